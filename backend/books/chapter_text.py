@@ -0,0 +1,182 @@
+import re
+from bisect import bisect_right
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+
+
+# placeholder div that used to be stored in chapter HTML for every event. Event anchors are now
+# rendered when a chapter is served (render_event_anchors), these are only removed from older chapters
+EVENT_PLACEHOLDER_RE = re.compile(r'<div id="ev\d+">PLACEHOLDER FOR IMAGE \d+</div>')
+EVENT_PLACEHOLDER_ID_RE = re.compile(r'ev\d+')
+
+# Chapters are parsed once, at ingestion. Besides the HTML served to readers, a chapter stores:
+#   - text: its plain text
+#   - paragraph_index: one [html_start, html_end, text_start, text_end] entry per <p>, in document order.
+#     Paragraph n (1-based, as used by events) is paragraph_index[n - 1]: the <p> element is
+#     content[html_start:html_end] and its text is text[text_start:text_end].
+# Downstream modules (events, summaries, characters, embeddings, scenes) read these instead of re-parsing HTML.
+
+
+def _is_event_placeholder(tag):
+    return tag.name == "div" and EVENT_PLACEHOLDER_ID_RE.fullmatch(tag.get("id") or "") is not None
+
+
+def _collect_text(node, parts, length, paragraphs):
+    # depth first walk appending text strings (same strings as get_text()) and recording <p> text offsets
+    for child in node.children:
+        if isinstance(child, Tag):
+            if _is_event_placeholder(child):
+                continue
+            if child.name == "p":
+                entry = [child, length, length]
+                paragraphs.append(entry)
+                length = _collect_text(child, parts, length, paragraphs)
+                entry[2] = length
+            else:
+                length = _collect_text(child, parts, length, paragraphs)
+        elif type(child) in (NavigableString, CData):
+            parts.append(str(child))
+            length += len(child)
+    return length
+
+
+def normalize_chapter(root):
+    """
+    Single pass normalization of a parsed chapter (BeautifulSoup body, or soup if there is no body).
+
+    Returns (content_html, text, paragraph_index):
+      - content_html: HTML of the chapter body, as stored in Chapter.content
+      - text: plain text of the chapter (event placeholders excluded)
+      - paragraph_index: [html_start, html_end, text_start, text_end] for every <p>
+    """
+    content_html = "".join(str(child) for child in root.contents)
+
+    parts = []
+    paragraphs = []
+    _collect_text(root, parts, 0, paragraphs)
+    text = "".join(parts)
+
+    paragraph_index = []
+    cursor = 0
+    for p_tag, text_start, text_end in paragraphs:
+        # a <p> serializes the same way inside its parent, so it is found at or after the previous one
+        p_html = str(p_tag)
+        html_start = content_html.find(p_html, cursor)
+        if html_start == -1:
+            html_start = cursor
+            html_end = cursor
+        else:
+            html_end = html_start + len(p_html)
+            cursor = html_start + 1
+        paragraph_index.append([html_start, html_end, text_start, text_end])
+
+    return content_html, text, paragraph_index
+
+
+def chapter_index(chapter):
+    """
+    Paragraph index of a chapter. Chapters stored before the index existed (index None) are parsed once
+    here and their text and index are saved.
+    """
+    if chapter.paragraph_index is not None:
+        return chapter.paragraph_index
+
+    soup = BeautifulSoup(chapter.content, "html.parser")
+    _, chapter.text, chapter.paragraph_index = normalize_chapter(soup)
+    chapter.save(update_fields=["text", "paragraph_index"])
+    return chapter.paragraph_index
+
+
+def chapter_plain_text(chapter):
+    """Plain text of a chapter as sent to the LLM modules and embeddings."""
+    chapter_index(chapter)
+    return chapter.text
+
+
+def chapter_paragraphs(chapter):
+    """Text of every paragraph of a chapter, in order (paragraph n is item n - 1)."""
+    index = chapter_index(chapter)
+    return [chapter.text[text_start:text_end] for _, _, text_start, text_end in index]
+
+
+def paragraph_range_offsets(chapter, first, last):
+    """
+    (start, end) offsets into chapter.text of paragraphs first..last (1-based, inclusive) of a chapter.
+    first <= 1 starts at the beginning of the chapter, last past the end of the chapter goes to its end.
+    """
+    index = chapter_index(chapter)
+    if not index:
+        return 0, len(chapter.text)
+    start = 0 if first <= 1 else index[min(first, len(index)) - 1][2]
+    end = len(chapter.text) if last >= len(index) else index[max(last, 1) - 1][3]
+    return start, max(start, end)
+
+
+def paragraph_range_text(chapter, first, last):
+    """Text of paragraphs first..last (1-based, inclusive) of a chapter, see paragraph_range_offsets."""
+    start, end = paragraph_range_offsets(chapter, first, last)
+    return chapter.text[start:end]
+
+
+def remove_event_placeholders(chapter):
+    """
+    Remove event placeholders from chapter.content and keep the paragraph index in sync.
+    Returns True if the content changed. The chapter is not saved.
+    """
+    chapter_index(chapter)
+    matches = list(EVENT_PLACEHOLDER_RE.finditer(chapter.content))
+    if not matches:
+        return False
+
+    ends = [m.end() for m in matches]
+    removed = [0]
+    for m in matches:
+        removed.append(removed[-1] + len(m.group(0)))
+
+    def shift(offset):
+        return offset - removed[bisect_right(ends, offset)]
+
+    for entry in chapter.paragraph_index:
+        entry[0] = shift(entry[0])
+        entry[1] = shift(entry[1])
+    chapter.content = EVENT_PLACEHOLDER_RE.sub("", chapter.content)
+    return True
+
+
+def paragraph_insert_position(chapter, paragraph_number):
+    """Position just before the closing </p> of a paragraph (1-based), where event anchors go."""
+    _, html_end, _, _ = chapter.paragraph_index[paragraph_number - 1]
+    if chapter.content[html_end - 4:html_end] == "</p>":
+        return html_end - 4
+    return html_end
+
+
+def event_anchor(event_number):
+    """HTML anchor marking the end of an event, swapped by the frontend for the scene widget"""
+    return f'<div id="ev{event_number}"></div>'
+
+
+def render_event_anchors(chapter, events):
+    """
+    Chapter HTML with the anchor of every event inserted at the end of its last paragraph.
+    Anchors are not stored: chapter.content is left unchanged.
+    """
+    index = chapter_index(chapter)
+    if not index:
+        return chapter.content
+
+    insertions = []
+    for event in events:
+        if event.start_index >= 1:
+            insertions.append((paragraph_insert_position(chapter, min(event.start_index, len(index))), event_anchor(event.number)))
+    if not insertions:
+        return chapter.content
+
+    insertions.sort(key=lambda insertion: insertion[0])
+    pieces = []
+    previous = 0
+    for position, html in insertions:
+        pieces.append(chapter.content[previous:position])
+        pieces.append(html)
+        previous = position
+    pieces.append(chapter.content[previous:])
+    return "".join(pieces)
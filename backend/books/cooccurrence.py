@@ -0,0 +1,83 @@
+import numpy as np
+
+from .models import Character, CharacterMention
+
+
+# Character co-occurrence: two characters co-occur when they are mentioned in the same paragraph.
+# Computed at ingestion (cooccurrence stage) from the mention index (mentions.py), no LLM involved.
+# Stored in Book.cooccurrence:
+#   {"characters": {name: paragraphs mentioning the character},
+#    "pairs": [{"source", "target", "weight", "first_chapter"}]}   (only co-occurring pairs, by weight)
+# weight is the number of paragraphs mentioning both characters, first_chapter the first chapter where it happens.
+
+
+def chapter_cooccurrence(book):
+    """
+    Co-occurrence counts chapter by chapter, in chapter order.
+
+    Returns (names, chapters): names of the book characters (matrix order) and
+    [(chapter number, n x n counts of the chapter)] for the chapters with mentions.
+    """
+    characters = list(Character.objects.filter(book=book).order_by('id'))
+    column = {c.id: i for i, c in enumerate(characters)}
+    names = [c.name for c in characters]
+
+    mentions = (
+        CharacterMention.objects.filter(character__book=book)
+        .values_list('character_id', 'chapter__number', 'paragraphs')
+        .order_by('chapter__number')
+    )
+    # mentioned paragraphs of every chapter: {chapter number: [(column, paragraph numbers)]}
+    chapters = {}
+    for character_id, chapter_number, paragraphs in mentions:
+        if paragraphs:
+            chapters.setdefault(chapter_number, []).append((column[character_id], paragraphs))
+
+    n = len(characters)
+    result = []
+    for chapter_number in sorted(chapters):
+        entries = chapters[chapter_number]
+        # incidence matrix of the chapter: one row per mentioned paragraph, one column per character
+        rows = {p: i for i, p in enumerate(sorted({p for _, paragraphs in entries for p in paragraphs}))}
+        incidence = np.zeros((len(rows), n), dtype=np.int64)
+        for col, paragraphs in entries:
+            incidence[[rows[p] for p in paragraphs], col] = 1
+        result.append((chapter_number, incidence.T @ incidence))
+    return names, result
+
+
+def cooccurrence_pairs(names, counts, first_chapter):
+    """Co-occurring pairs of a counts matrix in the Book.cooccurrence format, heaviest first."""
+    # upper triangle: each unordered pair once, the diagonal is the paragraph count of each character
+    sources, targets = np.nonzero(np.triu(counts, k=1))
+    order = np.argsort(-counts[sources, targets], kind="stable")
+    return [
+        {
+            "source": names[sources[i]],
+            "target": names[targets[i]],
+            "weight": int(counts[sources[i], targets[i]]),
+            "first_chapter": int(first_chapter[sources[i], targets[i]]),
+        }
+        for i in order
+    ]
+
+
+def compute_cooccurrence(book):
+    """Character x character paragraph co-occurrence of a book, in the Book.cooccurrence format."""
+    names, chapters = chapter_cooccurrence(book)
+    n = len(names)
+    counts = np.zeros((n, n), dtype=np.int64)
+    first_chapter = np.zeros((n, n), dtype=np.int64)
+    for chapter_number, chapter_counts in chapters:
+        first_chapter[(first_chapter == 0) & (chapter_counts > 0)] = chapter_number
+        counts += chapter_counts
+
+    return {
+        "characters": {names[i]: int(counts[i, i]) for i in range(n)},
+        "pairs": cooccurrence_pairs(names, counts, first_chapter),
+    }
+
+
+def pair_key(source, target):
+    # pairs are undirected
+    return tuple(sorted((source, target)))
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import numpy as np
+
+from .cooccurrence import chapter_cooccurrence, pair_key
+from .models import Chapter, Character, GraphSnapshot
+
+
+# Relationship graph served by GET /api/books/<book_id>/graph/, in the frontend graph library format:
+#   nodes: [{id, label, x, y}], edges: [{id, source, target, label, weight, first_chapter}]
+# At ingestion (graph stage) one snapshot is stored per chapter: the graph as a reader of that chapter
+# knows it, so the endpoint is a single lookup. A relationship shows up once both characters have been
+# mentioned together (first co-appearance), or once both have appeared when they are never mentioned together.
+#
+# Node coordinates come from a force-directed layout of the whole book graph, computed once per graph
+# version and stored in Book.graph_layout next to Book.relationships. Every snapshot uses the same
+# coordinates, so characters do not move from one chapter to the next.
+
+
+def relationship_graph(relationships, cooccurrence, visible=None):
+    """
+    Graph of labeled relationships.
+      - relationships: [{source, target, label}] (Book.relationships["relationships"])
+      - cooccurrence: {pair_key: {weight, first_chapter}}
+      - visible: indexes of the relationships to include, all of them if None. Edge ids use the
+        index in relationships so an edge keeps its id in every snapshot
+    """
+    if visible is not None:
+        relationships = [r if i in visible else {} for i, r in enumerate(relationships)]
+
+    names = set()
+    for r in relationships:
+        s = r.get("source")
+        t = r.get("target")
+        if s: names.add(s)
+        if t: names.add(t)
+
+    nodes = [{"id": n, "label": n} for n in sorted(names)]
+
+    edges = []
+    for i, r in enumerate(relationships):
+        s, t = r.get("source"), r.get("target")
+        if not s or not t:
+            continue
+        edges.append({
+            "id": f"{s}-{t}-{i}",
+            "source": s,
+            "target": t,
+            "label": r.get("label", ""),
+            "weight": cooccurrence.get(pair_key(s, t), {}).get("weight", 0),
+            "first_chapter": cooccurrence.get(pair_key(s, t), {}).get("first_chapter"),
+        })
+    return {"nodes": nodes, "edges": edges}
+
+
+def graph_etag(graph):
+    """Hash of the graph content, the same graph gets the same ETag whatever the chapter."""
+    return hashlib.sha1(json.dumps(graph, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def build_graph_snapshots(book):
+    """
+    Graph snapshot of every chapter of a book, built incrementally in chapter order.
+    Returns unsaved GraphSnapshot objects.
+    """
+    relationships = (book.relationships or {}).get("relationships", [])
+    chapter_numbers = list(Chapter.objects.filter(book=book).order_by('number').values_list('number', flat=True))
+    if not chapter_numbers:
+        return []
+    last_chapter = chapter_numbers[-1]
+
+    names, chapter_counts = chapter_cooccurrence(book)
+    column = {name: i for i, name in enumerate(names)}
+    counts_by_chapter = dict(chapter_counts)
+    first_seen = {
+        name: min(chapters) if chapters else None
+        for name, chapters in Character.objects.filter(book=book).values_list('name', 'chapters_appeared')
+    }
+
+    n = len(names)
+    counts = np.zeros((n, n), dtype=np.int64)
+    first_chapter = np.zeros((n, n), dtype=np.int64)
+    snapshots = []
+    for number in chapter_numbers:
+        if number in counts_by_chapter:
+            first_chapter[(first_chapter == 0) & (counts_by_chapter[number] > 0)] = number
+            counts += counts_by_chapter[number]
+
+        cooccurrence = {}
+        visible = set()
+        for index, r in enumerate(relationships):
+            s, t = r.get("source"), r.get("target")
+            if s in column and t in column and counts[column[s], column[t]] > 0:
+                i, j = column[s], column[t]
+                cooccurrence[pair_key(s, t)] = {"weight": int(counts[i, j]), "first_chapter": int(first_chapter[i, j])}
+                visible.add(index)
+            else:
+                appeared = [first_seen.get(s), first_seen.get(t)]
+                # characters never found in the text are shown from the last chapter on
+                if None in appeared:
+                    if number == last_chapter:
+                        visible.add(index)
+                elif max(appeared) <= number:
+                    visible.add(index)
+
+        graph = relationship_graph(relationships, cooccurrence, visible)
+        snapshots.append(GraphSnapshot(book=book, chapter_number=number, graph=graph, etag=graph_etag(graph)))
+    return snapshots
+
+
+def graph_version(book):
+    """Hash of the data the layout depends on, changes whenever the relationships or their weights change."""
+    data = {
+        "relationships": (book.relationships or {}).get("relationships", []),
+        "pairs": (book.cooccurrence or {}).get("pairs", []),
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def force_layout(n, edges, iterations=200, seed=0):
+    """
+    Fruchterman-Reingold force-directed layout of n nodes, vectorized with NumPy.
+
+    edges: [(i, j, strength)]. Every pair of nodes repels, edges attract their nodes proportionally
+    to strength. Returns an (n, 2) array of positions in [-1, 1]. Deterministic for a given seed.
+    Cost is O(n^2) per iteration, a few hundred nodes take well under a second.
+    """
+    if n == 0:
+        return np.zeros((0, 2))
+    if n == 1:
+        return np.zeros((1, 2))
+
+    rng = np.random.default_rng(seed)
+    pos = rng.random((n, 2)) * 2 - 1
+    attraction = np.zeros((n, n))
+    for i, j, strength in edges:
+        attraction[i, j] += strength
+        attraction[j, i] += strength
+
+    # optimal distance between nodes and starting temperature (max move per iteration)
+    k = np.sqrt(4.0 / n)
+    temperature = 0.2
+    cooling = temperature / (iterations + 1)
+    for _ in range(iterations):
+        delta = pos[:, None, :] - pos[None, :, :]
+        distance = np.linalg.norm(delta, axis=-1)
+        np.clip(distance, 0.01, None, out=distance)
+        # repulsion k^2 / d for every pair, attraction d^2 / k along edges
+        force = k * k / distance ** 2 - attraction * distance / k
+        displacement = np.einsum("ijk,ij->ik", delta, force)
+        length = np.linalg.norm(displacement, axis=-1)
+        length = np.where(length < 0.01, 0.1, length)
+        pos += displacement * (temperature / length)[:, None]
+        temperature -= cooling
+
+    pos -= pos.mean(axis=0)
+    extent = np.abs(pos).max()
+    return pos / extent if extent > 0 else pos
+
+
+# half width of the layout, in frontend graph units, per sqrt(number of nodes)
+LAYOUT_SCALE = 60
+
+
+def compute_layout(book):
+    """Node coordinates of the whole book graph: {name: [x, y]}"""
+    relationships = [r for r in (book.relationships or {}).get("relationships", []) if r.get("source") and r.get("target")]
+    names = sorted({r["source"] for r in relationships} | {r["target"] for r in relationships})
+    index = {name: i for i, name in enumerate(names)}
+    weights = {pair_key(p["source"], p["target"]): p["weight"] for p in (book.cooccurrence or {}).get("pairs", [])}
+
+    # characters mentioned together more often are pulled closer
+    edges = [
+        (index[r["source"]], index[r["target"]], 1.0 + np.log1p(weights.get(pair_key(r["source"], r["target"]), 0)))
+        for r in relationships
+    ]
+    positions = force_layout(len(names), edges)
+    # spread grows with the number of nodes so they keep about the same spacing
+    scale = LAYOUT_SCALE * np.sqrt(max(len(names), 1))
+    return {name: [round(float(x) * scale, 2), round(float(y) * scale, 2)] for name, (x, y) in zip(names, positions)}
+
+
+def save_book_layout(book):
+    """
+    Compute the layout of the book graph and save it in Book.graph_layout, unless it is up to date with
+    the relationships already. Called by the graph ingestion stage only. Returns (positions, version).
+    """
+    version = graph_version(book)
+    layout = book.graph_layout or {}
+    if layout.get("version") != version:
+        layout = {"version": version, "positions": compute_layout(book)}
+        book.graph_layout = layout
+        book.save(update_fields=["graph_layout"])
+    return layout["positions"], version
+
+
+def stored_layout(book):
+    """
+    Layout of the book graph as stored by the graph stage, never computed here: (positions, version),
+    ({}, "") for a book whose graph stage has not run yet.
+    """
+    layout = book.graph_layout or {}
+    return layout.get("positions", {}), layout.get("version", "")
+
+
+def with_layout(graph, positions):
+    """Copy of a graph with node coordinates (nodes missing from the layout are left without)."""
+    nodes = []
+    for node in graph["nodes"]:
+        position = positions.get(node["id"])
+        if position is not None:
+            node = {**node, "x": position[0], "y": position[1]}
+        nodes.append(node)
+    return {**graph, "nodes": nodes}
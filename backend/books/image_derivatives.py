@@ -0,0 +1,103 @@
+import os
+from django.conf import settings
+from PIL import Image, features
+
+
+# Image derivatives: smaller WebP/AVIF copies of the generated or extracted images (covers, character portraits,
+# scene images), written once per image next to the original:
+#   uploads/scenes/scene_1_2_3.png  ->  uploads/scenes/scene_1_2_3_w256.webp, scene_1_2_3_w256.avif, ...
+# Endpoints return them as a srcset map {"webp": "<url> 256w, <url> 512w, <original url> 1024w", "avif": ...} so
+# the frontend picks the smallest file that fits, the original is the largest candidate and the fallback.
+# A derivative older than its original (e.g a scene preview replaced by the full render) is rebuilt.
+
+# quality of the encoded derivatives, per format
+DERIVATIVE_QUALITY = {"webp": 80, "avif": 60}
+
+
+def derivative_formats():
+    """Formats derivatives are written in, AVIF only if this Pillow build supports it."""
+    return [fmt for fmt in settings.IMAGE_DERIVATIVE_FORMATS if features.check(fmt)]
+
+
+def derivative_path(original_path, width, fmt):
+    return f"{os.path.splitext(original_path)[0]}_w{width}.{fmt}"
+
+
+def _is_current(path, original_mtime):
+    try:
+        return os.path.getmtime(path) >= original_mtime
+    except FileNotFoundError:
+        return False
+
+
+def make_derivatives(original_path):
+    """
+    Write the missing or outdated derivatives of an image: every format of IMAGE_DERIVATIVE_WIDTHS
+    narrower than the original. Returns the number of files written.
+    """
+    original_mtime = os.path.getmtime(original_path)
+    formats = derivative_formats()
+    written = 0
+    with Image.open(original_path) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        for width in settings.IMAGE_DERIVATIVE_WIDTHS:
+            if width >= image.width:
+                continue
+            pending = [fmt for fmt in formats if not _is_current(derivative_path(original_path, width, fmt), original_mtime)]
+            if not pending:
+                continue
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            for fmt in pending:
+                path = derivative_path(original_path, width, fmt)
+                # written under a temporary name first, a partly written file is never served
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                resized.save(tmp_path, format=fmt.upper(), quality=DERIVATIVE_QUALITY[fmt])
+                os.replace(tmp_path, path)
+                written += 1
+    return written
+
+
+def build_derivatives(original_path):
+    """make_derivatives for the image pipelines: errors are logged, never raised."""
+    try:
+        return make_derivatives(original_path)
+    except Exception as e:
+        print(f"[IMAGE DERIVATIVES] Error while building derivatives of {original_path}:", repr(e))
+        return 0
+
+
+def image_srcset(original_path, original_url, request=None):
+    """
+    srcset map of the derivatives of an image that exist on disk: {format: "<url> <width>w, ..."}.
+    The original is the last, largest candidate of every format, so a browser never upscales a derivative
+    where the original is wider. Derivatives are looked up, not built. URLs are absolute if request is given.
+    """
+    if not original_path or not os.path.exists(original_path):
+        return {}
+    original_mtime = os.path.getmtime(original_path)
+    base_url = os.path.splitext(original_url.split("?")[0])[0]
+    with Image.open(original_path) as image:
+        original_width = image.width
+
+    def absolute(url):
+        return request.build_absolute_uri(url) if request is not None else url
+
+    srcset = {}
+    for fmt in derivative_formats():
+        entries = []
+        for width in settings.IMAGE_DERIVATIVE_WIDTHS:
+            if width < original_width and _is_current(derivative_path(original_path, width, fmt), original_mtime):
+                entries.append(f"{absolute(f'{base_url}_w{width}.{fmt}')} {width}w")
+        if entries:
+            entries.append(f"{absolute(original_url)} {original_width}w")
+            srcset[fmt] = ", ".join(entries)
+    return srcset
+
+
+def file_srcset(field_file, request=None):
+    """image_srcset of an ImageField value (Book.cover_image, Character.image)."""
+    if not field_file:
+        return {}
+    return image_srcset(field_file.path, field_file.url, request)
@@ -0,0 +1,501 @@
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from ebooklib import epub
+from bs4 import BeautifulSoup
+import ebooklib
+
+from .models import Book, Chapter, Character, Event, GraphSnapshot, IngestionJob, IngestionStage
+
+# importing LLM modules
+from books.llm_modules.summarizer import summarize_all_chapters, summarize_chapters_map_reduce
+from books.llm_modules.recap import build_recap_tree
+from books.llm_modules.character_extractor import set_characters, set_character_relationships, CharacterList
+from books.llm_modules.Chroma_embed import load_book
+from books.llm_modules.event_extractor import extract_events
+from books.llm_modules.metadata_extractor import get_book_metadata
+from books.llm_modules.image_gen import generate_character_image
+from books.llm_modules.scene_prompts import generate_scene_prompts, refresh_scene_context_version
+from books.llm_modules.fanout import fan_out
+from books.llm_modules.usage import track_usage
+
+# importing utility functions
+from .utils import save_characters_to_db, save_events_to_db, clear_events, save_chapter_summaries, save_recap_tree
+from .chapter_text import normalize_chapter
+from .mentions import build_mention_index
+from .cooccurrence import compute_cooccurrence
+from .graph import build_graph_snapshots, save_book_layout
+from .image_derivatives import build_derivatives
+
+
+# Background ingestion pipeline.
+# upload_epub only stores the EPUB and queues an IngestionJob. A worker process
+# (python manage.py ingest_worker) claims queued jobs and runs the stage graph below,
+# checkpointing every stage in an IngestionStage row so the frontend can poll /api/books/<id>/ingest_status/
+# and a failed ingestion can be resumed without paying again for the stages already done.
+
+
+class StageIncomplete(Exception):
+    """
+    Raised by a stage that saved part of its work: the stage is marked failed and its outputs are kept in
+    its checkpoint, so the next run of the stage can pick up the part that is missing.
+    """
+
+    def __init__(self, message, outputs):
+        super().__init__(message)
+        self.outputs = outputs
+
+
+def parse_epub(book):
+    """
+    Reads the stored EPUB file of a book and creates its Chapter rows.
+
+    - Reads EPUB metadata (title/author) and stores it.
+    - Extracts a cover image (if found) into MEDIA/uploads/covers/, with its WebP/AVIF derivatives.
+    - Extracts each document item as a Chapter (HTML content, plain text and paragraph index).
+    """
+    epub_book = epub.read_epub(book.epub_file.path)
+    title = epub_book.get_metadata('DC', 'title')
+    author = epub_book.get_metadata('DC', 'creator')
+    book.title = title[0][0] if title else book.title
+    book.author = author[0][0] if author else ''
+    book.save(update_fields=['title', 'author'])
+
+    # Extract book cover image if possible
+    for item in epub_book.get_items_of_type(ebooklib.ITEM_IMAGE):
+        if 'cover' in item.get_name().lower():
+            # save to MEDIA ROOT folder
+            cover_folder = os.path.join(settings.MEDIA_ROOT, 'uploads', 'covers')
+            os.makedirs(cover_folder, exist_ok=True)
+
+            cover_path = os.path.join(cover_folder, f'cover_{book.id}.jpg')
+            with open(cover_path, 'wb') as f:
+                f.write(item.get_content())
+            build_derivatives(cover_path)
+
+            book.cover_image = f'uploads/covers/cover_{book.id}.jpg'
+            book.save(update_fields=['cover_image'])
+            break
+
+    # a rerun of this stage replaces previously extracted chapters
+    Chapter.objects.filter(book=book).delete()
+
+    # Extract chapters from all HTML/XHTML document items
+    chapter_num = 1
+    for item in epub_book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+        soup = BeautifulSoup(item.get_body_content(), features="lxml")
+        if soup is None:
+            soup = BeautifulSoup(item.get_body_content(), "html.parser")
+
+        for tag in soup(["script", "style"]):
+            tag.decompose()
+
+        # single parse of the chapter: HTML, plain text and paragraph index all come from this soup
+        body = soup.body
+        content_html, text, paragraph_index = normalize_chapter(body if body else soup)
+
+        title_tag = soup.find(["h1", "h2"])
+        chapter_title = title_tag.get_text(strip=True) if title_tag else f"Chapter {chapter_num}"
+
+        #create chapter objects in DB
+        Chapter.objects.create(
+            book=book,
+            number=chapter_num,
+            title=chapter_title,
+            content=content_html,
+            text=text,
+            paragraph_index=paragraph_index,
+        )
+        chapter_num += 1
+
+    return {"chapters": chapter_num - 1, "title": book.title, "author": book.author}
+
+
+# Every stage receives its own Book object (stages can run at the same time in different threads)
+# and only saves the fields it owns.
+
+def stage_summary(book):
+    #LLM call to text summarizer module
+    chapter_stats = []
+    if book.summary_mode == "map_reduce":
+        chapter_summaries = summarize_chapters_map_reduce(book.id, stats=chapter_stats)
+    else:
+        chapter_summaries = summarize_all_chapters(book.id, stats=chapter_stats)
+    save_chapter_summaries(book, chapter_summaries)
+    book.summary = "\n\n".join(item["summary"].strip() for item in chapter_summaries)
+    book.save(update_fields=['summary'])
+    refresh_scene_context_version(book)
+    return {
+        "mode": book.summary_mode,
+        "summary_length": len(book.summary),
+        "chapter_summaries": len(chapter_summaries),
+        "prompt_tokens": sum(c["prompt_tokens"] for c in chapter_stats),
+        "max_prompt_tokens": max((c["prompt_tokens"] for c in chapter_stats), default=0),
+        "chapters": chapter_stats,
+    }
+
+
+def stage_recap(book):
+    #LLM calls condensing chapter summaries into the recap tree (arcs, then whole book)
+    nodes = build_recap_tree(book.id)
+    save_recap_tree(book, nodes)
+    refresh_scene_context_version(book)
+    return {"nodes": len(nodes), "levels": max((n["level"] for n in nodes), default=-1) + 1}
+
+
+def stage_metadata(book):
+    #LLM call to metadata extractor module
+    book.inferred_metadata = get_book_metadata(book.id).model_dump()
+    book.save(update_fields=['inferred_metadata'])
+    refresh_scene_context_version(book)
+    return {"main_genre": book.inferred_metadata.get("main_genre", [])}
+
+
+def stage_characters(book):
+    #LLM call to character extractor module, then save character objects to DB
+    result = set_characters(book.id)
+    if not isinstance(result, CharacterList):
+        return {"characters": []}
+
+    names = [c.name for c in result.Characters]
+    # on a rerun, characters that are no longer extracted are removed. Kept ones keep their portrait
+    Character.objects.filter(book=book).exclude(name__in=names).delete()
+    save_characters_to_db(book, result, generate_images=False)
+    refresh_scene_context_version(book)
+    return {"characters": names}
+
+
+def stage_mentions(book):
+    #local character mention index over chapter text (no LLM), sets chapters_appeared of every character
+    entries = build_mention_index(book)
+    return {"entries": entries}
+
+
+def stage_cooccurrence(book):
+    #character x character paragraph co-occurrence from the mention index (NumPy, no LLM)
+    book.cooccurrence = compute_cooccurrence(book)
+    book.save(update_fields=['cooccurrence'])
+    return {"pairs": len(book.cooccurrence["pairs"])}
+
+
+def stage_portraits(book):
+    #LLM image generation for every character without a portrait, one API call per character
+    characters = list(Character.objects.filter(book=book).filter(Q(image='') | Q(image__isnull=True)))
+    results = fan_out(generate_character_image, characters, settings.PORTRAIT_MAX_WORKERS)
+    return {
+        "generated": sum(1 for ok, _ in results if ok),
+        "failed": [c.name for c, (ok, _) in zip(characters, results) if not ok],
+    }
+
+
+def stage_relationships(book):
+    #LLM call to character extractor module (extract relationships)
+    book.relationships = set_character_relationships(book.id).model_dump()
+    book.save(update_fields=['relationships'])
+    return {"relationships": len(book.relationships.get("relationships", []))}
+
+
+def stage_graph(book):
+    #relationship graph snapshots, one per chapter, and node layout of the graph (no LLM)
+    snapshots = build_graph_snapshots(book)
+    with transaction.atomic():
+        GraphSnapshot.objects.filter(book=book).delete()
+        GraphSnapshot.objects.bulk_create(snapshots)
+    positions, _ = save_book_layout(book)
+    return {"snapshots": len(snapshots), "layout_nodes": len(positions)}
+
+
+def stage_events(book):
+    #LLM call to event extractor module, events are stored with their offsets (anchors are rendered when a chapter is served)
+    # a run where some chapters failed keeps their ids in its outputs: the next run only extracts those
+    previous = IngestionStage.objects.filter(book=book, name="events").values_list("outputs", flat=True).first() or {}
+    retry = list(Chapter.objects.filter(book=book, id__in=previous.get("failed_chapters") or []).values_list("id", flat=True))
+    clear_events(book, chapter_ids=retry or None)
+    request_stats = {}
+    all_events = extract_events(book.id, chapter_ids=retry or None, stats=request_stats)
+    save_events_to_db(book, all_events)
+    outputs = {
+        "events": Event.objects.filter(chapter__book=book).count(),
+        "retried_chapters": retry,
+        "failed_chapters": [e["chapter_id"] for e in all_events if e["error"]],
+        **request_stats,
+    }
+    if outputs["failed_chapters"]:
+        # the events of the other chapters are saved, the stage is failed so that resuming retries the rest
+        raise StageIncomplete(f"Event extraction failed for chapters {outputs['failed_chapters']}", outputs)
+    return outputs
+
+
+def stage_scene_prompts(book):
+    #LLM calls writing the scene image prompt of every event ahead of time, one call per chapter
+    stats = {}
+    written = generate_scene_prompts(book.id, stats=stats)
+    return {"prompts": written, **stats}
+
+
+def stage_embeddings(book):
+    #Build embeddings for RAG querying (Chroma)
+    chunks = load_book(book.id)
+    return {"chunks": chunks or 0}
+
+
+# Stage graph: stage name -> (stage function, names of the stages it needs).
+# Every stage receives the Book object and returns a small JSON serializable dict describing its outputs.
+# Stages whose dependencies are done run at the same time, so ingest latency is the longest chain
+# (parse -> summary -> recap -> relationships, ...) instead of the sum of all stages.
+STAGES = {
+    "parse": (parse_epub, []),
+    "summary": (stage_summary, ["parse"]),
+    "recap": (stage_recap, ["summary"]),
+    "metadata": (stage_metadata, ["summary"]),
+    "characters": (stage_characters, ["parse"]),
+    "mentions": (stage_mentions, ["characters"]),
+    "cooccurrence": (stage_cooccurrence, ["mentions"]),
+    "portraits": (stage_portraits, ["characters"]),
+    "relationships": (stage_relationships, ["recap", "characters", "cooccurrence"]),
+    "graph": (stage_graph, ["relationships"]),
+    "events": (stage_events, ["parse"]),
+    "scene_prompts": (stage_scene_prompts, ["events", "recap", "metadata", "characters"]),
+    "embeddings": (stage_embeddings, ["parse"]),
+}
+
+# declaration order is a valid topological order of the graph
+STAGE_NAMES = list(STAGES)
+
+
+def downstream_stages(name):
+    """The stage and every stage that needs it (directly or not), in pipeline order."""
+    selected = {name}
+    for other in STAGE_NAMES:
+        if any(dep in selected for dep in STAGES[other][1]):
+            selected.add(other)
+    return [other for other in STAGE_NAMES if other in selected]
+
+
+def enqueue_ingestion(book, stages=None):
+    """
+    Queue an ingestion job for a book. The job is run later by an ingest_worker process.
+
+    stages: names of stages to (re)run even if they are already done. By default (None) the job
+    resumes ingestion and only runs the stages that are not done yet.
+    """
+    for name in STAGE_NAMES:
+        IngestionStage.objects.get_or_create(book=book, name=name)
+    # stages rerun on purpose start over, not from the part a previous run left missing
+    IngestionStage.objects.filter(book=book, name__in=list(stages or [])).update(outputs={})
+    return IngestionJob.objects.create(book=book, stages=list(stages or []))
+
+
+def claim_next_job(worker_name=""):
+    """
+    Claim the oldest queued job for this worker.
+
+    Claiming is a conditional UPDATE (status queued -> running), so when several workers race
+    for the same job only one of them gets it. Returns None when the queue is empty.
+    """
+    queued_ids = IngestionJob.objects.filter(status="queued").order_by("created_at").values_list("id", flat=True)[:10]
+    for job_id in queued_ids:
+        claimed = IngestionJob.objects.filter(id=job_id, status="queued").update(
+            status="running",
+            worker=worker_name,
+            started_at=timezone.now(),
+        )
+        if claimed:
+            return IngestionJob.objects.select_related("book").get(id=job_id)
+    return None
+
+
+def stages_to_run(job):
+    """
+    Names of the stages a job runs, in pipeline order:
+      - if job.stages is set, exactly those stages (rerun even if done)
+      - otherwise every stage whose checkpoint is not done (resume)
+    """
+    if job.stages:
+        return [name for name in STAGE_NAMES if name in job.stages]
+    done = set(IngestionStage.objects.filter(book=job.book, status="done").values_list("name", flat=True))
+    return [name for name in STAGE_NAMES if name not in done]
+
+
+def run_stage(book, name, stage_function):
+    """
+    Run one stage and checkpoint it in its IngestionStage row: status, outputs, duration,
+    token usage and error. Exceptions are re-raised after the row is marked failed.
+    """
+    stage, _ = IngestionStage.objects.get_or_create(book=book, name=name)
+    stage.status = "running"
+    stage.error = ""
+    stage.started_at = timezone.now()
+    stage.finished_at = None
+    stage.save()
+
+    start = time.perf_counter()
+    try:
+        with track_usage() as usage:
+            outputs = stage_function(book)
+    except Exception as e:
+        stage.status = "failed"
+        stage.error = repr(e)
+        if isinstance(e, StageIncomplete):
+            stage.outputs = e.outputs
+        raise
+    else:
+        stage.status = "done"
+        stage.outputs = outputs or {}
+    finally:
+        stage.duration = round(time.perf_counter() - start, 3)
+        stage.input_tokens = usage.input_tokens
+        stage.output_tokens = usage.output_tokens
+        stage.finished_at = timezone.now()
+        stage.save()
+    return stage
+
+
+def _run_stage_in_thread(book_id, name):
+    # each scheduler thread uses its own Book object and DB connection
+    try:
+        book = Book.objects.get(id=book_id)
+        return run_stage(book, name, STAGES[name][0])
+    finally:
+        connections.close_all()
+
+
+def run_ingestion_job(job):
+    """
+    Run the ingestion stages of a job (see stages_to_run) following the stage graph.
+
+    A stage starts as soon as all the stages it needs are done, with at most
+    settings.INGESTION_STAGE_WORKERS stages running at the same time.
+    Every stage is checkpointed in an IngestionStage row. When a stage fails, the stages that need it
+    are not started, independent stages still run, and the job is marked as failed at the end.
+    Stages completed before the failure stay done, so queueing the book
+    again (or python manage.py reprocess_book <id>) resumes from the failed stage.
+
+    The critical path of the book (longest chain of stage durations) is stored on the job.
+    Returns True if all stages completed.
+    """
+    book = job.book
+    pending = stages_to_run(job)
+    # dependencies outside of this run are either done or explicitly not rerun
+    waiting_on = {name: {dep for dep in STAGES[name][1] if dep in pending} for name in pending}
+    running = {}
+    failed = {}
+    blocked = []
+    wall_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=settings.INGESTION_STAGE_WORKERS) as pool:
+        while pending or running:
+            for name in [n for n in pending if not waiting_on[n]]:
+                pending.remove(name)
+                running[pool.submit(_run_stage_in_thread, book.id, name)] = name
+
+            if running:
+                job.current_stage = ",".join(sorted(running.values()))
+                job.save(update_fields=["current_stage"])
+            elif pending:
+                # only stages whose dependencies failed are left
+                blocked.extend(pending)
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    stage = future.result()
+                except Exception as e:
+                    print(f"[INGEST] Stage '{name}' failed for book {book.id}:", repr(e))
+                    traceback.print_exc()
+                    failed[name] = e
+                    continue
+                print(f"[INGEST] Book {book.id}: stage '{name}' done in {stage.duration}s")
+                for other in pending:
+                    waiting_on[other].discard(name)
+
+    job.critical_path = critical_path(book)
+    job.critical_path["wall_seconds"] = round(time.perf_counter() - wall_start, 3)
+    job.current_stage = ""
+    job.finished_at = timezone.now()
+    if failed:
+        job.status = "failed"
+        job.error = "; ".join(f"{name}: {e!r}" for name, e in failed.items())
+        if blocked:
+            job.error += f" (not run: {', '.join(blocked)})"
+    else:
+        job.status = "done"
+    job.save(update_fields=["status", "error", "current_stage", "finished_at", "critical_path"])
+    return not failed
+
+
+def critical_path(book):
+    """
+    Longest chain of dependent stages for a book, using the last recorded duration of each stage.
+
+    With independent stages running in parallel this chain is the lower bound of total ingest
+    latency. serial_seconds is the sum of all stage durations (the latency of a serial run).
+    """
+    durations = dict(IngestionStage.objects.filter(book=book).values_list("name", "duration"))
+    finish = {}
+    previous = {}
+    for name in STAGE_NAMES:
+        deps = STAGES[name][1]
+        slowest = max(deps, key=lambda dep: finish[dep], default=None)
+        finish[name] = (durations.get(name) or 0) + (finish[slowest] if slowest else 0)
+        previous[name] = slowest
+
+    last = max(STAGE_NAMES, key=lambda name: finish[name])
+    chain = []
+    while last:
+        chain.append(last)
+        last = previous[last]
+
+    return {
+        "stages": chain[::-1],
+        "seconds": round(finish[chain[0]], 3),
+        "serial_seconds": round(sum(d or 0 for d in durations.values()), 3),
+    }
+
+
+def ingestion_status(job):
+    """
+    Serializable status report of an ingestion job and the stage checkpoints of its book,
+    used by the ingest_status endpoint.
+    """
+    rows = {stage.name: stage for stage in IngestionStage.objects.filter(book=job.book_id)}
+    stages = []
+    for name in STAGE_NAMES:
+        stage = rows.get(name)
+        if stage is None:
+            stages.append({"name": name, "status": "pending"})
+            continue
+        stages.append({
+            "name": name,
+            "status": stage.status,
+            "started_at": stage.started_at,
+            "finished_at": stage.finished_at,
+            "duration": stage.duration,
+            "input_tokens": stage.input_tokens,
+            "output_tokens": stage.output_tokens,
+            "outputs": stage.outputs,
+            "error": stage.error,
+        })
+
+    completed = sum(1 for s in stages if s["status"] == "done")
+    return {
+        "book_id": job.book_id,
+        "job_id": job.id,
+        "status": job.status,
+        "current_stage": job.current_stage,
+        "completed_stages": completed,
+        "total_stages": len(stages),
+        "stages": stages,
+        "error": job.error,
+        "critical_path": job.critical_path,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
@@ -4,6 +4,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from ..models import Book,Chapter
 from django.utils.html import strip_tags
+from ..chapter_text import chapter_plain_text
 
 
 # Embedding model used to convert chunks into vectors
@@ -30,6 +31,8 @@ def load_book(book_id):
     - Store chunks as vector emeddings in chroma
         - computes embeddings
         - stores vectors + text + metadata on disk
+    Vectors previously stored for the book are replaced.
+    Returns the number of stored chunks.
     """
 
     try:
@@ -37,7 +40,7 @@ def load_book(book_id):
         chapters = Chapter.objects.filter(book=book).order_by('number')
         docs = []
         for chapter in chapters:
-            clean = strip_tags(chapter.content)
+            clean = chapter_plain_text(chapter)
             docs.append(
                 Document(
                     page_content=clean,
@@ -61,7 +64,13 @@ def load_book(book_id):
 
     print(f"Split blog post into {len(all_splits)} sub-documents.")
 
+    # remove vectors of a previous run so chunks are not stored twice
+    previous_ids = vector_store.get(where={"book_id": book.id}, include=[])["ids"]
+    if previous_ids:
+        vector_store.delete(ids=previous_ids)
+
     document_ids = vector_store.add_documents(documents=all_splits)
+    return len(document_ids)
 
 
     
\ No newline at end of file
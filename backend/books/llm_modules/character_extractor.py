@@ -1,9 +1,16 @@
+import re
+from collections import Counter
 from pydantic import BaseModel, Field
 from typing import Literal, List
 from ..models import *
 from langchain.chat_models import init_chat_model
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from django.utils.html import strip_tags
+from ..chapter_text import chapter_plain_text
+from ..utils import get_recap
+from ..cooccurrence import pair_key
+from django.conf import settings
+from .fanout import fan_out
 
 
 class CharacterInfo(BaseModel):
@@ -15,6 +22,7 @@ class CharacterInfo(BaseModel):
     personality: str =Field(description="The personality of the character in the book described in 4 lines")
     appearance: str =Field(description="A detailed physical description of the character`s physical appearance and look in 5 lines. A reader should be able to visualise the character based on just this description")
     bio : str = Field(description="A 4 line bio of the character")
+    aliases : List[str] = Field(description="Other names, nicknames or titles used for the character in the book")
     chapters_appeared : List[int] = Field(description="list of c_id in which the character appeared")
     
 class CharacterList(BaseModel):
@@ -23,91 +31,204 @@ class CharacterList(BaseModel):
         description="List of about to 6 elements each containing a character`s information",
     )
 
-def character_summary(book_id):
-    """
+class CharacterCandidate(BaseModel):
+    """A character seen in one chapter"""
+    name: str = Field(description="The most complete name used for the character in this chapter")
+    aliases: List[str] = Field(description="Other names, nicknames or titles used for the same character in this chapter")
+    mentions: int = Field(description="Approximate number of times the character is mentioned or appears in this chapter")
+    gender: str = Field(description="The gender of the character, ' ' if unknown")
+    age: str = Field(description="The age of the character if stated or implied, ' ' if unknown")
+    appearance: str = Field(description="What this chapter says about the character`s physical appearance, ' ' if nothing")
+    personality: str = Field(description="What this chapter shows about the character`s personality, ' ' if nothing")
+    actions: str = Field(description="What the character does in this chapter, in one or two lines")
 
-    Create a running human-readable  list of main characters in a bbook by reading chapters one-by-one.
 
-    Pipeline:
-      - Convert each chapter HTML to  plain text
-      - Maintain 'character_summary' text that gets updated each chapter
-      - Each loop (new chapter):
-          - send current chapter text + existing character list to the LLM
-          - ask the LLM to extract newly discovered characters and swap out existing characters if needed (max 6 characters)
-          - Since LLM has no access to previous chapters when choosing to replace characters, we introduce a field in running list called confidence score where the LLM scores how sure it is a character it chooses is relevant to story. This score can then be used to switch out existing irrelevant characters
-      - Returns the final summarized character list as plain text 
+class ChapterCandidates(BaseModel):
+    """Characters of one chapter"""
+    candidates: List[CharacterCandidate] = Field(description="Every named fictional character of the chapter")
+
+
+# words that are not part of a name key
+NAME_ARTICLES = {"the"}
+# titles are kept in name keys ("Mr. Bennet" and "Mrs. Bennet" are different people), a name without its
+# titles is only a short key
+NAME_TITLES = {"mr", "mrs", "ms", "miss", "dr", "sir", "lady", "lord", "captain", "professor", "madam", "master"}
+# number of chapter notes kept per field when merging a character
+MAX_MERGED_NOTES = 6
 
+
+def normalize_name(name):
+    """Key of a name: lower case words without punctuation or articles ("Mr. Darcy" -> "mr darcy")."""
+    words = re.findall(r"[\w']+", name.lower())
+    return " ".join(w for w in words if w not in NAME_ARTICLES)
+
+
+def short_name_keys(name):
+    """
+    Shorter keys a name can be referred to by: the name without its titles, and its first and last names
+    ("Mr. Fitzwilliam Darcy" -> "fitzwilliam darcy", "fitzwilliam", "darcy").
     """
+    words = [w for w in normalize_name(name).split() if w not in NAME_TITLES]
+    keys = {" ".join(words)}
+    if len(words) > 1:
+        keys.update({words[0], words[-1]})
+    return keys - {""}
 
 
-    if not book_id:
-        return "No book provided."
+def extract_character_candidates(book_id, max_workers=None):
+    """
+    Map step: extract the characters of every chapter at the same time (structured output, one call per chapter).
+
+    Returns one entry per chapter: {"chapter": chapter number, "candidates": [CharacterCandidate], "error": ""}
+    A failed chapter has no candidates, the others are still used.
+    """
+    max_workers = max_workers or settings.CHARACTER_EXTRACTION_MAX_WORKERS
     book = Book.objects.get(id=book_id)
-    #print(book)
-    chapters = Chapter.objects.filter(book=book_id).order_by('number')
-    chapter_texts = [strip_tags(chapter.content) for chapter in chapters]
-    
-    llm = init_chat_model("gpt-4.1-mini")
-    
-    character_summary=''
-    chapter_texts.pop(0)
-    for c in chapter_texts:
+    chapters = list(Chapter.objects.filter(book=book_id).order_by('number'))
+    # the first chapter is not a story chapter (cover, title page), like in the summaries
+    chapters = chapters[1:]
+    inputs = [(chapter.number, chapter_plain_text(chapter)) for chapter in chapters]
 
+    llm = init_chat_model("openai:gpt-4.1-mini")
+    extractor = llm.with_structured_output(ChapterCandidates)
+
+    def extract_chapter(item):
+        number, text = item
         messages = [
             {
                 "role": "system",
                 "content": (
-                    f"Your task is to identify fictional characters from the book '{book.title}' and extracting and summarizing their information from a book, chapter by chapter. "
-                    "You will receive the full text of the current chapter and a running list of characters identified from the previous chapters."
-                    f"Analyse the current chapter to (1) add new  characters   and (2) update the information for characters in the running list only if you find new information about them."
-                    "There can be at most 6 characters in the list.Keep adding new chracters to list if it contains less than 6.If you find a new relevant character in current chapter and running list is full, REPLACE an existing character with lowest confidence score with the new character ONLY if you think they are more relevant than the existing character( Use the confidence_score values of the existing characters to decide which one to remove,i.e remove the lowest-confidence character) OTHERWISE ignore new character."
-                   "Your goal is to return only an updated list after making all changes relevant to the new chapter"
-                   "If you do not know some attribute for a character,you can set it to ' ' "
-                   "If current chapter is not a story chapter but a preface or something similar, ignore and return unchanged list "
-                  "Return only the updated list as a clear, human-readable summary. "
-            "using the pseudo-structured format below for each list element. Keep it concise but detailed:\n\n"
-            "CHARACTER 1:\n"
-            "    name: <name>\n"
-            "    role: <protagonist | antagonist | supporting character>\n"
-            "    age: <age>\n"
-            "    gender: <gender>\n"
-            "    personality: <4 lines describing personality>\n"
-            "    appearance: <5 lines detailed description of physical appearance.A reader should be able to visualise the character based on just this description>\n"
-            "    bio: <4-line biography>\n"
-            "    chapters_appeared: [<list of chapter numbers>]\n"
-            "    confidence_score: <score between 0 and 1, describing how confident you are that this character is relevant to the story> \n\n"
-           
-                    
-                ),
-            },
-            {
-                "role": "user",
-                "content": (
-                    f"agent response for list of PREVIOUSLY IDENTIFIED CHARACTERS:\n{character_summary}\n\n"
-                    f"CURRENT CHAPTER TEXT:\n{c}\n\n"
-                    "UPDATED LIST OF CHARACTERS:"
+                    f"Your task is to identify the fictional characters of one chapter of the book '{book.title}'. "
+                    "You will receive the full text of the chapter. Return every named character that appears or is talked about, "
+                    "with the names and aliases used for them, an estimate of how often they are mentioned, "
+                    "and only the information about them that is found in this chapter. "
+                    "If you do not know some attribute for a character, you can set it to ' '. "
+                    "If the chapter is not a story chapter but a preface or something similar, return an empty list."
                 ),
             },
+            {"role": "user", "content": f"CHAPTER {number} TEXT:\n{text}"},
         ]
-        character_summary = llm.invoke(messages).content
-    
-    print(character_summary)
-    return character_summary
-    
+        return extractor.invoke(messages).candidates
+
+    results = fan_out(extract_chapter, inputs, max_workers)
+    return [
+        {"chapter": number, "candidates": candidates or [], "error": repr(error) if error else ""}
+        for (number, _), (candidates, error) in zip(inputs, results)
+    ]
+
+
+def merge_character_candidates(chapter_candidates):
+    """
+    Reduce step, no LLM call: merge the candidates of all chapters into one entry per character.
+
+    Candidates with the same name key (titles included) are the same character. A shorter key (an alias, the
+    name without titles, a first or last name) only merges when exactly one character claims it:
+      - "Darcy" joins "Mr. Darcy" if no other character is called Darcy
+      - "Bennet" is claimed by Mr., Mrs. and Miss Bennet, it joins none of them and they stay apart
+    Returns the merged characters ranked by total mentions (then by number of chapters):
+      [{"name", "aliases", "mentions", "chapters", "gender", "age", "appearance", "personality", "actions"}]
+    """
+    groups = {}
+    for entry in chapter_candidates:
+        for candidate in entry["candidates"]:
+            key = normalize_name(candidate.name)
+            if key:
+                groups.setdefault(key, []).append((entry["chapter"], candidate))
+
+    # short key -> name keys of the characters claiming it
+    claims = {}
+    for key, items in groups.items():
+        names = {n for _, candidate in items for n in [candidate.name, *candidate.aliases]}
+        short = {normalize_name(n) for n in names} | {k for n in names for k in short_name_keys(n)}
+        for other in short - {key, ""}:
+            claims.setdefault(other, set()).add(key)
+
+    parent = {key: key for key in groups}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for short, owners in claims.items():
+        if len(owners) == 1 and short in groups:
+            owner = find(next(iter(owners)))
+            other = find(short)
+            if other != owner:
+                parent[other] = owner
+
+    merged = {}
+    for key, items in groups.items():
+        merged.setdefault(find(key), []).extend(items)
+
+    characters = []
+    for items in merged.values():
+        items.sort(key=lambda item: item[0])
+        names = Counter()
+        aliases = set()
+        for _, candidate in items:
+            names[candidate.name.strip()] += max(candidate.mentions, 1)
+            aliases.update(a.strip() for a in candidate.aliases if a.strip())
+        name = names.most_common(1)[0][0]
+
+        def notes(field):
+            # earliest chapters first, a few lines at most
+            values = [getattr(c, field).strip() for _, c in items if getattr(c, field).strip()]
+            return " ".join(dict.fromkeys(values[:MAX_MERGED_NOTES]))
+
+        characters.append({
+            "name": name,
+            "aliases": sorted((aliases | set(names)) - {name}),
+            "mentions": sum(max(c.mentions, 1) for _, c in items),
+            "chapters": sorted({number for number, _ in items}),
+            "gender": next((c.gender.strip() for _, c in items if c.gender.strip()), ""),
+            "age": next((c.age.strip() for _, c in items if c.age.strip()), ""),
+            "appearance": notes("appearance"),
+            "personality": notes("personality"),
+            "actions": notes("actions"),
+        })
+
+    characters.sort(key=lambda c: (c["mentions"], len(c["chapters"])), reverse=True)
+    return characters
 
 
 def set_characters(book_id):
 
     """
-    Convert the final character list text into a pydantic CharacterList object.
+    Extract the main characters of a book as a pydantic CharacterList object.
 
-    
-    Note: confidence_score is ignored during parsing since we do not need it anymore
+    Pipeline:
+      - map: candidate characters of every chapter, extracted in parallel (extract_character_candidates)
+      - reduce: candidates merged locally by normalized name / alias and ranked by mentions (merge_character_candidates)
+      - one final LLM call picks the main characters among the top ranked ones and writes their information
+    chapters_appeared comes from the merge, not from the LLM.
     """
 
     if not book_id:
         return "No book provided."
-    character_list_text=character_summary(book_id)
+    book = Book.objects.get(id=book_id)
+    chapter_candidates = extract_character_candidates(book_id)
+    failed = [entry["chapter"] for entry in chapter_candidates if entry["error"]]
+    if failed:
+        print("Character extraction failed for chapters:", failed)
+    merged = merge_character_candidates(chapter_candidates)[:settings.CHARACTER_CANDIDATES_FOR_PICK]
+    if not merged:
+        return CharacterList(Characters=[])
+
+    candidates_text = "\n\n".join(
+        f"CANDIDATE {i}:\n"
+        f"    name: {c['name']}\n"
+        f"    aliases: {', '.join(c['aliases']) or ' '}\n"
+        f"    mentions: {c['mentions']} in {len(c['chapters'])} chapters\n"
+        f"    gender: {c['gender'] or ' '}\n"
+        f"    age: {c['age'] or ' '}\n"
+        f"    appearance notes: {c['appearance'] or ' '}\n"
+        f"    personality notes: {c['personality'] or ' '}\n"
+        f"    actions: {c['actions'] or ' '}"
+        for i, c in enumerate(merged, start=1)
+    )
+
     llm = init_chat_model("openai:gpt-4.1")
     extractor = llm.with_structured_output(CharacterList)
     
@@ -117,14 +238,19 @@ def set_characters(book_id):
             {
                 "role": "system",
                 "content": (
-                    "Character information for about 6 fictional book characters of a book has been identified and summarised by an LLM" 
-                "and is provided below.Return a CharacterList containing that information. Ignore the confidence score"
+                    f"Candidate characters of the book '{book.title}' have been extracted chapter by chapter and merged. "
+                    "They are listed below, ranked by how often they are mentioned in the book. "
+                    "Pick the about 6 most important characters to the story and return a CharacterList with their information, "
+                    "using the candidate`s name. Write the personality, appearance and bio from the notes; "
+                    "the appearance should let a reader visualise the character. "
+                    "If a candidate is the same character as another one, use only one of them. "
+                    "If you do not know the age, estimate it from the notes."
                 ),
             },
             {
                 "role": "user",
                 "content": (
-                    f" agent response summary of PREVIOUSLY IDENTIFIED CHARACTERS:\n{character_list_text}\n\n"
+                    f"CANDIDATE CHARACTERS:\n{candidates_text}\n\n"
                     
                 ),
             },
@@ -132,12 +258,24 @@ def set_characters(book_id):
 
  
     clist = extractor.invoke(messages)   
+
+    # aliases and chapters come from the merged candidates (chapters_appeared is then recomputed
+    # from the mention index by the mentions stage)
+    merged_by_key = {}
+    for c in merged:
+        for n in [c["name"], *c["aliases"]]:
+            merged_by_key.setdefault(normalize_name(n), c)
+    for character in clist.Characters:
+        c = merged_by_key.get(normalize_name(character.name))
+        if c is not None:
+            character.chapters_appeared = c["chapters"]
+            character.aliases = sorted((set(character.aliases) | set(c["aliases"]) | {c["name"]}) - {character.name})
   
     print("Extracted Characters:", [c.name for c in clist.Characters])
     return clist
-        
-
     
+
+
 class Relationship(BaseModel):
     source: str = Field(description="Character name (must match CharacterInfo.name)")
     target: str = Field(description="Character name (must match CharacterInfo.name)")
@@ -150,12 +288,25 @@ class RelationshipList(BaseModel):
     )
 
 def set_character_relationships(book_id):
+    """
+    Label the relationships between the main characters of a book (RelationshipList).
+
+    When the co-occurrence of the book has been computed (cooccurrence stage), the LLM only labels
+    the RELATIONSHIP_TOP_PAIRS pairs of characters mentioned together most often, and only gets the
+    characters of those pairs. Otherwise it looks for relationships between all characters.
+    """
     if not book_id:
         return "No book provided."
     book = Book.objects.get(id=book_id)
-    context_1= book.summary
+    # recap of the whole book (top of the recap tree) instead of every chapter summary
+    context_1= get_recap(book_id, Chapter.objects.filter(book=book).count())
 
+    top_pairs = (book.cooccurrence or {}).get("pairs", [])[:settings.RELATIONSHIP_TOP_PAIRS]
     characters = Character.objects.filter(book_id=book_id)
+    if top_pairs:
+        paired = {p["source"] for p in top_pairs} | {p["target"] for p in top_pairs}
+        characters = characters.filter(name__in=paired)
+
     list=[]
     for c in characters:
         details = (
@@ -169,12 +320,24 @@ def set_character_relationships(book_id):
         )
         list.append(details)
     context_2="\n\n".join(list)
+    context_3="\n".join(
+        f"{p['source']} - {p['target']}: mentioned together in {p['weight']} paragraphs, first in chapter {p['first_chapter']}"
+        for p in top_pairs
+    )
     llm = init_chat_model("openai:gpt-4.1-mini")
     extractor = llm.with_structured_output(RelationshipList)
     rlist = RelationshipList(relationships=[])
 
-
-   
+    if top_pairs:
+        pair_instructions = (
+            "Only label the character pairs listed in CONTEXT 3 (pairs of characters that appear together the most), "
+            "use one of its two names as source and the other one as target.\n"
+            "Skip a pair if the context does not show a clear relationship.\n"
+        )
+        pair_context = f"CONTEXT 3 (character pairs to label):\n{context_3}\n\n"
+    else:
+        pair_instructions = ""
+        pair_context = ""
     
     messages = [
   {
@@ -185,6 +348,7 @@ def set_character_relationships(book_id):
       " \n\n"
       "INSTRUCTIONS :\n"
       "source and target MUST be character names that appear in CONTEXT 2.\n"
+      + pair_instructions +
       "label must be a short relationship label suitable for showing on an edge in a network graph "
       "(e.g., 'friends', 'rivals', 'mentor', 'family', 'allies', 'owner', 'enemy').\n"    
       "Do not invent new characters.\n"
@@ -196,10 +360,11 @@ def set_character_relationships(book_id):
     "role": "user",
     "content": (
       f"BOOK TITLE: {book.title}\n\n"
-      "CONTEXT 1 (book summary, chapter-by-chapter):\n"
+      "CONTEXT 1 (book recap):\n"
       f"{context_1}\n\n"
       "CONTEXT 2 (major characters with attributes):\n"
       f"{context_2}\n\n"
+      f"{pair_context}"
       " RelationshipList JSON object:\n\n"
     ),
   },
@@ -207,4 +372,8 @@ def set_character_relationships(book_id):
         
     rlist = extractor.invoke(messages)  
 
+    if top_pairs:
+        allowed = {pair_key(p["source"], p["target"]) for p in top_pairs}
+        rlist.relationships = [r for r in rlist.relationships if pair_key(r.source, r.target) in allowed]
+
     return rlist
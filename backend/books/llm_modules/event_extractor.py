@@ -2,8 +2,12 @@
 from pydantic import BaseModel, Field
 from typing import Literal, List
 from ..models import *
-from bs4 import BeautifulSoup
+from ..chapter_text import chapter_paragraphs
 from openai import OpenAI
+from django.conf import settings
+from .fanout import fan_out
+from .usage import record_usage
+from .tokens import count_tokens
 
 
 
@@ -21,57 +25,245 @@ class EventList(BaseModel):
     )
 
 
-def extract_events(book_id):
+class ChapterEvents(BaseModel):
+    """Events of one chapter of a batch"""
+    chapter_key: int = Field(description="The CHAPTER KEY number given in the chapter header")
+    events: List[EventInfo] = Field(
+        description="A list of 1 to 4 events that together cover the whole chapter. The number of events should make sense. Each event should describe a self-contained part of the story. All paragraphs of chapter should be belong to exactly one event with no overlap. ",
+    )
+
+
+class ChapterEventsBatch(BaseModel):
+    """Events of every chapter of a batch of short chapters"""
+    chapters: List[ChapterEvents] = Field(description="One entry per chapter of the batch, in the same order")
+
+
+EVENT_MODEL = "gpt-4.1-nano"
+# separators and the "PARAGRAPH n:" prefix around every paragraph
+PARAGRAPH_OVERHEAD_TOKENS = 6
+# context window of EVENT_MODEL, and the part of it kept for the system prompt and the structured answer
+# (max output of the model is 32,768 tokens)
+EVENT_MODEL_CONTEXT_TOKENS = 1_047_576
+EVENT_RESERVED_TOKENS = 34_000
+
+SYSTEM_PROMPT = "You are an expert at analysing and extracting book information .You have been provided the current chapter from a book which consists of a sequence of paragraphs along with paragraph number. Your task is to analyse and logically process the chapter into a list of one or more events.Split the chapter into events in a way that feels like a natural breakdown of the story"
+
+BATCH_SYSTEM_PROMPT = "You are an expert at analysing and extracting book information .You have been provided several short consecutive chapters from a book, each starting with a CHAPTER KEY header and consisting of a sequence of paragraphs along with paragraph number (numbers restart at 1 in every chapter). Your task is to analyse and logically process each chapter separately into a list of one or more events.Split each chapter into events in a way that feels like a natural breakdown of the story. Return one entry per chapter with its CHAPTER KEY"
+
+WINDOW_SYSTEM_PROMPT = "You are an expert at analysing and extracting book information .You have been provided one part of a long chapter from a book which consists of a sequence of paragraphs along with paragraph number. Your task is to analyse and logically process this part of the chapter into a list of one or more events.Split it into events in a way that feels like a natural breakdown of the story. The events must cover every paragraph of this part"
+
+
+def numbered_paragraphs(paragraphs):
+    return [f"PARAGRAPH {tag}: {p_text.strip()}" for tag, p_text in enumerate(paragraphs, start=1)]
+
+
+def event_window_tokens():
+    """Max chapter text of one request: settings.EVENT_WINDOW_TOKENS, or what fits in the context of EVENT_MODEL."""
+    return settings.EVENT_WINDOW_TOKENS or EVENT_MODEL_CONTEXT_TOKENS - EVENT_RESERVED_TOKENS
+
+
+def plan_event_requests(chapters, batch_tokens, window_tokens):
+    """
+    Group chapters into event extraction requests.
+
+    chapters: [(chapter id, title, [paragraph texts])] in chapter order. Returns a list of requests:
+      - {"kind": "chapter", "chapter": chapter}: one chapter on its own
+      - {"kind": "batch", "chapters": [chapter, ...]}: consecutive chapters of batch_tokens tokens at most
+        in total, packed together
+      - {"kind": "window", "chapter": chapter, "first": n, "last": m, "part": i, "parts": k}:
+        paragraphs first..last of a chapter over window_tokens tokens (too large for the context of the
+        model), cut on paragraph boundaries
+    """
+    requests = []
+    batch = []
+    batch_size = 0
+
+    def flush():
+        nonlocal batch, batch_size
+        if len(batch) == 1:
+            requests.append({"kind": "chapter", "chapter": batch[0]})
+        elif batch:
+            requests.append({"kind": "batch", "chapters": batch})
+        batch = []
+        batch_size = 0
+
+    for chapter in chapters:
+        _, title, paragraphs = chapter
+        paragraph_tokens = [count_tokens(p, EVENT_MODEL) + PARAGRAPH_OVERHEAD_TOKENS for p in numbered_paragraphs(paragraphs)]
+        tokens = count_tokens(title, EVENT_MODEL) + sum(paragraph_tokens)
+
+        if tokens > window_tokens:
+            flush()
+            windows = []
+            first = 1
+            window_size = 0
+            for number, p_tokens in enumerate(paragraph_tokens, start=1):
+                if number > first and window_size + p_tokens > window_tokens:
+                    windows.append((first, number - 1))
+                    first = number
+                    window_size = 0
+                window_size += p_tokens
+            windows.append((first, len(paragraph_tokens)))
+            for part, (first, last) in enumerate(windows, start=1):
+                requests.append({"kind": "window", "chapter": chapter, "first": first, "last": last, "part": part, "parts": len(windows)})
+            continue
+
+        if tokens > batch_tokens:
+            # an ordinary chapter, too large to be packed with others
+            flush()
+            requests.append({"kind": "chapter", "chapter": chapter})
+            continue
+
+        if batch_size + tokens > batch_tokens:
+            flush()
+        batch.append(chapter)
+        batch_size += tokens
+    flush()
+    return requests
+
+
+def batch_event_lists(batch, chapters):
+    """{chapter id: EventList} of a batch answer, chapters being the chapters of the batch request (CHAPTER KEY n is chapters[n - 1])."""
+    by_key = {entry.chapter_key: entry.events for entry in batch.chapters}
+    return {
+        chapter_id: EventList(events=by_key[key])
+        for key, (chapter_id, _, _) in enumerate(chapters, start=1)
+        if key in by_key
+    }
+
+
+def window_event_list(events, first, last):
+    """
+    EventList of a window answer with chapter paragraph numbers: the window holds paragraphs first..last of
+    the chapter, numbered from 1 for the model.
+    """
+    offset = first - 1
+    window_events = []
+    for ev in sorted(events.events, key=lambda ev: ev.last_paragraph):
+        window_events.append(ev.model_copy(update={"last_paragraph": min(max(ev.last_paragraph, 1) + offset, last)}))
+    # the window is covered up to its last paragraph, the next window starts right after it
+    if window_events:
+        window_events[-1].last_paragraph = last
+    return EventList(events=window_events)
+
+
+def extract_events(book_id, max_workers=None, batch_tokens=None, window_tokens=None, chapter_ids=None, stats=None):
     """
     Extract a structured list of events for each chapter in a book by identifying the last paragraph in a group of paragraphs that constitute an event
 
     Pipeline:
       1) Fetch all chapters for the book (ordered by chapter number)
-      2) Format chapter HTML into a sequence numbered paragraphs:
+      2) Format chapter paragraphs (from the chapter paragraph index) into a sequence numbered paragraphs:
            PARAGRAPH 1: <PARAGRAPH 1 CONTENT>
            PARAGRAPH 2: <PARAGRAPH 2 CONTENT>
               ...
-      3) pass the transformed chapter text to LLM API where LLM defines markers that splits groups of paragraphs into events 
-      4) Parse  the result into EventList and return:
-           {"chapter_id": <Chapter.id>, "event_list": <EventList>}
+      3) Group chapters into requests (plan_event_requests):
+           - small consecutive chapters (front matter, short chapters) are packed into one request of at most
+             batch_tokens tokens (settings.EVENT_BATCH_TOKENS) returning one EventList per chapter
+           - an ordinary chapter is one request
+           - a chapter over window_tokens tokens (event_window_tokens(), too large for the context of the model)
+             is split into windows of whole paragraphs, each window is one request and its paragraph numbers
+             are mapped back to chapter paragraph numbers
+      4) pass the transformed chapter text to LLM API where LLM defines markers that splits groups of paragraphs into events 
+      5) Parse  the result into EventList and return, in chapter order:
+           {"chapter_id": <Chapter.id>, "event_list": <EventList>, "error": ""}
 
+    Requests are independent API calls, so they are made concurrently with at most
+    max_workers requests in flight (defaults to settings.EVENT_EXTRACTION_MAX_WORKERS, 1 = sequential).
+    A chapter whose call fails (or one of its windows, or that is missing from its batch answer) gets
+    event_list None and the error message, the other chapters are kept.
+    chapter_ids: only extract the events of these chapters (e.g the chapters that failed in the previous run).
+    stats: optional dict that receives the number of requests, of batched and split chapters and the
+    estimated prompt tokens.
 
     """
     if not book_id:
         return "No book provided."
+    if max_workers is None:
+        max_workers = settings.EVENT_EXTRACTION_MAX_WORKERS
+    if batch_tokens is None:
+        batch_tokens = settings.EVENT_BATCH_TOKENS
+    if window_tokens is None:
+        window_tokens = event_window_tokens()
+    if stats is None:
+        stats = {}
+
     chapters = Chapter.objects.filter(book=book_id).order_by('number')
+    if chapter_ids is not None:
+        chapters = chapters.filter(id__in=chapter_ids)
+    # numbered paragraphs come from the paragraph index built at ingestion
+    chapter_inputs = [(chapter.id, chapter.title, chapter_paragraphs(chapter)) for chapter in chapters]
+    requests = plan_event_requests(chapter_inputs, batch_tokens, window_tokens)
+
     client = OpenAI()
-    all_events=[]
-    for chapter in chapters:
-        soup = BeautifulSoup(chapter.content, 'html.parser')
-        tag = 0
-        for p_tag in soup.find_all('p'):
-            tag += 1
-            p_text = p_tag.get_text(strip=True)
-            raw = f"\n\nPARAGRAPH {tag}: {p_text}"
-            p_tag.replace_with(raw)
-
-        chapter_text = str(soup)
+
+    def call(system_prompt, text, text_format):
         response = client.responses.parse(
-    model="gpt-4.1-nano",
+    model=EVENT_MODEL,
     input=[
-        {"role": "system", "content": "You are an expert at analysing and extracting book information .You have been provided the current chapter from a book which consists of a sequence of paragraphs along with paragraph number. Your task is to analyse and logically process the chapter into a list of one or more events.Split the chapter into events in a way that feels like a natural breakdown of the story"},
+        {"role": "system", "content": system_prompt},
         {
             "role": "user",
-            "content": f"Here is the chapter:\n\n {chapter_text}",
-        },],text_format=EventList,)
-        events: EventList = response.output_parsed
-        all_events.append( {"chapter_id":chapter.id,"event_list":events})
-    return all_events
-        
-        
-    
-           
+            "content": text,
+        },],text_format=text_format,)
+        record_usage(response)
+        return response.output_parsed, count_tokens(system_prompt + text, EVENT_MODEL)
 
+    def run_request(request):
+        if request["kind"] == "chapter":
+            chapter_id, title, paragraphs = request["chapter"]
+            chapter_text = f"{title}\n\n" + "\n\n".join(numbered_paragraphs(paragraphs))
+            events, tokens = call(SYSTEM_PROMPT, f"Here is the chapter:\n\n {chapter_text}", EventList)
+            return {chapter_id: events}, tokens
 
+        if request["kind"] == "batch":
+            parts = [
+                f"CHAPTER KEY {key}: {title}\n\n" + "\n\n".join(numbered_paragraphs(paragraphs))
+                for key, (_, title, paragraphs) in enumerate(request["chapters"], start=1)
+            ]
+            batch, tokens = call(BATCH_SYSTEM_PROMPT, "Here are the chapters:\n\n " + "\n\n".join(parts), ChapterEventsBatch)
+            return batch_event_lists(batch, request["chapters"]), tokens
 
+        # window: paragraphs first..last of the chapter, numbered from 1 for the model
+        chapter_id, title, paragraphs = request["chapter"]
+        first, last = request["first"], request["last"]
+        window_text = (
+            f"{title} (part {request['part']} of {request['parts']})\n\n"
+            + "\n\n".join(numbered_paragraphs(paragraphs[first - 1:last]))
+        )
+        events, tokens = call(WINDOW_SYSTEM_PROMPT, f"Here is the part of the chapter:\n\n {window_text}", EventList)
+        return {chapter_id: window_event_list(events, first, last)}, tokens
 
-    
-    
+    results = fan_out(run_request, requests, max_workers)
+
+    # merge request results per chapter. Windows of a chapter come in order
+    chapter_events = {}
+    chapter_errors = {}
+    for request, (result, error) in zip(requests, results):
+        members = request["chapters"] if request["kind"] == "batch" else [request["chapter"]]
+        for chapter_id, _, _ in members:
+            if error is not None:
+                chapter_errors.setdefault(chapter_id, repr(error))
+            elif chapter_id not in result[0]:
+                chapter_errors.setdefault(chapter_id, "chapter missing from the batch answer")
+            else:
+                chapter_events.setdefault(chapter_id, []).extend(result[0][chapter_id].events)
 
+    all_events=[]
+    for chapter_id, _, _ in chapter_inputs:
+        error = chapter_errors.get(chapter_id, "")
+        events = None if error else EventList(events=chapter_events.get(chapter_id, []))
+        all_events.append({"chapter_id": chapter_id, "event_list": events, "error": error})
 
+    stats.update({
+        "requests": len(requests),
+        "batched_chapters": sum(len(r["chapters"]) for r in requests if r["kind"] == "batch"),
+        "split_chapters": len({r["chapter"][0] for r in requests if r["kind"] == "window"}),
+        "prompt_tokens": sum(result[1] for result, _ in results if result is not None),
+    })
+    print(f"[EVENTS] {len(chapter_inputs)} chapters of book {book_id} in {len(requests)} requests")
+
+    failed = sum(1 for e in all_events if e["error"])
+    if failed:
+        print(f"[EVENTS] Event extraction failed for {failed}/{len(all_events)} chapters of book {book_id}")
+    return all_events
@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import traceback
+from django.db import connections
+
+
+def fan_out(func, items, max_workers):
+    """
+    Run func(item) for every item on a thread pool with at most max_workers calls in flight.
+
+    Used by LLM modules where every item (e.g a chapter) is an independent API call, so the
+    work is network wait and scales with the number of requests in flight.
+
+    - results are returned in the same order as items, whatever order calls finish in
+    - an exception in one call does not stop the others: each entry is a (result, error) tuple,
+      with result None and error the exception if the call failed
+    - max_workers <= 1 runs the calls one by one in the current thread
+    - each call runs in a copy of the caller`s context, so token usage tracking (usage.py) still applies
+    """
+    items = list(items)
+    in_pool = max_workers > 1 and len(items) > 1
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            print(f"[FAN OUT] {getattr(func, '__name__', func)} failed:", repr(e))
+            traceback.print_exc()
+            return None, e
+        finally:
+            # Django opens one DB connection per thread, close this thread`s connections
+            if in_pool:
+                connections.close_all()
+
+    if not in_pool:
+        return [call(item) for item in items]
+
+    # contexts are copied in the calling thread, pool threads start with an empty context
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(lambda context, item: context.run(call, item), contexts, items))
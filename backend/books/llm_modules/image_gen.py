@@ -5,10 +5,16 @@ import base64
 from django.conf import settings
 import os
 from ..models import *
-from ..utils import get_chapter_summary
 from django.utils.html import strip_tags
+import threading
 import traceback
 import re
+from .usage import record_usage
+from .singleflight import single_flight
+from ..image_derivatives import build_derivatives
+from .scene_prompts import describe_scene
+from ..scene_cache import (event_scene_key, record_scene_image, scene_cache_key, scene_file_path, scenes_folder,
+                           set_event_scene_key, touch_scene_image)
 
 
 def generate_character_image(character, use_default=False):
@@ -42,8 +48,10 @@ def generate_character_image(character, use_default=False):
                 character.image.save(
                     f"default_{character.name.replace(' ', '_')}.jpg",
                     ContentFile(f.read()),
-                    save=True
+                    save=False
                 )
+            character.save(update_fields=["image"])
+            build_derivatives(character.image.path)
 
             print(f"Default image used for {character.name}")
             return True
@@ -75,6 +83,7 @@ def generate_character_image(character, use_default=False):
             n=1,
         )
 
+        record_usage(result)
         image_base64 = result.data[0].b64_json
         if not image_base64:
             raise ValueError("No image data returned from image model")
@@ -84,7 +93,12 @@ def generate_character_image(character, use_default=False):
         filename = f"{name.replace(' ', '_')}.png"
 
         #Save into ImageField (folder is media/uploads/characters/)
-        character.image.save(filename, ContentFile(image_bytes), save=True)
+        # only the image field is written: the instance was loaded before the mentions stage, which runs at the
+        # same time and updates chapters_appeared
+        character.image.save(filename, ContentFile(image_bytes), save=False)
+        character.save(update_fields=["image"])
+        # smaller WebP/AVIF copies for the character grid
+        build_derivatives(character.image.path)
         print(f"AI image generated for {character.name}")
         return True
 
@@ -94,62 +108,144 @@ def generate_character_image(character, use_default=False):
 
 
 
-def generate_or_get_scene_image(book_id,chapter_id,event_number):
+def scene_image_path(book_id, chapter_id, event_number):
     """
-    Generate (or load cached) a scene image for a specific event in a chapter.
+    Location of the scene image of an event: (path on disk, MEDIA_URL path), (None, None) if the event has none.
+    Scene images live in the scene image cache, under MEDIA/uploads/scenes/<key>.png (see scene_cache.py)
+    """
+    key = event_scene_key(book_id, chapter_id, event_number)
+    if not key:
+        return None, None
+    return scene_file_path(key)
 
-    - scene images are stored on disk under MEDIA/uploads/scenes/
-    - filename convention: scene_<book_id>_<chapter_id>_<event_number>.png
-    - if the file already exists, return the MEDIA_URL path immediately
 
-    - OTHERWISE, call scene description API to generate a text description of scene/event.Text description is then passed as input prompt to Image generation API.
+# Scene images come in two tiers stored under the same path: a fast low quality "preview" served first,
+# then the "full" render that replaces it. While the file on disk is a preview, an empty <path>.preview
+# marker file sits next to it.
+SCENE_IMAGE_QUALITY = {"preview": "low", "full": "medium"}
+SCENE_IMAGE_MODEL = "gpt-image-1"
+# 1024x1024 is the smallest size of gpt-image-1, the preview tier saves time with a lower quality
+SCENE_IMAGE_SIZE = "1024x1024"
 
-    """
 
+def _file_tier(filepath):
+    if not filepath or not os.path.exists(filepath):
+        return None
+    return "preview" if os.path.exists(f"{filepath}.preview") else "full"
 
-    scenes_folder = os.path.join(settings.MEDIA_ROOT, "uploads", "scenes")
-    os.makedirs(scenes_folder, exist_ok=True)
 
-    filename = f"scene_{book_id}_{chapter_id}_{event_number}.png"
-    filepath = os.path.join(scenes_folder, filename)
+def scene_image_tier(book_id, chapter_id, event_number):
+    """Tier of the scene image on disk: "full", "preview", or None if there is no image yet."""
+    filepath, _ = scene_image_path(book_id, chapter_id, event_number)
+    return _file_tier(filepath)
 
-    
-    if os.path.exists(filepath):
-        return f"{settings.MEDIA_URL}uploads/scenes/{filename}"
-    else:
 
-        try:
-            image_prompt=""
+def generate_or_get_scene_image(book_id,chapter_id,event_number):
+    """
+    Generate (or load cached) a scene image for a specific event in a chapter.
+    Same as generate_scene_image, but errors are logged and the default image is returned instead.
+    """
+    try:
+        return generate_scene_image(book_id, chapter_id, event_number)
 
-            #uses book,chapter and event objects to generate text description of scene
-            image_prompt=get_scene_description(book_id,chapter_id,event_number)
+    except Exception as e:
+        print("[SCENE IMAGE] Error while generating scene image:", repr(e))
+        traceback.print_exc()  
+        #default image fallback
+        return f"{settings.MEDIA_URL}uploads/characters/default_character.jpg"
 
-            client = OpenAI()
-            result = client.images.generate(
-            model="gpt-image-1",
-            n=1,
-            quality="medium",
-            size="1024x1024",
-            prompt=image_prompt) 
- 
-            #save image to disk (folder is media/uploads/scenes/)
-            image_base64 = result.data[0].b64_json
-            image_bytes = base64.b64decode(image_base64)
-            save_dir = os.path.join(settings.MEDIA_ROOT, "uploads", "scenes")
-            os.makedirs(save_dir, exist_ok=True)
 
-            filename = f"scene_{book_id}_{chapter_id}_{event_number}.png"
-            save_path = os.path.join(save_dir, filename)
+def generate_scene_image(book_id, chapter_id, event_number, tier="full"):
+    """
+    Generate (or load cached) a scene image for a specific event in a chapter, returns its MEDIA_URL path.
 
-            with open(save_path, "wb") as f:
-                f.write(image_bytes)
-            return f"{settings.MEDIA_URL}uploads/scenes/{filename}"
+    - scene images are stored in the scene image cache under MEDIA/uploads/scenes/, keyed by a hash of the
+      image model and prompt (see scene_cache.py)
+    - if the event has an image of the requested tier (or better), return the MEDIA_URL path immediately.
+      Asking for the full tier when only the preview exists renders the full image over it
 
-        except Exception as e:
-            print("[SCENE IMAGE] Error while generating scene image:", repr(e))
-            traceback.print_exc()  
-            #default image fallback
-            return f"{settings.MEDIA_URL}uploads/characters/default_character.jpg"
+    - OTHERWISE, call scene description API to generate a text description of scene/event.Text description is then passed as input prompt to Image generation API.
+      If an image already exists for that prompt (e.g the same event of an earlier ingestion) it is reused.
+    - concurrent calls for the same event (other readers, retries, prefetch) wait for the one generation
+      in flight instead of starting their own (see singleflight.py)
+    - errors of the API calls are raised
+    """
+
+    os.makedirs(scenes_folder(), exist_ok=True)
+
+    def done():
+        current = scene_image_tier(book_id, chapter_id, event_number)
+        return current == "full" or (current is not None and tier == "preview")
+
+    if not done():
+        # the lease is per event: the prompt, so the cache key, is only known once the leader computed it
+        event_target = os.path.join(scenes_folder(), f"event_{book_id}_{chapter_id}_{event_number}")
+        if not single_flight(event_target, lambda: _generate_scene_file(book_id, chapter_id, event_number, tier), done):
+            raise RuntimeError(f"Scene image of event {event_number} of chapter {chapter_id} was not written")
+
+    return scene_image_path(book_id, chapter_id, event_number)[1]
+
+
+def _scene_file_prompt(book_id, chapter_id, event_number):
+    # the full render of a preview uses the prompt the preview was made from: the image stays under the
+    # key of its prompt, and the scene is described once
+    event = (
+        Event.objects.filter(chapter__book_id=book_id, chapter__number=chapter_id, number=event_number)
+        .values('scene_key', 'scene_prompt')
+        .first()
+    )
+    if event and event['scene_key'] and event['scene_prompt']:
+        if _file_tier(scene_file_path(event['scene_key'])[0]) == "preview" and \
+                scene_cache_key(event['scene_prompt'], SCENE_IMAGE_MODEL, SCENE_IMAGE_SIZE) == event['scene_key']:
+            return event['scene_prompt']
+    #uses book,chapter and event objects to generate text description of scene
+    return get_scene_description(book_id, chapter_id, event_number)
+
+
+def _generate_scene_file(book_id, chapter_id, event_number, tier):
+    image_prompt = _scene_file_prompt(book_id, chapter_id, event_number)
+
+    # same prompt, same key: a preview is replaced, or an evicted image generated again, under the same name
+    key = scene_cache_key(image_prompt, SCENE_IMAGE_MODEL, SCENE_IMAGE_SIZE)
+    current = _file_tier(scene_file_path(key)[0])
+    if current == "full" or (current is not None and tier == "preview"):
+        # an image with the same prompt is already in the cache
+        set_event_scene_key(book_id, chapter_id, event_number, key)
+        touch_scene_image(key)
+        return
+    filepath, _ = scene_file_path(key)
+
+    client = OpenAI()
+    result = client.images.generate(
+    model=SCENE_IMAGE_MODEL,
+    n=1,
+    quality=SCENE_IMAGE_QUALITY[tier],
+    size=SCENE_IMAGE_SIZE,
+    prompt=image_prompt) 
+
+    record_usage(result)
+    #save image to disk (folder is media/uploads/scenes/)
+    image_base64 = result.data[0].b64_json
+    image_bytes = base64.b64decode(image_base64)
+
+    # written under a temporary name first: a reader never sees a partly written image as cached
+    tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(image_bytes)
+    marker = f"{filepath}.preview"
+    if tier == "preview":
+        # marker first, the preview is never seen as the full render
+        open(marker, "wb").close()
+        os.replace(tmp_path, filepath)
+    else:
+        os.replace(tmp_path, filepath)
+        if os.path.exists(marker):
+            os.remove(marker)
+        # smaller WebP/AVIF copies, not worth it for a preview that is about to be replaced
+        build_derivatives(filepath)
+
+    set_event_scene_key(book_id, chapter_id, event_number, key)
+    record_scene_image(key, SCENE_IMAGE_MODEL, tier)
 
 
 
@@ -157,86 +253,22 @@ def generate_or_get_scene_image(book_id,chapter_id,event_number):
 
 def get_scene_description(book_id,chapter_id,event_number):
     """
-    Create a detailed text prompt for scene image generation for a given event using the following information:
+    Text prompt for scene image generation of a given event.
+
+    Prompts are precomputed at ingestion for all the events of a book and stored on the Event
+    (see scene_prompts.py): the stored prompt is returned while it is up to date with the book
+    (scene_prompt_version == Book.scene_context_version). Otherwise it is written now from:
       - Book inferred metadata: main_genre, time_period, primary_setting
-      - Event label + Event summary
-      - Truncated book summary upto current chapter (Context 1)
+      - Event label + Event summary + full event text
+      - Recap of the book upto current chapter (Context 1)
       - Character list (Context 2) to include names/details when relevant
-      - extract full event text based on markers 
-
-
-    Returns:
-      - response.output_text (the image prompt), as plain text
+    and stored for the next time.
     """
-    #book info
-    book = Book.objects.get(id=book_id)
-    genre=book.inferred_metadata['main_genre']
-    time_period=book.inferred_metadata['time_period']
-    setting=book.inferred_metadata['primary_setting']
-
-    #chapter info
-    chapter = Chapter.objects.get(book_id=book_id, number=chapter_id)
-    full_chapter= strip_tags(chapter.content)
-    # extracts the full text of event in chapter using previously set event markers to get substring
-    if event_number==1:
-        start_idx = full_chapter.find('PLACEHOLDER FOR IMAGE 1')
-        event_details = full_chapter[:start_idx]
-    else:
-        start=f'PLACEHOLDER FOR IMAGE {event_number-1}'
-        end=f'PLACEHOLDER FOR IMAGE {event_number}'
-        start_idx = full_chapter.find(start)
-        end_idx=full_chapter.find(end)
-        event_details =full_chapter[start_idx + len(start):end_idx]
-
-    #full book summary upto chapter
-    context_1= get_chapter_summary(book_id,chapter_id+1)
-
-    #list of character info, including description of appearance
-    characters = Character.objects.filter(book_id=book_id)
-    list=[]
-    for c in characters:
-        details = (
-            f"Name: {c.name}\n"
-            f"Role: {c.role}\n"
-            f"Age: {c.age if c.age is not None else 'unknown'}\n"
-            f"Gender: {c.gender or 'unspecified'}\n\n"
-            f"Personality:\n{c.personality or 'N/A'}\n\n"
-            f"Appearance:\n{c.appearance or 'N/A'}\n\n"
-            f"Bio:\n{c.bio or 'N/A'}\n"
-        )
-        list.append(details)
-    context_2="\n\n".join(list)
-
-    event =Event.objects.get(chapter=chapter, number=event_number) 
-
-
-    #everything that was extracted passed to this prompt
-    client=OpenAI()
-    response = client.responses.parse(
-    model="gpt-4.1-nano",
-    input=[
-        {"role": "system",
-          f"content": "You are an expert prompt engineer.Your role is to write a text prompt which will be used as input to an image generation model.The text prompt describes a scene from a chapter of a book called {book.title}. You have been given the part of the chapter where event occurs along with a short description of event. You should generate a prompt for an image generation model that describes  a scene using this event information. You should be descriptive as possible with characters,background and actions since the image generation will only have your prompt and no information on the book.You should only use information currently provided  for generation.You have also been provided extra context information that are only there to give you more context about the event information. CONTEXT 1 is a chapter by chapter summary of book, with the last paragraph being the chapter where the event occurs.CONTEXT 2 is a list of 10 major characters in the book. If a character from list is present in the event, include their name. You should only output the image generation prompt and nothing else. The art style should be: 'detailed fantasy storybook illustration, warm lighting, expressive' "},
-        {
-            "role": "user",
-            "content": f"Here are the event details :\n\n"
-            "MAIN EVENT INFORMATION FOR GENERATION:\n"
-            f"Event label: {event.label}"
-            f"Event synopsis: {event.summary}"
-            f"Event extract from book:\n\n{event_details}\n\n"
-            f"Book setting:\n\nThe book events occur primarily in the {time_period} time period. The primary setting of the book is {setting} and the main genres of the book are {genre}\n\n"
-            "EXTRA CONTEXT FOR MAIN EVENT INFORMATION:\n"
-            f"CONTEXT 1:\n{context_1}\n\n"
-            f"CONTEXT 2:\n{context_2}\n\n"
-            "PROMPT FOR IMAGE GENERATION:\n\n",
-
-        },]
-        )
-    #print("''''''''''''''''''''''''")
-    #print(response.output_text)
-    
-    #text description of event
-    return response.output_text
-
-
-
+    event = Event.objects.select_related('chapter__book').get(
+        chapter__book_id=book_id, chapter__number=chapter_id, number=event_number
+    )
+    chapter = event.chapter
+    book = chapter.book
+    if event.scene_prompt and event.scene_prompt_version == book.scene_context_version:
+        return event.scene_prompt
+    return describe_scene(book, chapter, event)
@@ -7,6 +7,7 @@ from django.utils.html import strip_tags
 
 # OpenAI  client api
 from openai import OpenAI
+from .usage import record_usage
 
 
 
@@ -52,6 +53,7 @@ def get_book_metadata(book_id):
             "content": f"Here is the book summary:\n\n {book.summary}",
         },],text_format=BookMetaData,)
     
+    record_usage(response)
     metadata: BookMetaData = response.output_parsed
     
     return metadata
\ No newline at end of file
@@ -0,0 +1,115 @@
+# Recap tree of a book, built from the chapter summaries with the openAI langchain API
+from langchain.chat_models import init_chat_model
+from django.conf import settings
+from ..models import *
+from .fanout import fan_out
+
+
+# Level 0 of the tree holds the chapter summaries (in chapter order). Every B consecutive nodes of a level
+# are condensed by the LLM into one node of the level above (arc summaries), until one node covers the book.
+#
+#   level 2               [ch 2 ............................. ch 17]
+#   level 1    [ch 2 - ch 5]  [ch 6 - ch 9]  [ch 10 - ch 13]  [ch 14 - ch 17]
+#   level 0    ch2 ch3 ch4 ch5 ch6 ...
+#
+# The recap at chapter N covers the summarized chapters up to N with the largest complete nodes:
+# at most B - 1 nodes per level, so O(log N) nodes of bounded size, whatever the length of the book.
+
+
+def build_recap_tree(book_id, branching=None, max_words=None):
+    """
+    Build the recap tree of a book from its chapter summaries (ChapterSummary rows).
+
+    Returns the list of nodes, level by level:
+      [{"level", "index", "start_chapter", "end_chapter", "summary"}]
+    Condensing the nodes of a level is one LLM call per node, run in parallel.
+    """
+    branching = branching or settings.RECAP_BRANCHING
+    max_words = max_words or settings.RECAP_NODE_WORDS
+
+    book = Book.objects.get(id=book_id)
+    summaries = ChapterSummary.objects.filter(book=book).order_by('chapter_number')
+    level = [
+        {"level": 0, "index": i, "start_chapter": s.chapter_number, "end_chapter": s.chapter_number, "summary": s.summary}
+        for i, s in enumerate(summaries)
+    ]
+    nodes = list(level)
+    llm = init_chat_model("openai:gpt-4.1-mini")
+
+    def condense(group):
+        # a trailing group with a single node is moved up as is
+        if len(group) == 1:
+            return group[0]["summary"]
+        return _condense(llm, book.title, group, max_words)
+
+    while len(level) > 1:
+        groups = [level[i:i + branching] for i in range(0, len(level), branching)]
+        results = fan_out(condense, groups, settings.RECAP_MAX_WORKERS)
+        failed = [error for _, error in results if error is not None]
+        if failed:
+            raise failed[0]
+
+        level = [
+            {
+                "level": group[0]["level"] + 1,
+                "index": i,
+                "start_chapter": group[0]["start_chapter"],
+                "end_chapter": group[-1]["end_chapter"],
+                "summary": summary,
+            }
+            for i, (group, (summary, _)) in enumerate(zip(groups, results))
+        ]
+        nodes.extend(level)
+
+    return nodes
+
+
+def _condense(llm, title, group, max_words):
+    parts = "\n\n".join(f"{_node_label(node)}:\n{node['summary']}" for node in group)
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                f"You are writing a recap of the book '{title}'. "
+                "You will receive the summaries of consecutive parts of the story, in order. "
+                f"Condense them into a single recap of at most {max_words} words that reads as one part of the story. "
+                "Keep the events that matter for the rest of the book, character developments, "
+                "relationships and unresolved plot threads. Drop minor details."
+            ),
+        },
+        {"role": "user", "content": parts},
+    ]
+    return llm.invoke(messages).content
+
+
+def _node_label(node):
+    if node["start_chapter"] == node["end_chapter"]:
+        return f"Chapter {node['start_chapter']}"
+    return f"Chapters {node['start_chapter']}-{node['end_chapter']}"
+
+
+def recap_node_keys(covered, total, branching):
+    """
+    (level, index) of the recap nodes covering the first `covered` summarized chapters of a book
+    with `total` summarized chapters, in story order.
+    """
+    if covered <= 0 or total <= 0:
+        return []
+
+    # height of the tree: number of levels above level 0
+    height = 0
+    size = 1
+    while size < total:
+        size *= branching
+        height += 1
+    if covered >= total:
+        return [(height, 0)]
+
+    keys = []
+    cursor = 0
+    for level in range(height, -1, -1):
+        size = branching ** level
+        while cursor + size <= covered:
+            keys.append((level, cursor // size))
+            cursor += size
+    return keys
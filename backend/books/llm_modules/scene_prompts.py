@@ -0,0 +1,227 @@
+# Scene image prompts of the events of a book, written by an LLM with the openAI API
+import hashlib
+import json
+from pydantic import BaseModel, Field
+from typing import List
+from langchain.chat_models import init_chat_model
+from openai import OpenAI
+from django.conf import settings
+from ..models import *
+from ..utils import get_recap
+from .fanout import fan_out
+from .usage import record_usage
+
+
+# The prompt of a scene image is written from the event text and from book wide context (metadata, characters,
+# recap up to the chapter). Prompts are written ahead of time at ingestion (scene_prompts stage) and stored on
+# the Event rows, so generating a scene image is a single image API call.
+#
+# Book.scene_context_version is a hash of the book wide context. It is refreshed by the stages that change it
+# (summary, recap, metadata, characters), and an event prompt is only used while its scene_prompt_version
+# matches: prompts written from an older context are written again (on demand, or by the next scene_prompts run).
+
+SCENE_PROMPT_MODEL = "gpt-4.1-nano"
+
+SCENE_PROMPT_SYSTEM = (
+    "You are an expert prompt engineer.Your role is to write a text prompt which will be used as input to an image generation model."
+    "The text prompt describes a scene from a chapter of a book called {title}. "
+    "You have been given the part of the chapter where event occurs along with a short description of event. "
+    "You should generate a prompt for an image generation model that describes  a scene using this event information. "
+    "You should be descriptive as possible with characters,background and actions since the image generation will only have your prompt and no information on the book."
+    "You should only use information currently provided  for generation."
+    "You have also been provided extra context information that are only there to give you more context about the event information. "
+    "CONTEXT 1 is a recap of the book up to the chapter where the event occurs, with the last part being that chapter."
+    "CONTEXT 2 is a list of 10 major characters in the book. If a character from list is present in the event, include their name. "
+    "{output}"
+    "The art style should be: 'detailed fantasy storybook illustration, warm lighting, expressive' "
+)
+SINGLE_OUTPUT = "You should only output the image generation prompt and nothing else. "
+BATCH_OUTPUT = (
+    "You will receive several events of the same chapter, each with its EVENT NUMBER. "
+    "Write one image generation prompt per event, each prompt must stand on its own. "
+)
+
+
+class ScenePrompt(BaseModel):
+    event_number: int = Field(description="The EVENT NUMBER given in the event header")
+    prompt: str = Field(description="The image generation prompt of the event")
+
+
+class ScenePrompts(BaseModel):
+    prompts: List[ScenePrompt] = Field(description="One image generation prompt per event, in the order of the events")
+
+
+def scene_context_version(book):
+    """Hash of the book data scene prompts depend on: metadata, characters, chapter summaries and recap tree."""
+    metadata = book.inferred_metadata or {}
+    data = {
+        "model": SCENE_PROMPT_MODEL,
+        "title": book.title,
+        "setting": [metadata.get("main_genre"), metadata.get("time_period"), metadata.get("primary_setting")],
+        "characters": list(
+            Character.objects.filter(book=book).order_by('id')
+            .values_list('name', 'role', 'age', 'gender', 'personality', 'appearance', 'bio')
+        ),
+        "summaries": list(
+            ChapterSummary.objects.filter(book=book).order_by('chapter_number')
+            .values_list('chapter_number', 'summary', 'story_so_far')
+        ),
+        "recap": list(RecapNode.objects.filter(book=book).order_by('level', 'index').values_list('level', 'index', 'summary')),
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def refresh_scene_context_version(book):
+    """Recompute and save Book.scene_context_version, called after the data it covers changed."""
+    book.scene_context_version = scene_context_version(book)
+    book.save(update_fields=["scene_context_version"])
+    return book.scene_context_version
+
+
+def character_context(book):
+    """CONTEXT 2 of scene prompts: list of character info, including description of appearance."""
+    details = []
+    for c in Character.objects.filter(book=book):
+        details.append(
+            f"Name: {c.name}\n"
+            f"Role: {c.role}\n"
+            f"Age: {c.age if c.age is not None else 'unknown'}\n"
+            f"Gender: {c.gender or 'unspecified'}\n\n"
+            f"Personality:\n{c.personality or 'N/A'}\n\n"
+            f"Appearance:\n{c.appearance or 'N/A'}\n\n"
+            f"Bio:\n{c.bio or 'N/A'}\n"
+        )
+    return "\n\n".join(details)
+
+
+def book_setting(book):
+    metadata = book.inferred_metadata or {}
+    return (
+        f"Book setting:\n\nThe book events occur primarily in the {metadata.get('time_period')} time period. "
+        f"The primary setting of the book is {metadata.get('primary_setting')} and the main genres of the book are {metadata.get('main_genre')}\n\n"
+    )
+
+
+def event_details(chapter, event):
+    # full text of event in chapter: paragraphs after the previous event up to the last paragraph of this one,
+    # offsets stored with the event
+    return (
+        f"Event label: {event.label}"
+        f"Event synopsis: {event.summary}"
+        f"Event extract from book:\n\n{chapter.text[event.text_start:event.text_end]}\n\n"
+    )
+
+
+def extra_context(context_1, context_2):
+    return (
+        "EXTRA CONTEXT FOR MAIN EVENT INFORMATION:\n"
+        f"CONTEXT 1:\n{context_1}\n\n"
+        f"CONTEXT 2:\n{context_2}\n\n"
+    )
+
+
+def describe_scene(book, chapter, event):
+    """
+    Write the image prompt of one event (one LLM call) and store it on the event with the current
+    scene context version. Used when the event has no up to date precomputed prompt.
+    """
+    context_1 = get_recap(book.id, chapter.number + 1)
+    client = OpenAI()
+    response = client.responses.parse(
+        model=SCENE_PROMPT_MODEL,
+        input=[
+            {"role": "system", "content": SCENE_PROMPT_SYSTEM.format(title=book.title, output=SINGLE_OUTPUT)},
+            {
+                "role": "user",
+                "content": "Here are the event details :\n\n"
+                "MAIN EVENT INFORMATION FOR GENERATION:\n"
+                + event_details(chapter, event)
+                + book_setting(book)
+                + extra_context(context_1, character_context(book))
+                + "PROMPT FOR IMAGE GENERATION:\n\n",
+            },
+        ],
+    )
+    record_usage(response)
+    event.scene_prompt = response.output_text
+    event.scene_prompt_version = book.scene_context_version
+    event.save(update_fields=["scene_prompt", "scene_prompt_version"])
+    return event.scene_prompt
+
+
+def _chapter_prompts(llm, book, chapter, events, setting, context_2):
+    # one call for all the events of a chapter: the book context is sent once per chapter
+    context_1 = get_recap(book.id, chapter.number + 1)
+    parts = [
+        f"EVENT NUMBER {event.number}\nMAIN EVENT INFORMATION FOR GENERATION:\n{event_details(chapter, event)}"
+        for event in events
+    ]
+    messages = [
+        {"role": "system", "content": SCENE_PROMPT_SYSTEM.format(title=book.title, output=BATCH_OUTPUT)},
+        {
+            "role": "user",
+            "content": "Here are the events :\n\n" + "\n\n".join(parts) + setting + extra_context(context_1, context_2),
+        },
+    ]
+    result = llm.invoke(messages)
+    return {p.event_number: p.prompt for p in result.prompts}
+
+
+def generate_scene_prompts(book_id, max_workers=None, stats=None):
+    """
+    Write the image prompts of every event of a book whose prompt is missing or out of date.
+
+    Inputs:
+      - max_workers: chapters sent at the same time (default SCENE_PROMPT_MAX_WORKERS)
+      - stats: optional dict filled with {"version", "chapters", "failed_chapters"}
+    One LLM call per chapter with events, the character list and setting are built once for the book.
+    An event whose prompt changes loses its scene image key, its next image is generated from the new prompt.
+    An event getting its first prompt keeps its image.
+    Returns the number of prompts written.
+    """
+    max_workers = max_workers or settings.SCENE_PROMPT_MAX_WORKERS
+    book = Book.objects.get(id=book_id)
+    version = refresh_scene_context_version(book)
+
+    events = (
+        Event.objects.filter(chapter__book=book)
+        .exclude(scene_prompt_version=version, scene_prompt__gt='')
+        .select_related('chapter')
+        .order_by('chapter__number', 'number')
+    )
+    by_chapter = {}
+    for event in events:
+        by_chapter.setdefault(event.chapter_id, (event.chapter, []))[1].append(event)
+    if stats is not None:
+        stats.update({"version": version, "chapters": len(by_chapter), "failed_chapters": []})
+    if not by_chapter:
+        return 0
+
+    setting = book_setting(book)
+    context_2 = character_context(book)
+    llm = init_chat_model(f"openai:{SCENE_PROMPT_MODEL}").with_structured_output(ScenePrompts)
+
+    groups = list(by_chapter.values())
+    results = fan_out(lambda group: _chapter_prompts(llm, book, group[0], group[1], setting, context_2), groups, max_workers)
+
+    updated = []
+    failed = []
+    for (chapter, chapter_events), (prompts, error) in zip(groups, results):
+        if error is not None:
+            failed.append(chapter.number)
+            continue
+        for event in chapter_events:
+            prompt = (prompts.get(event.number) or "").strip()
+            if not prompt:
+                continue
+            # an image stored before its event had a prompt (e.g adopted by manage.py scene_cache --adopt-legacy) is kept
+            if event.scene_prompt and prompt != event.scene_prompt:
+                event.scene_key = ""
+            event.scene_prompt = prompt
+            event.scene_prompt_version = version
+            updated.append(event)
+    Event.objects.bulk_update(updated, ["scene_prompt", "scene_prompt_version", "scene_key"])
+
+    if stats is not None:
+        stats["failed_chapters"] = failed
+    return len(updated)
@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from django.conf import settings
+
+
+# Single-flight generation of files (e.g scene images): when several callers ask for the same missing file,
+# one of them (the leader) produces it and the others wait for it, instead of every caller paying for an
+# API call and overwriting each other`s result.
+#
+#   - callers in the same process are serialized by a lock per file
+#   - callers in other processes are kept out by a lease file next to the target (<target>.lease), created
+#     atomically by the leader and removed when it is done
+#   - a lease older than SCENE_LEASE_SECONDS is considered left behind by a crashed process and is taken over
+
+_locks_lock = threading.Lock()
+# target path -> [lock, number of callers using it]
+_locks = {}
+
+
+def _file_lock(target):
+    with _locks_lock:
+        entry = _locks.setdefault(target, [threading.Lock(), 0])
+        entry[1] += 1
+    return entry
+
+
+def _release_file_lock(target, entry):
+    with _locks_lock:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[target]
+
+
+def _try_lease(lease_path):
+    """Create the lease file, False if another process holds it."""
+    try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{os.getpid()} {time.time()}")
+    return True
+
+
+def _lease_is_stale(lease_path, stale_after):
+    try:
+        return time.time() - os.path.getmtime(lease_path) > stale_after
+    except FileNotFoundError:
+        return False
+
+
+def single_flight(target, produce, done=None, stale_after=None, poll_interval=0.5):
+    """
+    Make sure the file `target` exists, calling produce() to write it at most once at a time
+    across threads and processes.
+
+    - done(): whether the work is already done, defaults to target existing (e.g a check that
+      target is not a lower quality version)
+    - returns immediately if done
+    - otherwise waits for the caller already producing it, or becomes the one producing it
+    - produce() must write target (atomically, e.g write a temp file then os.replace), its exceptions
+      are raised to the caller that ran it. Callers waiting on a failed produce() then try themselves.
+    Returns done() at the end.
+    """
+    done = done or (lambda: os.path.exists(target))
+    stale_after = stale_after or settings.SCENE_LEASE_SECONDS
+    if done():
+        return True
+
+    lease_path = f"{target}.lease"
+    entry = _file_lock(target)
+    try:
+        with entry[0]:
+            while not done():
+                if _try_lease(lease_path):
+                    try:
+                        # the previous leader may have finished between our checks
+                        if not done():
+                            produce()
+                    finally:
+                        try:
+                            os.remove(lease_path)
+                        except FileNotFoundError:
+                            pass
+                    break
+
+                if _lease_is_stale(lease_path, stale_after):
+                    print(f"[SINGLE FLIGHT] Recovering stale lease {lease_path}")
+                    try:
+                        os.remove(lease_path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+
+                # another process is producing the file
+                time.sleep(poll_interval)
+    finally:
+        _release_file_lock(target, entry)
+    return done()
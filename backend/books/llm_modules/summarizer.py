@@ -5,46 +5,78 @@ from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
 
+import time
+from django.conf import settings
 from django.utils.html import strip_tags
+from ..chapter_text import chapter_plain_text
 from ..models import *
 from rest_framework.response import Response
 from rest_framework import status
+from pydantic import BaseModel, Field
+from typing import List
+from .fanout import fan_out
+from .tokens import count_tokens, tail_tokens
 
 
 
 
+SUMMARY_MODEL = "gpt-4.1-mini"
 
-def summarize_all_chapters(book_id):
+
+def summarize_all_chapters(book_id, context_budget=None, recent_chapters=None, stats=None):
     """
     Build a running, chapter-by-chapter summary for an entire book using multiple LLM calls.
 
     Implementation:
       - Load the book chapters from DB
-      - Convert each chapter from HTML to plain text (strip_tags)
-      - Maintain a running summary string
+      - Read the plain text of each chapter (stored at ingestion)
+      - Maintain a running summary context
       - For each chapter:
-          * send the running summary + current chapter text to the LLM
+          * send the running summary context + current chapter text to the LLM
           * ask for a short (5-line) summary of only the *new* chapter
           * append it to the running summary
-      - Return the final combined summary text
+      - Return the chapter summaries, in order: [{"chapter": chapter number, "summary": text}]
+
+      Note :This iterative refinement process passes as context to LLM ALL previous chapters.Simply passing the last 2-3 chapters as context does not work since book progression to current chapter is not linear,
+      which is why older chapters are condensed into digests instead of being dropped.
 
-      Note :This iterative refinement process passes as context to LLM ALL previous chapters.Simply passing the last 2-3 chapters as context does not work since book progression to current chapter is not linear.
+    Context budget:
+      - context_budget (tokens, defaults to settings.SUMMARY_CONTEXT_TOKEN_BUDGET). 0 sends every previous
+        summary verbatim, so prompt tokens grow quadratically with the number of chapters.
+      - otherwise the context is kept under the budget: the last recent_chapters summaries
+        (settings.SUMMARY_RECENT_CHAPTERS) stay verbatim and older ones are compressed into digests,
+        so the whole story is still in the context but its size no longer grows with the book.
+      - stats: optional list that receives one dict per chapter with prompt tokens, context tokens and latency
 
     """
+    if context_budget is None:
+        context_budget = settings.SUMMARY_CONTEXT_TOKEN_BUDGET
+    if recent_chapters is None:
+        recent_chapters = settings.SUMMARY_RECENT_CHAPTERS
+    if stats is None:
+        stats = []
+
     try:
         book = Book.objects.get(id=book_id)
         chapters = Chapter.objects.filter(book=book).order_by('number')
     except (Book.DoesNotExist, Chapter.DoesNotExist):
         return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    chapter_texts = [strip_tags(chapter.content) for chapter in chapters]
-    llm = init_chat_model("openai:gpt-4.1-mini")
-    summary = " "
+    chapter_texts = [(chapter.number, chapter_plain_text(chapter)) for chapter in chapters]
+    llm = init_chat_model(f"openai:{SUMMARY_MODEL}")
+    summaries = []
+    # rolling context: digests of older chapters + most recent summaries verbatim
+    digests = []
+    recent = []
 
     #print(len(chapter_texts))
     chapter_texts.pop(0)
 
-    for c in chapter_texts:
+    for number, c in chapter_texts:
+        if context_budget:
+            context = _rolling_context(digests, recent)
+        else:
+            context = "\n\n".join(s["summary"] for s in summaries)
 
         messages = [
             {
@@ -62,16 +94,224 @@ def summarize_all_chapters(book_id):
             {
                 "role": "user",
                 "content": (
-                    f"SUMMARY OF PREVIOUS CHAPTERS:\n{summary}\n\n"
+                    f"SUMMARY OF PREVIOUS CHAPTERS:\n{context or ' '}\n\n"
                     f"CURRENT CHAPTER TEXT:\n{c}\n\n"
                     "SUMMARY OF NEW CHAPTER:"
                 ),
             },
         ]
 
+        start = time.perf_counter()
         response = llm.invoke(messages)
+        latency = time.perf_counter() - start
+
+        usage = response.usage_metadata or {}
+        prompt_tokens = usage.get("input_tokens") or count_tokens(messages[0]["content"] + messages[1]["content"], SUMMARY_MODEL)
+        stats.append({
+            "chapter": number,
+            "prompt_tokens": prompt_tokens,
+            "context_tokens": count_tokens(context, SUMMARY_MODEL),
+            "latency": round(latency, 3),
+        })
+        print(f"[SUMMARY] chapter {number}: {prompt_tokens} prompt tokens, {latency:.2f}s")
+
         # append to running summary
-        summary += f"\n\n{response.content}"
+        summaries.append({"chapter": number, "summary": response.content})
+        if context_budget:
+            recent.append(response.content)
+            digests, recent = _fit_context(llm, book.title, digests, recent, context_budget, recent_chapters)
+
+    return summaries
+
+
+def _rolling_context(digests, recent):
+    parts = []
+    if digests:
+        parts.append("EARLIER CHAPTERS (condensed):\n" + "\n\n".join(digests))
+    if recent:
+        parts.append("MOST RECENT CHAPTERS:\n" + "\n\n".join(recent))
+    return "\n\n".join(parts)
+
+
+def _fit_context(llm, title, digests, recent, budget, keep_recent):
+    """
+    Keep the rolling context under budget tokens.
+
+    When it is over budget, every summary except the keep_recent most recent ones is compressed
+    into a new digest. If the digests alone take more than half the budget, they are merged into one.
+    If the context is still over budget (a few long recent summaries, or a small budget), everything but
+    the latest summary is merged into one digest, and as a last resort the digest and the latest summary
+    are cut to their end.
+    """
+    def fits():
+        return count_tokens(_rolling_context(digests, recent), SUMMARY_MODEL) <= budget
+
+    if fits():
+        return digests, recent
+
+    if len(recent) > keep_recent:
+        split = len(recent) - keep_recent
+        older, recent = recent[:split], recent[split:]
+        digests = digests + [_digest(llm, title, older, budget // 4)]
+        if count_tokens("\n\n".join(digests), SUMMARY_MODEL) > budget // 2:
+            digests = [_digest(llm, title, digests, budget // 4)]
+    if not fits() and (len(recent) > 1 or len(digests) > 1):
+        digests = [_digest(llm, title, digests + recent[:-1], budget // 4)]
+        recent = recent[-1:]
+    if not fits():
+        # the model wrote longer digests than asked, or the latest summary alone is over budget
+        digests = [tail_tokens(digest, budget // 4, SUMMARY_MODEL) for digest in digests]
+        left = budget - count_tokens(_rolling_context(digests, [""]), SUMMARY_MODEL)
+        recent = [tail_tokens(recent[-1], left, SUMMARY_MODEL)]
+    return digests, recent
+
+
+def _digest(llm, title, texts, max_tokens):
+    # roughly 3 words for 4 tokens
+    max_words = max(max_tokens * 3 // 4, 50)
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                f"You are condensing the chapter summaries of the book '{title}'. "
+                f"Merge the summaries below into a single digest of at most {max_words} words, in story order. "
+                "Keep the events that matter for the rest of the story, character developments, "
+                "relationships and unresolved plot threads. Drop minor details."
+            ),
+        },
+        {"role": "user", "content": "\n\n".join(texts)},
+    ]
+    return llm.invoke(messages).content
+
+
+class StitchedSummaries(BaseModel):
+    summaries: List[str] = Field(description="The rewritten chapter summaries, one per input summary, in the same order")
+
+
+def summarize_chapters_map_reduce(book_id, lookback_tokens=None, stitch_batch=None, max_workers=None, stats=None):
+    """
+    Map-reduce alternative to summarize_all_chapters: chapter summaries do not wait for each other.
+
+    Implementation:
+      - map: every chapter is summarized at the same time (fan_out, max_workers requests in flight),
+        with only the last lookback_tokens tokens of the previous chapter as context
+      - reduce: consecutive summaries are sent stitch_batch at a time (batches also in parallel) to be
+        rewritten so they read as one continuous story (who is who, references to earlier events, transitions)
+      - returns the chapter summaries in the same format as summarize_all_chapters
+
+    Each chapter summary only sees a fixed size context, so ingest time no longer grows linearly with
+    the number of chapters, at the cost of the stitching calls. Defaults come from settings.SUMMARY_*.
+    """
+    if lookback_tokens is None:
+        lookback_tokens = settings.SUMMARY_LOOKBACK_TOKENS
+    stitch_batch = stitch_batch or settings.SUMMARY_STITCH_BATCH
+    max_workers = max_workers or settings.SUMMARY_MAX_WORKERS
+    if stats is None:
+        stats = []
+
+    book = Book.objects.get(id=book_id)
+    chapters = Chapter.objects.filter(book=book).order_by('number')
+    chapter_texts = [(chapter.number, chapter_plain_text(chapter)) for chapter in chapters]
+    llm = init_chat_model(f"openai:{SUMMARY_MODEL}")
+
+    # same chapters as the iterative mode: the first one is not summarized
+    inputs = []
+    for i in range(1, len(chapter_texts)):
+        number, text = chapter_texts[i]
+        inputs.append((number, text, tail_tokens(chapter_texts[i - 1][1], lookback_tokens, SUMMARY_MODEL)))
+
+    def summarize_chapter(item):
+        number, text, lookback = item
+        messages = [
+            {
+                "role": "system",
+                "content": (
+                    f"You are summarizing one chapter of the book '{book.title}'. "
+                    "You will receive the end of the previous chapter, only to know where the story stands, "
+                    "and the full text of the current chapter. "
+                    "Write a short 5 line summary of the current chapter. Mention chapter number before summarizing. "
+                    " Most importantly, summarise events from the chapter with greatest importance to the story. "
+                ),
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"END OF PREVIOUS CHAPTER:\n{lookback or ' '}\n\n"
+                    f"CURRENT CHAPTER ({number}) TEXT:\n{text}\n\n"
+                    "SUMMARY OF CURRENT CHAPTER:"
+                ),
+            },
+        ]
+        start = time.perf_counter()
+        response = llm.invoke(messages)
+        latency = time.perf_counter() - start
+        usage = response.usage_metadata or {}
+        prompt_tokens = usage.get("input_tokens") or count_tokens(messages[0]["content"] + messages[1]["content"], SUMMARY_MODEL)
+        print(f"[SUMMARY] chapter {number}: {prompt_tokens} prompt tokens, {latency:.2f}s")
+        return response.content, {
+            "chapter": number,
+            "prompt_tokens": prompt_tokens,
+            "context_tokens": count_tokens(lookback, SUMMARY_MODEL),
+            "latency": round(latency, 3),
+        }
+
+    results = fan_out(summarize_chapter, inputs, max_workers)
+    failed = [error for _, error in results if error is not None]
+    if failed:
+        raise failed[0]
+    summaries = []
+    for (number, _, _), (result, _) in zip(inputs, results):
+        summary, chapter_stats = result
+        summaries.append({"chapter": number, "summary": summary})
+        stats.append(chapter_stats)
+
+    # reduce: stitch consecutive summaries. A batch also gets the summary before it, for continuity across batches
+    batches = [(summaries[i - 1] if i else None, summaries[i:i + stitch_batch]) for i in range(0, len(summaries), stitch_batch)]
+    stitcher = llm.with_structured_output(StitchedSummaries, include_raw=True)
+
+    def stitch(batch):
+        previous, items = batch
+        messages = [
+            {
+                "role": "system",
+                "content": (
+                    f"You are editing the chapter by chapter summary of the book '{book.title}'. "
+                    "Each chapter was summarized on its own, so the summaries can repeat introductions, "
+                    "call the same character by different names or miss links between chapters. "
+                    "Rewrite each summary so that together they read as one continuous story: keep names consistent, "
+                    "refer back to earlier events where relevant and smooth the transitions. "
+                    "Keep one summary per chapter, in the same order, each starting with its chapter number and about 5 lines long. "
+                    "Do not add events that are not in the summaries."
+                ),
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"PREVIOUS CHAPTER SUMMARY (context only, do not rewrite):\n{previous['summary'] if previous else ' '}\n\n"
+                    "SUMMARIES TO REWRITE:\n\n" + "\n\n".join(item["summary"] for item in items)
+                ),
+            },
+        ]
+        start = time.perf_counter()
+        result = stitcher.invoke(messages)
+        latency = time.perf_counter() - start
+        usage = result["raw"].usage_metadata or {}
+        print(f"[SUMMARY] stitched chapters {items[0]['chapter']}-{items[-1]['chapter']} in {latency:.2f}s")
+        return result["parsed"], {
+            "chapters": [items[0]["chapter"], items[-1]["chapter"]],
+            "prompt_tokens": usage.get("input_tokens", 0),
+            "latency": round(latency, 3),
+        }
 
-    return summary.strip()
+    for (_, items), (result, error) in zip(batches, fan_out(stitch, batches, max_workers)):
+        # a failed or malformed stitch keeps the chapter summaries of the map step
+        if error is not None:
+            continue
+        stitched, stitch_stats = result
+        stats.append(stitch_stats)
+        if stitched is None or len(stitched.summaries) != len(items):
+            continue
+        for item, summary in zip(items, stitched.summaries):
+            item["summary"] = summary
 
+    return summaries
@@ -0,0 +1,28 @@
+from functools import lru_cache
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    # loaded on first use: tiktoken downloads the encoding file the first time
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model="gpt-4.1-mini"):
+    """Number of tokens of text for the given OpenAI model."""
+    if not text:
+        return 0
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def tail_tokens(text, max_tokens, model="gpt-4.1-mini"):
+    """The last max_tokens tokens of text (the whole text if it is shorter)."""
+    if not text or max_tokens <= 0:
+        return ""
+    tokens = _encoding(model).encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _encoding(model).decode(tokens[-max_tokens:])
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+
+# Token accounting for LLM calls.
+# track_usage() opens a scope (e.g one ingestion stage) and every LLM call made inside it is counted:
+#   - langchain chat model calls are collected automatically through a callback handler
+#   - OpenAI client calls are added with record_usage(response)
+# Scopes are stored in context variables, fan_out copies them into its worker threads.
+
+_current_usage = ContextVar("llm_token_usage", default=None)
+
+# langchain adds the handler stored in this variable to every chat model call made in the context
+_langchain_usage_handler = ContextVar("langchain_usage_handler", default=None)
+register_configure_hook(_langchain_usage_handler, inheritable=True)
+
+
+class TokenUsage:
+    """Running input/output token counts of a usage scope. Safe to update from several threads."""
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, input_tokens=0, output_tokens=0):
+        with self._lock:
+            self.input_tokens += input_tokens or 0
+            self.output_tokens += output_tokens or 0
+
+
+@contextmanager
+def track_usage():
+    """
+    Count tokens of all LLM calls made inside the with block.
+
+        with track_usage() as usage:
+            summarize_all_chapters(book_id)
+        usage.input_tokens, usage.output_tokens
+    """
+    usage = TokenUsage()
+    handler = UsageMetadataCallbackHandler()
+    usage_token = _current_usage.set(usage)
+    handler_token = _langchain_usage_handler.set(handler)
+    try:
+        yield usage
+    finally:
+        _langchain_usage_handler.reset(handler_token)
+        _current_usage.reset(usage_token)
+        for metadata in handler.usage_metadata.values():
+            usage.add(metadata.get("input_tokens", 0), metadata.get("output_tokens", 0))
+
+
+def record_usage(response):
+    """
+    Add the token usage of an OpenAI client response (responses.parse, images.generate, ...)
+    to the current usage scope. Does nothing outside of track_usage().
+    """
+    usage = _current_usage.get()
+    response_usage = getattr(response, "usage", None)
+    if usage is None or response_usage is None:
+        return
+    usage.add(
+        getattr(response_usage, "input_tokens", None) or getattr(response_usage, "prompt_tokens", 0),
+        getattr(response_usage, "output_tokens", None) or getattr(response_usage, "completion_tokens", 0),
+    )
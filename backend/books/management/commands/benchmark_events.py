@@ -0,0 +1,86 @@
+import time
+from bs4 import BeautifulSoup
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from books.chapter_text import normalize_chapter
+from books.llm_modules.event_extractor import EventInfo, EventList
+from books.models import Book, Chapter, Event
+from books.utils import save_events_to_db
+
+
+def soup_edit_chapter(chapter, event, event_index):
+    # original event persistence, kept as the benchmark baseline:
+    # full BeautifulSoup parse + serialize of the chapter for every event to insert its placeholder
+    soup = BeautifulSoup(chapter.content, 'html.parser')
+    p_tags = soup.find_all("p")
+    event_position = min(event.last_paragraph, len(p_tags))
+    div = soup.new_tag("div", id=f"ev{event_index}")
+    div.string = f"PLACEHOLDER FOR IMAGE {event_index}"
+    p_tags[event_position - 1].append(div)
+    chapter.content = str(soup)
+    chapter.save()
+
+
+class Command(BaseCommand):
+    """
+    python manage.py benchmark_events [--chapters 100] [--paragraphs 80] [--events 4]
+
+    Benchmarks event persistence on a synthetic book:
+      - per event, BeautifulSoup rewrite of the chapter with a placeholder + Event.objects.create (original)
+      - save_events_to_db: event text offsets from the paragraph index, one bulk_create, chapters untouched
+    Everything runs inside a transaction that is rolled back, no data is kept.
+    """
+
+    help = "Benchmark event persistence on a synthetic book"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chapters", type=int, default=100)
+        parser.add_argument("--paragraphs", type=int, default=80, help="Paragraphs per chapter")
+        parser.add_argument("--events", type=int, default=4, help="Events per chapter")
+
+    def handle(self, *args, **options):
+        n_chapters, n_paragraphs, n_events = options["chapters"], options["paragraphs"], options["events"]
+
+        paragraph = "<p>" + "The quick brown fox jumps over the lazy dog. " * 12 + "</p>"
+        chapter_html = "<h1>Chapter</h1>" + paragraph * n_paragraphs
+        step = max(n_paragraphs // n_events, 1)
+        event_list = EventList(events=[
+            EventInfo(event_label=f"Event {i}", event_summary="Something happens.", last_paragraph=min(step * i, n_paragraphs))
+            for i in range(1, n_events + 1)
+        ])
+
+        def make_book():
+            book = Book.objects.create(title="benchmark")
+            _, text, paragraph_index = normalize_chapter(BeautifulSoup(chapter_html, "html.parser"))
+            Chapter.objects.bulk_create([
+                Chapter(book=book, number=n, title=f"Chapter {n}", content=chapter_html, text=text, paragraph_index=list(map(list, paragraph_index)))
+                for n in range(1, n_chapters + 1)
+            ])
+            chapters = list(Chapter.objects.filter(book=book).order_by("number"))
+            return book, chapters
+
+        def per_event(book, chapters):
+            for ch in chapters:
+                for index, ev in enumerate(event_list.events, start=1):
+                    soup_edit_chapter(ch, ev, index)
+                    Event.objects.create(chapter=ch, number=index, start_index=ev.last_paragraph, summary=ev.event_summary, label=ev.event_label)
+
+        def batched(book, chapters):
+            save_events_to_db(book, [{"chapter_id": ch.id, "event_list": event_list, "error": ""} for ch in chapters])
+
+        self.stdout.write(f"{n_chapters} chapters x {n_paragraphs} paragraphs, {n_events} events per chapter")
+        for name, run in [
+            ("per event, BeautifulSoup rewrite", per_event),
+            ("save_events_to_db", batched),
+        ]:
+            with transaction.atomic():
+                book, chapters = make_book()
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    run(book, chapters)
+                    elapsed = time.perf_counter() - start
+                events = Event.objects.filter(chapter__book=book).count()
+                transaction.set_rollback(True)
+            self.stdout.write(f"{name:<36} {elapsed:8.3f}s  {len(queries):6d} queries  {events} events")
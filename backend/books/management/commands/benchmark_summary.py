@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from books.llm_modules.summarizer import summarize_all_chapters, summarize_chapters_map_reduce
+from books.llm_modules.usage import track_usage
+from books.models import Book, Chapter
+
+
+MODES = {
+    "iterative": summarize_all_chapters,
+    "map_reduce": summarize_chapters_map_reduce,
+}
+
+
+class Command(BaseCommand):
+    """
+    python manage.py benchmark_summary <book_id> [--modes iterative map_reduce]
+
+    Summarizes an already parsed book with each summary mode and compares them:
+      - wall clock time
+      - input / output tokens of all LLM calls (chapter summaries, digests, stitching)
+      - largest prompt sent for one chapter
+    The summaries are not saved, the book keeps its current ones. This makes real API calls.
+    """
+
+    help = "Compare wall clock time and token cost of the summary modes on a book"
+
+    def add_arguments(self, parser):
+        parser.add_argument("book_id", type=int)
+        parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+
+    def handle(self, *args, **options):
+        try:
+            book = Book.objects.get(id=options["book_id"])
+        except Book.DoesNotExist:
+            raise CommandError(f"Book {options['book_id']} not found")
+        chapters = Chapter.objects.filter(book=book).count()
+        if chapters < 2:
+            raise CommandError(f"Book {book.id} has no chapters to summarize, run its parse stage first")
+
+        self.stdout.write(f"{book.title}: {chapters} chapters")
+        self.stdout.write(f"{'mode':<12} {'wall':>9} {'input tok':>11} {'output tok':>11} {'max prompt':>11}")
+        for mode in options["modes"]:
+            stats = []
+            with track_usage() as usage:
+                start = time.perf_counter()
+                MODES[mode](book.id, stats=stats)
+                elapsed = time.perf_counter() - start
+            max_prompt = max((s["prompt_tokens"] for s in stats if "chapter" in s), default=0)
+            self.stdout.write(
+                f"{mode:<12} {elapsed:8.1f}s {usage.input_tokens:11d} {usage.output_tokens:11d} {max_prompt:11d}"
+            )
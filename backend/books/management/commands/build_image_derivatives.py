@@ -0,0 +1,35 @@
+import os
+from django.core.management.base import BaseCommand
+
+from books.image_derivatives import make_derivatives
+from books.models import Book, Character, SceneImage
+from books.scene_cache import scene_file_path
+
+
+class Command(BaseCommand):
+    """
+    python manage.py build_image_derivatives
+
+    Writes the missing WebP/AVIF derivatives of the images stored before derivatives existed:
+    book covers, character portraits and full scene images (previews are skipped).
+    Images that already have up to date derivatives are left alone.
+    """
+
+    help = "Build the missing WebP/AVIF derivatives of covers, portraits and scene images"
+
+    def handle(self, *args, **options):
+        paths = [b.cover_image.path for b in Book.objects.exclude(cover_image="") if b.cover_image]
+        paths += [c.image.path for c in Character.objects.exclude(image="") if c.image]
+        scenes = [scene_file_path(key)[0] for key in SceneImage.objects.filter(size__gt=0).values_list('key', flat=True)]
+        paths += [p for p in scenes if not os.path.exists(f"{p}.preview")]
+
+        images = written = 0
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                written += make_derivatives(path)
+                images += 1
+            except Exception as e:
+                self.stderr.write(f"{path}: {e!r}")
+        self.stdout.write(f"{images} images, {written} derivatives written")
@@ -0,0 +1,52 @@
+import os
+import socket
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from books.ingestion import claim_next_job, run_ingestion_job
+from books.models import IngestionJob
+
+
+class Command(BaseCommand):
+    """
+    python manage.py ingest_worker
+
+    Worker process for the background ingestion queue. Claims queued IngestionJobs one at a time
+    and runs its ingestion stages (see books.ingestion). Several workers can run at the same time.
+    """
+
+    help = "Run queued book ingestion jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty instead of polling")
+        parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds to wait between polls of an empty queue")
+        parser.add_argument(
+            "--requeue-running",
+            action="store_true",
+            help="Queue again jobs left in 'running' state by a worker that crashed",
+        )
+
+    def handle(self, *args, **options):
+        worker_name = f"{socket.gethostname()}:{os.getpid()}"
+
+        if options["requeue_running"]:
+            count = IngestionJob.objects.filter(status="running").update(status="queued", worker="")
+            self.stdout.write(f"Requeued {count} running job(s)")
+
+        self.stdout.write(f"Ingestion worker {worker_name} started")
+        while True:
+            close_old_connections()
+            job = claim_next_job(worker_name)
+            if job is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(f"Running ingestion job {job.id} for book {job.book_id}")
+            ok = run_ingestion_job(job)
+            if ok:
+                self.stdout.write(self.style.SUCCESS(f"Job {job.id} done"))
+            else:
+                self.stdout.write(self.style.ERROR(f"Job {job.id} failed: {job.error}"))
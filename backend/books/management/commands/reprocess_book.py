@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from books.ingestion import STAGE_NAMES, downstream_stages, enqueue_ingestion, run_ingestion_job
+from books.models import Book, IngestionJob, SUMMARY_MODE_CHOICES
+
+
+class Command(BaseCommand):
+    """
+    python manage.py reprocess_book <book_id> [--from-stage STAGE | --stages STAGE [STAGE ...]] [--enqueue]
+                                    [--summary-mode iterative|map_reduce]
+
+    Resumes or reruns the ingestion stages of a book from their checkpoints:
+      - no option: resume, run every stage that is not done yet (e.g after a rate limit error)
+      - --from-stage summary: rerun that stage and every stage that needs its output
+      - --stages summary metadata: rerun only the named stages
+    By default the job runs in this process. With --enqueue it is left to an ingest_worker.
+    --summary-mode changes how the book is summarized, rerun the summary stage for it to apply.
+    """
+
+    help = "Resume or rerun ingestion stages of a book"
+
+    def add_arguments(self, parser):
+        parser.add_argument("book_id", type=int)
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--from-stage", choices=STAGE_NAMES, help="Rerun this stage and all stages that depend on it")
+        group.add_argument("--stages", nargs="+", choices=STAGE_NAMES, help="Rerun only these stages")
+        parser.add_argument("--enqueue", action="store_true", help="Queue the job for ingest_worker instead of running it here")
+        parser.add_argument("--summary-mode", choices=[mode for mode, _ in SUMMARY_MODE_CHOICES], help="Set the summary mode of the book")
+
+    def handle(self, *args, **options):
+        try:
+            book = Book.objects.get(id=options["book_id"])
+        except Book.DoesNotExist:
+            raise CommandError(f"Book {options['book_id']} not found")
+
+        if IngestionJob.objects.filter(book=book, status__in=["queued", "running"]).exists():
+            raise CommandError(f"Book {book.id} already has a queued or running ingestion job")
+
+        if options["summary_mode"]:
+            book.summary_mode = options["summary_mode"]
+            book.save(update_fields=["summary_mode"])
+
+        if options["from_stage"]:
+            stages = downstream_stages(options["from_stage"])
+        else:
+            stages = options["stages"] or []
+
+        job = enqueue_ingestion(book, stages=stages)
+        if options["enqueue"]:
+            self.stdout.write(f"Queued ingestion job {job.id} for book {book.id}")
+            return
+
+        # claim the job right away so no worker picks it up too
+        IngestionJob.objects.filter(id=job.id).update(status="running", worker="reprocess_book", started_at=timezone.now())
+        job.refresh_from_db()
+        if run_ingestion_job(job):
+            self.stdout.write(self.style.SUCCESS(f"Book {book.id} reprocessed"))
+        else:
+            raise CommandError(f"Reprocessing failed: {job.error}")
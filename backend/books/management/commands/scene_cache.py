@@ -0,0 +1,64 @@
+import os
+from django.core.management.base import BaseCommand
+
+from books.llm_modules.image_gen import SCENE_IMAGE_MODEL
+from books.scene_cache import adopt_legacy_scene_images, enforce_scene_quota, evict_scene_image, scene_cache_stats
+
+
+def _mb(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+class Command(BaseCommand):
+    """
+    python manage.py scene_cache [--adopt-legacy] [--prune]
+
+    Reports on the scene image cache (see books/scene_cache.py):
+      - images and space on disk against the quota (SCENE_CACHE_MAX_MB)
+      - hits, generations and hit rate
+      - reclaimable space: images no event uses anymore (e.g after re-ingesting a book), and files of the
+        scenes folder the cache does not know (e.g left by a crash)
+      - legacy files: scene images stored before the cache existed, named after their event
+    --adopt-legacy moves the legacy images whose event still exists into the cache (run it once after
+    upgrading), the others stay legacy files.
+    --prune deletes the reclaimable files and evicts least recently used images down to the quota. Legacy
+    files are never deleted.
+    """
+
+    help = "Report scene image cache hit rate and reclaimable space, optionally prune it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--adopt-legacy", action="store_true", help="Move scene images stored before the cache into it")
+        parser.add_argument("--prune", action="store_true", help="Delete reclaimable files and enforce the quota")
+
+    def handle(self, *args, **options):
+        if options["adopt_legacy"]:
+            adopted, left = adopt_legacy_scene_images(SCENE_IMAGE_MODEL)
+            self.stdout.write(f"adopted {adopted} legacy scene images, {left} left (their event is gone)")
+
+        stats = scene_cache_stats()
+        quota = _mb(stats["quota_bytes"]) if stats["quota_bytes"] else "no limit"
+        self.stdout.write(f"images:       {stats['entries']} ({_mb(stats['bytes'])}, quota {quota})")
+        self.stdout.write(f"hits:         {stats['hits']}")
+        self.stdout.write(f"generations:  {stats['generations']}")
+        self.stdout.write(f"hit rate:     {stats['hit_rate']:.1%}")
+        self.stdout.write(f"unused:       {len(stats['orphans'])} images ({_mb(stats['orphan_bytes'])})")
+        self.stdout.write(f"untracked:    {len(stats['untracked'])} files ({_mb(stats['untracked_bytes'])})")
+        self.stdout.write(f"legacy:       {len(stats['legacy'])} files ({_mb(stats['legacy_bytes'])})")
+        self.stdout.write(f"reclaimable:  {_mb(stats['orphan_bytes'] + stats['untracked_bytes'])}")
+
+        if not options["prune"]:
+            return
+
+        freed = sum(evict_scene_image(image) for image in stats["orphans"])
+        for path in stats["untracked"]:
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        evicted, quota_freed = enforce_scene_quota()
+        self.stdout.write(
+            f"pruned {len(stats['orphans'])} unused images and {len(stats['untracked'])} untracked files, "
+            f"evicted {evicted} images over quota: {_mb(freed + quota_freed)} freed"
+        )
@@ -0,0 +1,115 @@
+import re
+from django.db import transaction
+
+from .chapter_text import chapter_index
+from .models import Chapter, Character, CharacterMention
+
+
+# Character mention index: for every character, the chapters and paragraphs where its name or one of its
+# aliases is written. Built at ingestion (mentions stage) with one regex matching all names at once,
+# run over the stored chapter text. Character.chapters_appeared is computed from it.
+
+
+def name_patterns(characters):
+    """
+    Names and aliases to look for -> character id.
+    A name shared by several characters (e.g a family name) is left out, it cannot tell them apart.
+    """
+    owners = {}
+    for character in characters:
+        for name in {character.name, *(character.aliases or [])}:
+            name = name.strip()
+            if len(name) < 2:
+                continue
+            owners.setdefault(name, set()).add(character.id)
+    return {name: ids.pop() for name, ids in owners.items() if len(ids) == 1}
+
+
+def mention_regex(names):
+    """
+    Single regex matching any of the names as whole words. Longest names come first so "Mr. Darcy"
+    is matched as a whole and not as "Darcy". Matching is case sensitive: names are capitalized.
+    """
+    alternatives = sorted(names, key=len, reverse=True)
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(name) for name in alternatives) + r")(?!\w)")
+
+
+def find_mentions(chapter, regex, patterns):
+    """
+    Mentions of every character in a chapter: {character id: [count, [paragraph numbers]]}.
+    Mentions outside of <p> elements (e.g headings) are counted without a paragraph.
+    """
+    index = chapter_index(chapter)
+    found = {}
+    # paragraph numbers by text start, matches are found in the whole text in one pass
+    starts = [text_start for _, _, text_start, _ in index]
+    ends = [text_end for _, _, _, text_end in index]
+    paragraph = 0
+    for match in regex.finditer(chapter.text):
+        entry = found.setdefault(patterns[match.group(0)], [0, []])
+        entry[0] += 1
+        paragraphs = entry[1]
+
+        position = match.start()
+        while paragraph < len(starts) and ends[paragraph] <= position:
+            paragraph += 1
+        if paragraph < len(starts) and starts[paragraph] <= position:
+            number = paragraph + 1
+            if not paragraphs or paragraphs[-1] != number:
+                paragraphs.append(number)
+    return found
+
+
+def build_mention_index(book):
+    """
+    Rebuild the mention index of a book and the chapters_appeared of its characters.
+    Returns the number of index entries (character, chapter).
+    """
+    characters = list(Character.objects.filter(book=book))
+    patterns = name_patterns(characters)
+
+    rows = []
+    chapters_by_character = {c.id: [] for c in characters}
+    if patterns:
+        regex = mention_regex(patterns)
+        for chapter in Chapter.objects.filter(book=book).order_by('number'):
+            for character_id, (count, paragraphs) in find_mentions(chapter, regex, patterns).items():
+                rows.append(CharacterMention(character_id=character_id, chapter=chapter, paragraphs=paragraphs, count=count))
+                chapters_by_character[character_id].append(chapter.number)
+
+    for character in characters:
+        character.chapters_appeared = chapters_by_character[character.id]
+
+    with transaction.atomic():
+        CharacterMention.objects.filter(character__book=book).delete()
+        CharacterMention.objects.bulk_create(rows)
+        Character.objects.bulk_update(characters, ["chapters_appeared"])
+    return len(rows)
+
+
+def find_character(book_id, name):
+    """Character of a book by name or alias (case insensitive), None if there is none."""
+    wanted = name.strip().lower()
+    for character in Character.objects.filter(book_id=book_id):
+        if wanted in {n.strip().lower() for n in [character.name, *(character.aliases or [])]}:
+            return character
+    return None
+
+
+def character_appearances(character):
+    """Chapters where a character appears, from the mention index: [{chapter, title, count, paragraphs}]"""
+    mentions = (
+        CharacterMention.objects.filter(character=character)
+        .select_related('chapter')
+        .only('count', 'paragraphs', 'chapter__number', 'chapter__title')
+        .order_by('chapter__number')
+    )
+    return [
+        {
+            "chapter": m.chapter.number,
+            "title": m.chapter.title,
+            "count": m.count,
+            "paragraphs": m.paragraphs,
+        }
+        for m in mentions
+    ]
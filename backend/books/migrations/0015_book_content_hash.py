@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:22
+
+import hashlib
+from django.db import migrations, models
+
+
+def hash_existing_epubs(apps, schema_editor):
+    """Fill content_hash for books uploaded before deduplication existed."""
+    Book = apps.get_model('books', 'Book')
+    for book in Book.objects.exclude(epub_file='').exclude(epub_file__isnull=True):
+        try:
+            hasher = hashlib.sha256()
+            with book.epub_file.open('rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(chunk)
+        except (OSError, ValueError):
+            continue
+        book.content_hash = hasher.hexdigest()
+        book.save(update_fields=['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0014_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(hash_existing_epubs, migrations.RunPython.noop),
+    ]
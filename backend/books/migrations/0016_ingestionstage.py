@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_book_content_hash'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='ingestionjob',
+            name='progress',
+        ),
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='stages',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='IngestionStage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('outputs', models.JSONField(blank=True, default=dict)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('input_tokens', models.PositiveIntegerField(default=0)),
+                ('output_tokens', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_stages', to='books.book')),
+            ],
+            options={
+                'unique_together': {('book', 'name')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0016_ingestionstage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='critical_path',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0017_ingestionjob_critical_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='paragraph_index',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='text',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def split_book_summaries(apps, schema_editor):
+    # books ingested before this table existed: Book.summary holds one paragraph per chapter,
+    # starting with chapter 2 (the first chapter is not summarized)
+    Book = apps.get_model('books', 'Book')
+    ChapterSummary = apps.get_model('books', 'ChapterSummary')
+    for book in Book.objects.exclude(summary=''):
+        paragraphs = [p.strip() for p in book.summary.split("\n\n") if p.strip()]
+        rows = []
+        for i, paragraph in enumerate(paragraphs):
+            rows.append(ChapterSummary(
+                book=book,
+                chapter_number=i + 2,
+                summary=paragraph,
+                story_so_far="\n\n".join(paragraphs[:i + 1]),
+            ))
+        ChapterSummary.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0018_chapter_text_paragraph_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChapterSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chapter_number', models.PositiveIntegerField()),
+                ('summary', models.TextField(blank=True)),
+                ('story_so_far', models.TextField(blank=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chapter_summaries', to='books.book')),
+            ],
+            options={
+                'ordering': ['book', 'chapter_number'],
+                'unique_together': {('book', 'chapter_number')},
+            },
+        ),
+        migrations.RunPython(split_book_summaries, migrations.RunPython.noop),
+    ]
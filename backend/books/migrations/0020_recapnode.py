@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0019_chapter_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecapNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveIntegerField()),
+                ('index', models.PositiveIntegerField()),
+                ('start_chapter', models.PositiveIntegerField()),
+                ('end_chapter', models.PositiveIntegerField()),
+                ('summary', models.TextField(blank=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recap_nodes', to='books.book')),
+            ],
+            options={
+                'ordering': ['book', 'level', 'index'],
+                'unique_together': {('book', 'level', 'index')},
+            },
+        ),
+    ]
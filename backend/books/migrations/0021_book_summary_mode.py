@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0020_recapnode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='summary_mode',
+            field=models.CharField(choices=[('iterative', 'iterative'), ('map_reduce', 'map_reduce')], default='iterative', max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0021_book_summary_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='aliases',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='CharacterMention',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('paragraphs', models.JSONField(blank=True, default=list)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='character_mentions', to='books.chapter')),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='books.character')),
+            ],
+            options={
+                'ordering': ['character', 'chapter__number'],
+                'unique_together': {('character', 'chapter')},
+            },
+        ),
+    ]
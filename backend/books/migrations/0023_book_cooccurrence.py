@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0022_character_mentions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cooccurrence',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0023_book_cooccurrence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chapter_number', models.PositiveIntegerField()),
+                ('graph', models.JSONField(blank=True, default=dict)),
+                ('etag', models.CharField(blank=True, default='', max_length=40)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='graph_snapshots', to='books.book')),
+            ],
+            options={
+                'ordering': ['book', 'chapter_number'],
+                'unique_together': {('book', 'chapter_number')},
+            },
+        ),
+    ]
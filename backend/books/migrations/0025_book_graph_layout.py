@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0024_graphsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='graph_layout',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,123 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:45
+
+import re
+from bisect import bisect_right
+
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
+from django.db import migrations, models
+
+
+# Helpers of books.chapter_text as they were when this migration was written, copied here so that later
+# changes to chapter_text do not change what this migration does.
+
+EVENT_PLACEHOLDER_RE = re.compile(r'<div id="ev\d+">PLACEHOLDER FOR IMAGE \d+</div>')
+
+
+def _collect_text(node, parts, length, paragraphs):
+    # depth first walk appending text strings and recording <p> text offsets
+    for child in node.children:
+        if isinstance(child, Tag):
+            if child.name == "p":
+                entry = [child, length, length]
+                paragraphs.append(entry)
+                length = _collect_text(child, parts, length, paragraphs)
+                entry[2] = length
+            else:
+                length = _collect_text(child, parts, length, paragraphs)
+        elif type(child) in (NavigableString, CData):
+            parts.append(str(child))
+            length += len(child)
+    return length
+
+
+def build_paragraph_index(content):
+    """(text, paragraph_index) of chapter HTML without event placeholders, see books.chapter_text.normalize_chapter"""
+    root = BeautifulSoup(content, "html.parser")
+    content_html = "".join(str(child) for child in root.contents)
+    parts = []
+    paragraphs = []
+    _collect_text(root, parts, 0, paragraphs)
+
+    paragraph_index = []
+    cursor = 0
+    for p_tag, text_start, text_end in paragraphs:
+        p_html = str(p_tag)
+        html_start = content_html.find(p_html, cursor)
+        if html_start == -1:
+            html_start = html_end = cursor
+        else:
+            html_end = html_start + len(p_html)
+            cursor = html_start + 1
+        paragraph_index.append([html_start, html_end, text_start, text_end])
+    return "".join(parts), paragraph_index
+
+
+def remove_event_placeholders(chapter):
+    # placeholders are not part of the text, only the HTML offsets of the paragraph index move
+    matches = list(EVENT_PLACEHOLDER_RE.finditer(chapter.content))
+    if not matches:
+        return False
+    ends = [m.end() for m in matches]
+    removed = [0]
+    for m in matches:
+        removed.append(removed[-1] + len(m.group(0)))
+
+    def shift(offset):
+        return offset - removed[bisect_right(ends, offset)]
+
+    for entry in chapter.paragraph_index:
+        entry[0] = shift(entry[0])
+        entry[1] = shift(entry[1])
+    chapter.content = EVENT_PLACEHOLDER_RE.sub("", chapter.content)
+    return True
+
+
+def paragraph_range_offsets(chapter, first, last):
+    index = chapter.paragraph_index
+    if not index:
+        return 0, len(chapter.text)
+    start = 0 if first <= 1 else index[min(first, len(index)) - 1][2]
+    end = len(chapter.text) if last >= len(index) else index[max(last, 1) - 1][3]
+    return start, max(start, end)
+
+
+def move_event_anchors_out_of_chapters(apps, schema_editor):
+    # event placeholders were stored in chapter HTML: remove them and store the event text offsets instead
+    Chapter = apps.get_model('books', 'Chapter')
+    Event = apps.get_model('books', 'Event')
+    for chapter in Chapter.objects.filter(events__isnull=False).distinct():
+        if chapter.paragraph_index is None:
+            # chapter stored before the paragraph index existed
+            chapter.content = EVENT_PLACEHOLDER_RE.sub("", chapter.content)
+            chapter.text, chapter.paragraph_index = build_paragraph_index(chapter.content)
+            chapter.save(update_fields=['content', 'text', 'paragraph_index'])
+        elif remove_event_placeholders(chapter):
+            chapter.save(update_fields=['content', 'paragraph_index'])
+
+        events = list(Event.objects.filter(chapter=chapter).order_by('number'))
+        first_paragraph = 1
+        for event in events:
+            event.text_start, event.text_end = paragraph_range_offsets(chapter, first_paragraph, event.start_index)
+            first_paragraph = event.start_index + 1
+        Event.objects.bulk_update(events, ['text_start', 'text_end'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0025_book_graph_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='text_end',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='text_start',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(move_event_anchors_out_of_chapters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0026_event_text_offsets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SceneJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chapter_number', models.PositiveIntegerField()),
+                ('event_number', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=16)),
+                ('image_url', models.CharField(blank=True, default='', max_length=255)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scene_jobs', to='books.book')),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['book', 'chapter_number', 'event_number'], name='books_scene_book_id_835c60_idx')],
+            },
+        ),
+    ]
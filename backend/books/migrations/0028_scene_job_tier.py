@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0027_scene_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenejob',
+            name='tier',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:55
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0028_scene_job_tier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SceneImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(blank=True, default='', max_length=64)),
+                ('size', models.BigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('generations', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_accessed', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='scene_key',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0029_scene_image_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='scene_context_version',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='scene_prompt',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='scene_prompt_version',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
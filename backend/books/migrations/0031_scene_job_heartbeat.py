@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0030_scene_prompts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenejob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
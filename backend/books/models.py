@@ -3,6 +3,12 @@ from django.utils import timezone
 from django.db.models import JSONField                 
 
 
+SUMMARY_MODE_CHOICES = (
+    ("iterative", "iterative"),
+    ("map_reduce", "map_reduce"),
+)
+
+
 class Book(models.Model):
     """
     Represents an uploaded EPUB and all derived/processed information for it.
@@ -14,15 +20,26 @@ class Book(models.Model):
     title = models.CharField(max_length=200)
     author = models.CharField(max_length=100, blank=True)
     epub_file = models.FileField(upload_to='uploads/epubs/', null=True, blank=True)
+    # sha256 of the uploaded EPUB file, used to detect re-uploads of the same book
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
     created_at = models.DateTimeField(default=timezone.now, null=True, blank=True)
     cover_image = models.ImageField(upload_to='uploads/covers/', null=True, blank=True)
     last_chapter_visited = models.IntegerField(default=1)
     # whole book summary
     summary = models.TextField(default='')
+    # how chapter summaries are generated at ingestion (see llm_modules/summarizer.py)
+    summary_mode = models.CharField(max_length=20, choices=SUMMARY_MODE_CHOICES, default='iterative')
     #JSON object containing all metadat on book
     inferred_metadata =models.JSONField(default=dict, blank=True)
     #charcter relationship information
     relationships = models.JSONField(default=dict, blank=True)
+    # hash of the book data scene prompts are written from: metadata, characters, summaries
+    # (see llm_modules/scene_prompts.py). Event scene prompts of another version are out of date
+    scene_context_version = models.CharField(max_length=40, blank=True, default='')
+    # paragraph level character co-occurrence (see cooccurrence.py)
+    cooccurrence = models.JSONField(default=dict, blank=True)
+    # relationship graph node coordinates {"version", "positions": {name: [x, y]}} (see graph.py)
+    graph_layout = models.JSONField(default=dict, blank=True)
 
 
     def __str__(self):
@@ -33,13 +50,19 @@ class Book(models.Model):
 class Chapter(models.Model):
     """
     Represents one chapterextracted from the EPUB. A book has many chapters
-    
+
+    The chapter HTML is parsed once at ingestion: text and paragraph_index are read by the
+    LLM modules instead of parsing content again (see chapter_text.py)
     """
 
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='chapters')
     number = models.PositiveIntegerField()
     title = models.CharField(max_length=200, blank=True)
     content = models.TextField(blank=True)
+    # plain text of the chapter
+    text = models.TextField(blank=True, default='')
+    # [html_start, html_end, text_start, text_end] for every <p>, offsets into content and text. None = not built yet
+    paragraph_index = models.JSONField(null=True, blank=True, default=None)
 
     def __str__(self):
         return f"{self.book.title} - {self.title or f'Chapter {self.number}'}"
@@ -48,10 +71,22 @@ class Event(models.Model):
     """
     Represents an extracted event inside a chapter.A chaper has many events.Events ordered by
     uniue (chapter, number)
+
+    Events are not marked in Chapter.content: their anchors are rendered when the chapter is served
     """
     chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='events')
     number= models.PositiveIntegerField()
+    # last paragraph of the event (1-based), where its anchor is rendered
     start_index = models.PositiveIntegerField()
+    # text of the event is chapter.text[text_start:text_end]
+    text_start = models.PositiveIntegerField(default=0)
+    text_end = models.PositiveIntegerField(default=0)
+    # key of the scene image of the event in the scene image cache (see scene_cache.py), empty until generated
+    scene_key = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # image prompt of the scene (see llm_modules/scene_prompts.py), valid while scene_prompt_version
+    # is the scene_context_version of the book
+    scene_prompt = models.TextField(blank=True, default='')
+    scene_prompt_version = models.CharField(max_length=40, blank=True, default='')
     summary = models.TextField(blank=True)
     label = models.TextField(blank=True)
 
@@ -62,6 +97,48 @@ class Event(models.Model):
         ordering = ['chapter', 'number']
         unique_together = ('chapter', 'number')
 
+class ChapterSummary(models.Model):
+    """
+    Summary of one chapter, generated at ingestion by the summary stage. A book has one row per
+    summarized chapter (the first chapter of the EPUB is not summarized).
+
+    story_so_far is precomputed: it is every chapter summary of the book up to and including this one,
+    so "summary up to chapter N" is a single indexed lookup.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='chapter_summaries')
+    chapter_number = models.PositiveIntegerField()
+    summary = models.TextField(blank=True)
+    story_so_far = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.book.title} - Ch {self.chapter_number} summary"
+
+    class Meta:
+        ordering = ['book', 'chapter_number']
+        unique_together = ('book', 'chapter_number')
+
+class RecapNode(models.Model):
+    """
+    Node of the recap tree of a book, built at ingestion by the recap stage.
+
+    Level 0 nodes are the chapter summaries. Every RECAP_BRANCHING consecutive nodes of a level are
+    condensed into one node of the level above (arcs), up to a single node covering the whole book.
+    Node index of a level covers summarized chapters [index * B^level, (index + 1) * B^level) in chapter order.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='recap_nodes')
+    level = models.PositiveIntegerField()
+    index = models.PositiveIntegerField()
+    start_chapter = models.PositiveIntegerField()
+    end_chapter = models.PositiveIntegerField()
+    summary = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"{self.book.title} - recap level {self.level} (Ch {self.start_chapter}-{self.end_chapter})"
+
+    class Meta:
+        ordering = ['book', 'level', 'index']
+        unique_together = ('book', 'level', 'index')
+
 ROLE_CHOICES = (
     ("protagonist", "protagonist"),
     ("antagonist", "antagonist"),
@@ -82,7 +159,9 @@ class Character(models.Model):
     personality = models.TextField(blank=True, default="")
     appearance = models.TextField(blank=True, default="")
     bio = models.TextField(blank=True, default="")
-    # Store chapter numbers where the character appears
+    # other names used for the character in the book (matched by the mention index)
+    aliases = JSONField(default=list, blank=True)
+    # Store chapter numbers where the character appears (computed from the mention index, see mentions.py)
     chapters_appeared = JSONField(default=list, blank=True)
     image = models.ImageField(upload_to='uploads/characters/', blank=True,null=True)
 
@@ -91,3 +170,162 @@ class Character(models.Model):
 
     def __str__(self):
         return f"{self.name} ({self.book.title})"
+
+
+class CharacterMention(models.Model):
+    """
+    Entry of the character mention index: the paragraphs of one chapter where a character's name
+    or one of its aliases appears. Built at ingestion from chapter text, no LLM involved.
+    """
+    character = models.ForeignKey(Character, on_delete=models.CASCADE, related_name='mentions')
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='character_mentions')
+    # paragraph numbers (1-based, as in Chapter.paragraph_index) with at least one mention
+    paragraphs = JSONField(default=list, blank=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['character', 'chapter__number']
+        unique_together = ('character', 'chapter')
+
+    def __str__(self):
+        return f"{self.character.name} - Ch {self.chapter.number}: {self.count} mentions"
+
+
+class GraphSnapshot(models.Model):
+    """
+    Relationship graph of a book as of one chapter (see graph.py), built at ingestion by the graph stage.
+    A book has one snapshot per chapter.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='graph_snapshots')
+    chapter_number = models.PositiveIntegerField()
+    # {"nodes": [...], "edges": [...]} as returned by the graph endpoint
+    graph = JSONField(default=dict, blank=True)
+    # hash of graph, sent as the ETag of the graph endpoint
+    etag = models.CharField(max_length=40, blank=True, default='')
+
+    class Meta:
+        ordering = ['book', 'chapter_number']
+        unique_together = ('book', 'chapter_number')
+
+    def __str__(self):
+        return f"{self.book.title} - graph at Ch {self.chapter_number}"
+
+
+JOB_STATUS_CHOICES = (
+    ("queued", "queued"),
+    ("running", "running"),
+    ("done", "done"),
+    ("failed", "failed"),
+)
+
+class IngestionJob(models.Model):
+    """
+    Represents one background run of the ingestion pipeline for an uploaded book. A book can have many jobs
+    (e.g a failed run that was queued again), the latest one is reported by the ingest_status endpoint.
+
+    Jobs are created by upload_epub (or reprocess_book) and picked up by the ingest_worker management command.
+    Per stage progress is stored in IngestionStage rows of the book.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    status = models.CharField(max_length=16, choices=JOB_STATUS_CHOICES, default="queued")
+    current_stage = models.CharField(max_length=32, blank=True, default="")
+    # stages to (re)run even if already done. Empty list = resume, run every stage not done yet
+    stages = models.JSONField(default=list, blank=True)
+    # longest chain of dependent stages: {"stages": [...], "seconds": x, "serial_seconds": y, "wall_seconds": z}
+    critical_path = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True, default="")
+    # name of the worker process that claimed the job
+    worker = models.CharField(max_length=100, blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.book.title} - ingestion job {self.id} ({self.status})"
+
+
+
+STAGE_STATUS_CHOICES = (
+    ("pending", "pending"),
+    ("running", "running"),
+    ("done", "done"),
+    ("failed", "failed"),
+)
+
+class IngestionStage(models.Model):
+    """
+    Checkpoint of one ingestion stage (parse, summary, events, ...) for a book. A book has one row per stage.
+
+    Stages marked done are skipped when ingestion is resumed, so a failure in a late stage
+    does not throw away the LLM work of earlier stages.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='ingestion_stages')
+    name = models.CharField(max_length=32)
+    status = models.CharField(max_length=16, choices=STAGE_STATUS_CHOICES, default="pending")
+    # small JSON summary of what the stage produced (counts, names, ...)
+    outputs = models.JSONField(default=dict, blank=True)
+    # duration of the last run in seconds
+    duration = models.FloatField(null=True, blank=True)
+    # LLM tokens used by the last run
+    input_tokens = models.PositiveIntegerField(default=0)
+    output_tokens = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("book", "name")
+
+    def __str__(self):
+        return f"{self.book.title} - stage {self.name} ({self.status})"
+
+
+class SceneJob(models.Model):
+    """
+    Background generation of the scene image of one event, created by the scene endpoint when the image
+    is not on disk yet, or only as a preview (see scene_jobs.py). The frontend polls the scene job endpoint
+    until it is done, showing the preview as soon as there is one.
+    """
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='scene_jobs')
+    chapter_number = models.PositiveIntegerField()
+    event_number = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=JOB_STATUS_CHOICES, default="queued")
+    # MEDIA_URL path of the image once there is one, and its tier: "preview" or "full"
+    image_url = models.CharField(max_length=255, blank=True, default="")
+    tier = models.CharField(max_length=16, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
+    # last sign of life of the worker running the job: set when it starts and after each render
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['book', 'chapter_number', 'event_number'])]
+
+    def __str__(self):
+        return f"{self.book.title} - scene Ch {self.chapter_number} Event {self.event_number} ({self.status})"
+
+
+class SceneImage(models.Model):
+    """
+    Entry of the scene image cache (see scene_cache.py): one generated image, stored under
+    MEDIA/uploads/scenes/<key>.png with its derivatives. Events point to their image by key, several events
+    with the same prompt share one image. Least recently used entries are evicted to stay under the disk quota.
+    """
+    # sha256 of the image model, size and prompt
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=64, blank=True, default='')
+    # bytes on disk: the image and its derivatives
+    size = models.BigIntegerField(default=0)
+    # times the image was served from the cache, and generated (again after an eviction)
+    hits = models.PositiveIntegerField(default=0)
+    generations = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"scene image {self.key[:12]} ({self.size} bytes)"
@@ -0,0 +1,215 @@
+import glob
+import hashlib
+import os
+import re
+from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Event, SceneImage
+
+
+# Scene image cache. Images are content addressed: the key of an image is the sha256 of the image model, size
+# and prompt, the file is MEDIA/uploads/scenes/<key>.png, next to its preview marker and derivatives
+# (<key>.png.preview, <key>_w256.webp, ...). Event.scene_key points an event to its image, so
+#   - events with the same prompt share one image
+#   - re-ingesting a book (new Event rows) cannot serve an image made for another event, the new events
+#     have no key until their prompt is known
+# Every image has a SceneImage row with its size on disk and last access. When the cache grows over
+# SCENE_CACHE_MAX_MB, the least recently used images are evicted: their files are deleted and the row is kept
+# with size 0, so the hit/generation counts survive for the stats (manage.py scene_cache).
+#
+# Scene images stored before the cache are named after their event: scene_<book_id>_<chapter number>_<event
+# number>.png, with their preview marker and derivatives. They are never pruned, manage.py scene_cache
+# --adopt-legacy moves them into the cache (adopt_legacy_scene_images).
+
+LEGACY_SCENE_NAME = re.compile(r"^scene_(\d+)_(\d+)_(\d+)(\.png|\.png\.preview|_w\d+\.\w+)$")
+
+
+def scenes_folder():
+    return os.path.join(settings.MEDIA_ROOT, "uploads", "scenes")
+
+
+def scene_cache_key(prompt, model, size):
+    return hashlib.sha256(f"{model}\n{size}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def scene_file_path(key):
+    """(path on disk, MEDIA_URL path) of the image of a cache key."""
+    filename = f"{key}.png"
+    return os.path.join(scenes_folder(), filename), f"{settings.MEDIA_URL}uploads/scenes/{filename}"
+
+
+def scene_key_files(key):
+    """Files of a cache key on disk: the image, its preview marker and its derivatives."""
+    return glob.glob(os.path.join(scenes_folder(), f"{key}.png*")) + glob.glob(os.path.join(scenes_folder(), f"{key}_w*"))
+
+
+def _files_size(paths):
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def event_scene_key(book_id, chapter_number, event_number):
+    """Cache key of the scene image of an event, "" if it has none yet."""
+    return (
+        Event.objects.filter(chapter__book_id=book_id, chapter__number=chapter_number, number=event_number)
+        .values_list('scene_key', flat=True)
+        .first()
+    ) or ""
+
+
+def set_event_scene_key(book_id, chapter_number, event_number, key):
+    Event.objects.filter(chapter__book_id=book_id, chapter__number=chapter_number, number=event_number).update(scene_key=key)
+
+
+def record_scene_image(key, model, tier="full"):
+    """
+    Index an image just written for a key (size of its files), then enforce the quota.
+    A full render counts as one more generation, its preview does not.
+    """
+    now = timezone.now()
+    image, _ = SceneImage.objects.get_or_create(key=key, defaults={"model": model})
+    image.size = _files_size(scene_key_files(key))
+    if tier == "full":
+        image.generations += 1
+    image.last_accessed = now
+    image.save(update_fields=["size", "generations", "last_accessed"])
+    enforce_scene_quota(keep={key})
+
+
+def touch_scene_image(key):
+    """Count a cache hit on a key and mark it as recently used."""
+    SceneImage.objects.filter(key=key).update(hits=F('hits') + 1, last_accessed=timezone.now())
+
+
+def evict_scene_image(image):
+    """Delete the files of a cache entry, its row is kept with size 0."""
+    for path in scene_key_files(image.key):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    freed = image.size
+    image.size = 0
+    image.save(update_fields=["size"])
+    return freed
+
+
+def enforce_scene_quota(keep=()):
+    """
+    Evict least recently used images until the cache is under SCENE_CACHE_MAX_MB (0 = no limit).
+    Keys in keep are never evicted. Returns (images evicted, bytes freed).
+    """
+    limit = settings.SCENE_CACHE_MAX_MB * 1024 * 1024
+    if not limit:
+        return 0, 0
+    total = SceneImage.objects.aggregate(total=Sum('size'))['total'] or 0
+    evicted = freed = 0
+    if total <= limit:
+        return evicted, freed
+
+    for image in SceneImage.objects.filter(size__gt=0).exclude(key__in=keep).order_by('last_accessed'):
+        if total - freed <= limit:
+            break
+        print(f"[SCENE CACHE] Evicting {image.key} ({image.size} bytes)")
+        freed += evict_scene_image(image)
+        evicted += 1
+    return evicted, freed
+
+
+def adopt_legacy_scene_images(model):
+    """
+    Move the scene images stored before the cache into it. Their prompt is not known, so the key of an image
+    is made from its content; it gets a SceneImage row and the event it was made for points to it.
+    Images of events that are gone (book deleted or re-ingested) are left in place.
+    Returns (images adopted, images left).
+    """
+    folder = scenes_folder()
+    adopted = left = 0
+    for path in sorted(glob.glob(os.path.join(folder, "scene_*.png"))):
+        match = LEGACY_SCENE_NAME.match(os.path.basename(path))
+        if not match or match.group(4) != ".png":
+            continue
+        book_id, chapter_number, event_number = (int(n) for n in match.groups()[:3])
+        event = Event.objects.filter(
+            chapter__book_id=book_id, chapter__number=chapter_number, number=event_number
+        ).first()
+        if event is None:
+            left += 1
+            continue
+
+        with open(path, "rb") as f:
+            key = hashlib.sha256(b"legacy\n" + f.read()).hexdigest()
+        stem = os.path.splitext(path)[0]
+        renames = [(path, os.path.join(folder, f"{key}.png"))]
+        if os.path.exists(f"{path}.preview"):
+            renames.append((f"{path}.preview", os.path.join(folder, f"{key}.png.preview")))
+        for derivative in glob.glob(f"{stem}_w*"):
+            renames.append((derivative, os.path.join(folder, f"{key}{derivative[len(stem):]}")))
+        for source, target in renames:
+            os.replace(source, target)
+
+        SceneImage.objects.update_or_create(
+            key=key,
+            defaults={
+                "model": model,
+                "size": _files_size(target for _, target in renames),
+                "generations": 1,
+                "last_accessed": timezone.now(),
+            },
+        )
+        Event.objects.filter(id=event.id).update(scene_key=key)
+        adopted += 1
+    return adopted, left
+
+
+def scene_cache_stats():
+    """
+    Cache report:
+      - entries / bytes on disk, quota
+      - hits, generations and hit rate (hits / requests, a request being a hit or a generation)
+      - reclaimable bytes: images no event points to, and files in the scenes folder the index does not know
+        (e.g left by a crash)
+      - legacy files: scene images stored before the cache, see adopt_legacy_scene_images. They are
+        reported apart and never reclaimed
+    """
+    images = SceneImage.objects.filter(size__gt=0)
+    totals = SceneImage.objects.aggregate(hits=Sum('hits'), generations=Sum('generations'))
+    hits = totals['hits'] or 0
+    generations = totals['generations'] or 0
+
+    used_keys = set(Event.objects.exclude(scene_key='').values_list('scene_key', flat=True))
+    orphans = [image for image in images if image.key not in used_keys]
+
+    known = {image.key for image in SceneImage.objects.all()}
+    untracked, legacy = [], []
+    for path in glob.glob(os.path.join(scenes_folder(), "*")):
+        name = os.path.basename(path)
+        # leases and temporary files of generations in flight
+        if name.endswith((".lease", ".tmp")):
+            continue
+        if LEGACY_SCENE_NAME.match(name):
+            legacy.append(path)
+        elif name.split(".")[0].split("_w")[0] not in known:
+            untracked.append(path)
+
+    return {
+        "entries": images.count(),
+        "bytes": images.aggregate(total=Sum('size'))['total'] or 0,
+        "quota_bytes": settings.SCENE_CACHE_MAX_MB * 1024 * 1024,
+        "hits": hits,
+        "generations": generations,
+        "hit_rate": hits / (hits + generations) if hits + generations else 0.0,
+        "orphans": orphans,
+        "orphan_bytes": sum(image.size for image in orphans),
+        "untracked": untracked,
+        "untracked_bytes": _files_size(untracked),
+        "legacy": legacy,
+        "legacy_bytes": _files_size(legacy),
+    }
@@ -0,0 +1,117 @@
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import SceneJob
+from .llm_modules.image_gen import generate_scene_image, scene_image_tier
+
+
+# Scene images requested by a reader and not on disk yet are generated in the background:
+# the scene endpoint creates a SceneJob and answers 202 right away, the job runs on a pool of
+# SCENE_JOB_MAX_WORKERS threads in the server process, and the frontend polls the scene job endpoint
+# until the job is done (image_url) or failed (error).
+#
+# With SCENE_PROGRESSIVE, a job first renders a low quality preview (a few seconds) and publishes it in
+# image_url with tier "preview" while still running, then renders the full image over it and is done.
+# A scene found on disk as a preview only gets a job that does the full render.
+#
+# A reader asking again for a scene being generated gets the job already in flight. Jobs are not persisted
+# across restarts of the server, an unfinished job is considered abandoned and replaced by a new one when:
+#   - it is running and its worker gave no sign of life (heartbeat_at) for SCENE_LEASE_SECONDS
+#   - it is queued, older than SCENE_LEASE_SECONDS and not waiting in the pool of this process
+# Time spent waiting in the pool does not count: a busy pool does not make its queued jobs abandoned.
+
+_pool = None
+_lock = threading.Lock()
+# ids of the jobs submitted to the pool of this process and not started yet
+_queued = set()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=settings.SCENE_JOB_MAX_WORKERS, thread_name_prefix="scene-job")
+    return _pool
+
+
+def start_scene_job(book, chapter_number, event_number):
+    """Unfinished scene job of an event, or a new one queued on the worker pool."""
+    active = SceneJob.objects.filter(
+        book=book, chapter_number=chapter_number, event_number=event_number, status__in=["queued", "running"]
+    ).order_by('-created_at')
+    abandoned_before = timezone.now() - datetime.timedelta(seconds=settings.SCENE_LEASE_SECONDS)
+    for job in active:
+        if not _is_abandoned(job, abandoned_before):
+            return job
+        job.status = "failed"
+        job.error = "Abandoned"
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "error", "finished_at"])
+
+    job = SceneJob.objects.create(book=book, chapter_number=chapter_number, event_number=event_number)
+    with _lock:
+        _queued.add(job.id)
+    _executor().submit(run_scene_job, job.id)
+    return job
+
+
+def _is_abandoned(job, before):
+    if job.status == "queued":
+        with _lock:
+            if job.id in _queued:
+                return False
+        return job.created_at < before
+    return (job.heartbeat_at or job.created_at) < before
+
+
+def run_scene_job(job_id):
+    """Generate the image of a scene job (preview first if progressive) and record the result in the job."""
+    try:
+        with _lock:
+            _queued.discard(job_id)
+        # a job replaced while it was waiting (e.g queued by a process that was restarted) is not run
+        if not SceneJob.objects.filter(id=job_id, status="queued").update(status="running", heartbeat_at=timezone.now()):
+            return
+        job = SceneJob.objects.get(id=job_id)
+        key = (job.book_id, job.chapter_number, job.event_number)
+        try:
+            if settings.SCENE_PROGRESSIVE:
+                job.image_url = generate_scene_image(*key, tier="preview")
+                job.tier = scene_image_tier(*key)
+                job.heartbeat_at = timezone.now()
+                job.save(update_fields=["image_url", "tier", "heartbeat_at"])
+            job.image_url = generate_scene_image(*key, tier="full")
+            job.tier = "full"
+            job.status = "done"
+        except Exception as e:
+            print(f"[SCENE JOB] Job {job_id} failed:", repr(e))
+            traceback.print_exc()
+            job.status = "failed"
+            job.error = repr(e)
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "image_url", "tier", "error", "finished_at"])
+    finally:
+        # pool threads open their own DB connection
+        connections.close_all()
+
+
+def scene_image_url(url, tier):
+    """URL of a scene image with its tier in the query string, so browsers do not keep showing the preview."""
+    return f"{url}?tier={tier}" if url and tier else url
+
+
+def scene_job_status(job):
+    """Serializable status of a scene job, used by the scene and scene job endpoints."""
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "chapter": job.chapter_number,
+        "event": job.event_number,
+        "image_url": scene_image_url(job.image_url, job.tier),
+        "tier": job.tier,
+        "error": job.error,
+    }
@@ -0,0 +1,94 @@
+import datetime
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+
+from .models import Event
+from .llm_modules.image_gen import generate_or_get_scene_image, scene_image_tier
+
+
+# Scene image prefetcher: when a reader opens a chapter (get_chapter) or moves their reading position
+# (set_last_chapter), the scene images of the next SCENE_PREFETCH_EVENTS events from that chapter on are
+# generated in the background, so get_scene finds them on disk instead of waiting for the image model.
+#
+#   - at most SCENE_PREFETCH_MAX_WORKERS images are generated at the same time, for all books and readers
+#   - an event already queued or already on disk is not queued again
+#   - at most SCENE_PREFETCH_DAILY_BUDGET prefetches are started per day (0 = no limit). Scenes requested
+#     by get_scene are always generated, the budget only caps speculative work
+# State is kept in the server process: each process has its own pool and budget.
+
+_lock = threading.Lock()
+_pool = None
+# (book_id, chapter number, event number) of the scenes queued or being generated
+_queued = set()
+# [day, number of prefetches started that day]
+_budget = [None, 0]
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=settings.SCENE_PREFETCH_MAX_WORKERS, thread_name_prefix="scene-prefetch")
+    return _pool
+
+
+def _take_budget():
+    """Count one prefetch against today`s budget, False if it is used up. Call with _lock held."""
+    today = datetime.date.today()
+    if _budget[0] != today:
+        _budget[0], _budget[1] = today, 0
+    limit = settings.SCENE_PREFETCH_DAILY_BUDGET
+    if limit and _budget[1] >= limit:
+        return False
+    _budget[1] += 1
+    return True
+
+
+def upcoming_events(book_id, chapter_number, count):
+    """(chapter number, event number) of the first `count` events of a book from a chapter on, in reading order."""
+    return list(
+        Event.objects.filter(chapter__book_id=book_id, chapter__number__gte=chapter_number)
+        .order_by('chapter__number', 'number')
+        .values_list('chapter__number', 'number')[:count]
+    )
+
+
+def _generate(key):
+    try:
+        generate_or_get_scene_image(*key)
+    except Exception as e:
+        print("[SCENE PREFETCH] Error while prefetching scene", key, repr(e))
+        traceback.print_exc()
+    finally:
+        with _lock:
+            _queued.discard(key)
+        # pool threads open their own DB connection
+        connections.close_all()
+
+
+def prefetch_scenes(book_id, chapter_number, count=None):
+    """
+    Queue generation of the scene images of the next `count` events (default SCENE_PREFETCH_EVENTS)
+    of a book, from a chapter on. Returns immediately with the number of scenes queued.
+    """
+    count = settings.SCENE_PREFETCH_EVENTS if count is None else count
+    if count <= 0:
+        return 0
+
+    queued = 0
+    for chapter, number in upcoming_events(book_id, chapter_number, count):
+        key = (book_id, chapter, number)
+        if scene_image_tier(*key) == "full":
+            continue
+        with _lock:
+            if key in _queued:
+                continue
+            if not _take_budget():
+                print(f"[SCENE PREFETCH] Daily budget of {settings.SCENE_PREFETCH_DAILY_BUDGET} scenes reached")
+                break
+            _queued.add(key)
+        _executor().submit(_generate, key)
+        queued += 1
+    return queued
@@ -1,3 +1,566 @@
-from django.test import TestCase
+import base64
+import datetime
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from bs4 import BeautifulSoup
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+from langchain_core.messages import AIMessage
+from PIL import Image
+
+from .chapter_text import normalize_chapter, paragraph_range_offsets, paragraph_range_text, render_event_anchors
+from . import ingestion
+from .llm_modules import event_extractor, image_gen, summarizer, tokens
+from .llm_modules.character_extractor import CharacterCandidate, merge_character_candidates
+from .llm_modules.event_extractor import (ChapterEvents, ChapterEventsBatch, EventInfo, EventList, batch_event_lists,
+                                          plan_event_requests, window_event_list)
+from .llm_modules.fanout import fan_out
+from .llm_modules.singleflight import single_flight
+from .llm_modules.usage import record_usage, track_usage
+from .models import Book, Chapter, Event, IngestionJob, IngestionStage, SceneImage
+from .scene_cache import (adopt_legacy_scene_images, enforce_scene_quota, record_scene_image, scene_cache_stats,
+                          scene_file_path, scenes_folder)
+
+
+def candidate(name, aliases=(), mentions=1):
+    return CharacterCandidate(
+        name=name, aliases=list(aliases), mentions=mentions,
+        gender=" ", age=" ", appearance=" ", personality=" ", actions=" ",
+    )
+
+
+class MergeCharacterCandidatesTests(TestCase):
+    def merged_names(self, chapter_candidates):
+        return sorted(
+            sorted([c["name"], *c["aliases"]]) for c in merge_character_candidates(chapter_candidates)
+        )
+
+    def test_titles_keep_the_bennets_apart(self):
+        chapters = [
+            {"chapter": 1, "candidates": [candidate("Mr. Bennet", ["Bennet"]), candidate("Mrs. Bennet", ["Bennet"])]},
+            {"chapter": 2, "candidates": [candidate("Miss Bennet", ["Jane"]), candidate("Bennet")]},
+        ]
+        self.assertEqual(
+            self.merged_names(chapters),
+            [["Bennet"], ["Bennet", "Mr. Bennet"], ["Bennet", "Mrs. Bennet"], ["Jane", "Miss Bennet"]],
+        )
+
+    def test_same_name_in_several_chapters_is_merged(self):
+        chapters = [
+            {"chapter": 3, "candidates": [candidate("Mr. Darcy", mentions=4)]},
+            {"chapter": 1, "candidates": [candidate("mr darcy", mentions=2)]},
+        ]
+        merged = merge_character_candidates(chapters)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0]["mentions"], 6)
+        self.assertEqual(merged[0]["chapters"], [1, 3])
+
+    def test_short_name_claimed_once_is_merged(self):
+        chapters = [
+            {"chapter": 1, "candidates": [candidate("Mr. Fitzwilliam Darcy", mentions=5)]},
+            {"chapter": 2, "candidates": [candidate("Darcy", mentions=3), candidate("Elizabeth Bennet", ["Lizzy"])]},
+            {"chapter": 3, "candidates": [candidate("Lizzy")]},
+        ]
+        merged = merge_character_candidates(chapters)
+        self.assertEqual(
+            sorted((c["name"], c["mentions"]) for c in merged),
+            [("Elizabeth Bennet", 2), ("Mr. Fitzwilliam Darcy", 8)],
+        )
+
+    def test_shared_alias_does_not_chain_characters(self):
+        chapters = [
+            {"chapter": 1, "candidates": [candidate("Jane Bennet", ["Miss Bennet"]), candidate("Elizabeth Bennet", ["Miss Bennet"])]},
+            {"chapter": 2, "candidates": [candidate("Miss Bennet")]},
+        ]
+        self.assertEqual(len(merge_character_candidates(chapters)), 3)
+
+
+def words(count):
+    return " ".join(["word"] * count)
+
+
+def event(last_paragraph):
+    return EventInfo(event_label="label", event_summary="summary", last_paragraph=last_paragraph)
+
+
+# one token per word, no tiktoken download
+@mock.patch.object(event_extractor, "count_tokens", lambda text, model=None: len(text.split()))
+@mock.patch.object(event_extractor, "PARAGRAPH_OVERHEAD_TOKENS", 0)
+class PlanEventRequestsTests(TestCase):
+    def test_small_chapters_are_batched_up_to_the_batch_size(self):
+        chapters = [(i, "T", [words(40)]) for i in range(1, 6)]
+        requests = plan_event_requests(chapters, batch_tokens=100, window_tokens=1000)
+        self.assertEqual([r["kind"] for r in requests], ["batch", "batch", "chapter"])
+        self.assertEqual([c[0] for c in requests[0]["chapters"]], [1, 2])
+        self.assertEqual(requests[2]["chapter"][0], 5)
+
+    def test_ordinary_chapter_is_one_request_and_keeps_order(self):
+        chapters = [(1, "T", [words(10)]), (2, "T", [words(500)]), (3, "T", [words(10)])]
+        requests = plan_event_requests(chapters, batch_tokens=100, window_tokens=1000)
+        self.assertEqual([(r["kind"], r["chapter"][0]) for r in requests], [("chapter", 1), ("chapter", 2), ("chapter", 3)])
+
+    def test_chapter_over_the_window_size_is_split_on_paragraphs(self):
+        chapter = (1, "T", [words(300)] * 7)
+        requests = plan_event_requests([chapter], batch_tokens=100, window_tokens=1000)
+        self.assertEqual([(r["first"], r["last"], r["part"], r["parts"]) for r in requests], [(1, 3, 1, 3), (4, 6, 2, 3), (7, 7, 3, 3)])
+
+
+def word_tail(text, max_tokens, model=None):
+    return " ".join(text.split()[-max_tokens:]) if max_tokens > 0 else ""
+
+
+class FakeLLM:
+    """Chat model answering every digest request with the same text."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+
+    def invoke(self, messages):
+        self.calls += 1
+        return mock.Mock(content=self.answer)
+
+
+@mock.patch.object(summarizer, "count_tokens", lambda text, model=None: len(text.split()))
+@mock.patch.object(summarizer, "tail_tokens", word_tail)
+class FitContextTests(TestCase):
+    def context_tokens(self, digests, recent):
+        return len(summarizer._rolling_context(digests, recent).split())
+
+    def test_under_budget_is_left_alone(self):
+        llm = FakeLLM(words(10))
+        self.assertEqual(summarizer._fit_context(llm, "T", [], [words(20)], 100, 3), ([], [words(20)]))
+        self.assertEqual(llm.calls, 0)
+
+    def test_older_summaries_are_compressed_into_a_digest(self):
+        recent = [words(30)] * 5
+        digests, recent = summarizer._fit_context(FakeLLM(words(10)), "T", [], recent, 100, 2)
+        self.assertEqual((len(digests), len(recent)), (1, 2))
+        self.assertLessEqual(self.context_tokens(digests, recent), 100)
+
+    def test_recent_summaries_over_budget_are_compressed_too(self):
+        # no more summaries than keep_recent, but they do not fit
+        digests, recent = summarizer._fit_context(FakeLLM(words(10)), "T", [], [words(60), words(60)], 100, 3)
+        self.assertEqual(recent, [words(60)])
+        self.assertLessEqual(self.context_tokens(digests, recent), 100)
+
+    def test_long_digest_and_latest_summary_are_cut(self):
+        # the model ignores the digest length, and the latest summary alone is over budget
+        digests, recent = summarizer._fit_context(FakeLLM(words(80)), "T", [words(40)], [words(150)], 100, 3)
+        self.assertLessEqual(self.context_tokens(digests, recent), 100)
+        self.assertTrue(recent[0])
+
+
+class EventRemappingTests(TestCase):
+    def test_window_paragraphs_are_mapped_to_chapter_paragraphs(self):
+        events = window_event_list(EventList(events=[event(4), event(2), event(9)]), first=11, last=18)
+        # sorted, offset by 10, clamped to the window, the last event closes the window
+        self.assertEqual([e.last_paragraph for e in events.events], [12, 14, 18])
+
+    def test_window_last_event_is_closed_on_the_window(self):
+        events = window_event_list(EventList(events=[event(0), event(3)]), first=5, last=12)
+        self.assertEqual([e.last_paragraph for e in events.events], [5, 12])
+
+    def test_batch_answer_is_mapped_by_chapter_key(self):
+        chapters = [(31, "A", []), (32, "B", []), (33, "C", [])]
+        batch = ChapterEventsBatch(chapters=[
+            ChapterEvents(chapter_key=3, events=[event(2)]),
+            ChapterEvents(chapter_key=1, events=[event(1), event(4)]),
+        ])
+        lists = batch_event_lists(batch, chapters)
+        self.assertEqual(sorted(lists), [31, 33])
+        self.assertEqual([e.last_paragraph for e in lists[31].events], [1, 4])
+        self.assertEqual([e.last_paragraph for e in lists[33].events], [2])
+
+
+def parsed_chapter(html):
+    content, text, paragraph_index = normalize_chapter(BeautifulSoup(html, "html.parser"))
+    return Chapter(number=1, title="Chapter", content=content, text=text, paragraph_index=paragraph_index)
+
+
+class ChapterOffsetsTests(TestCase):
+    def setUp(self):
+        self.chapter = parsed_chapter("<h1>Title</h1><p>One.</p><div><p>Two <i>it</i>.</p></div><p>Three.</p>")
+
+    def test_paragraph_ranges(self):
+        self.assertEqual(paragraph_range_text(self.chapter, 2, 2), "Two it.")
+        self.assertEqual(paragraph_range_text(self.chapter, 2, 3), "Two it.Three.")
+
+    def test_first_range_starts_at_the_chapter_start_and_last_goes_to_its_end(self):
+        # the heading before the first paragraph belongs to the first event
+        self.assertEqual(paragraph_range_offsets(self.chapter, 1, 1), (0, len("TitleOne.")))
+        self.assertEqual(paragraph_range_offsets(self.chapter, 3, 99), (len("TitleOne.Two it."), len(self.chapter.text)))
+
+    def test_empty_chapter_is_one_range(self):
+        chapter = parsed_chapter("<div>No paragraphs</div>")
+        self.assertEqual(paragraph_range_offsets(chapter, 1, 4), (0, len("No paragraphs")))
+
+    def test_anchors_are_rendered_at_the_end_of_the_last_paragraph_of_events(self):
+        events = [Event(number=2, start_index=3), Event(number=1, start_index=1)]
+        self.assertEqual(
+            render_event_anchors(self.chapter, events),
+            '<h1>Title</h1><p>One.<div id="ev1"></div></p><div><p>Two <i>it</i>.</p></div><p>Three.<div id="ev2"></div></p>',
+        )
+        # anchors are not stored
+        self.assertNotIn("ev1", self.chapter.content)
+
+    def test_every_chapter_endpoint_renders_the_anchors(self):
+        book = Book.objects.create(title="Book", last_chapter_visited=1)
+        self.chapter.book, self.chapter.number = book, 1
+        self.chapter.save()
+        Event.objects.create(chapter=self.chapter, number=1, start_index=1)
+        for url in (f"/api/books/{book.id}/chapters/1/", f"/api/books/{book.id}/last_chapter", f"/api/books/{book.id}/chapters/"):
+            with mock.patch("books.views.prefetch_scenes"):
+                data = self.client.get(url).json()
+            chapter = data[0] if isinstance(data, list) else data
+            self.assertIn('<div id="ev1"></div>', chapter["content"], url)
+            self.assertEqual([a["event"] for a in chapter["anchors"]], [1], url)
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.target = os.path.join(folder.name, "image.png")
+        self.lease = f"{self.target}.lease"
+        self.calls = 0
+
+    def produce(self):
+        self.calls += 1
+        time.sleep(0.05)
+        with open(self.target, "wb") as f:
+            f.write(b"image")
+
+    def test_concurrent_callers_produce_once(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight(self.target, self.produce))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [True] * 5)
+        self.assertFalse(os.path.exists(self.lease))
+
+    def test_waits_for_the_lease_of_another_process(self):
+        open(self.lease, "w").close()
+
+        def other_process_finishes():
+            time.sleep(0.1)
+            with open(self.target, "wb") as f:
+                f.write(b"image")
+            os.remove(self.lease)
+
+        thread = threading.Thread(target=other_process_finishes)
+        thread.start()
+        self.assertTrue(single_flight(self.target, self.produce, stale_after=60, poll_interval=0.01))
+        thread.join()
+        self.assertEqual(self.calls, 0)
+
+    def test_stale_lease_is_taken_over(self):
+        open(self.lease, "w").close()
+        old = time.time() - 120
+        os.utime(self.lease, (old, old))
+        self.assertTrue(single_flight(self.target, self.produce, stale_after=60, poll_interval=0.01))
+        self.assertEqual(self.calls, 1)
+        self.assertFalse(os.path.exists(self.lease))
+
+    def test_failed_produce_raises_and_releases_the_lease(self):
+        def fail():
+            raise RuntimeError("image model down")
+
+        with self.assertRaises(RuntimeError):
+            single_flight(self.target, fail)
+        self.assertFalse(os.path.exists(self.lease))
+        self.assertTrue(single_flight(self.target, self.produce))
+        self.assertEqual(self.calls, 1)
+
+
+def png_b64():
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class SceneImageTierTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name, SCENE_CACHE_MAX_MB=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.book = Book.objects.create(title="Book", scene_context_version="v1")
+        chapter = Chapter.objects.create(book=self.book, number=1, title="Chapter", text="")
+        Event.objects.create(chapter=chapter, number=1, start_index=1, scene_prompt="A castle at dawn", scene_prompt_version="v1")
+
+        self.client = mock.Mock()
+        self.client.images.generate.return_value = mock.Mock(data=[mock.Mock(b64_json=png_b64())])
+        for name, value in [("OpenAI", mock.Mock(return_value=self.client)), ("record_usage", mock.Mock()),
+                            ("build_derivatives", mock.Mock()), ("describe_scene", mock.Mock(side_effect=AssertionError))]:
+            patcher = mock.patch.object(image_gen, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def qualities(self):
+        return [call.kwargs["quality"] for call in self.client.images.generate.call_args_list]
+
+    def test_preview_is_upgraded_to_full_under_the_same_key(self):
+        preview_url = image_gen.generate_scene_image(self.book.id, 1, 1, tier="preview")
+        self.assertEqual(image_gen.scene_image_tier(self.book.id, 1, 1), "preview")
+        # a preview is enough for a preview request
+        image_gen.generate_scene_image(self.book.id, 1, 1, tier="preview")
+        self.assertEqual(self.qualities(), ["low"])
+
+        # the book context changed since: the full render still uses the prompt of its preview
+        Book.objects.filter(id=self.book.id).update(scene_context_version="v2")
+        full_url = image_gen.generate_scene_image(self.book.id, 1, 1, tier="full")
+        self.assertEqual(full_url, preview_url)
+        self.assertEqual(self.qualities(), ["low", "medium"])
+        self.assertEqual(image_gen.scene_image_tier(self.book.id, 1, 1), "full")
+        self.assertFalse(os.path.exists(f"{image_gen.scene_image_path(self.book.id, 1, 1)[0]}.preview"))
+
+        # a full image is served from the cache, for both tiers
+        image_gen.generate_scene_image(self.book.id, 1, 1, tier="full")
+        image_gen.generate_scene_image(self.book.id, 1, 1, tier="preview")
+        self.assertEqual(self.qualities(), ["low", "medium"])
+        self.assertEqual(SceneImage.objects.get().generations, 1)
+
+
+@override_settings(SCENE_CACHE_MAX_MB=1)
+class SceneQuotaTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(scenes_folder())
+
+    def add_image(self, key, minutes_ago, size=400 * 1024):
+        with open(scene_file_path(key)[0], "wb") as f:
+            f.write(b"0" * size)
+        SceneImage.objects.create(
+            key=key, size=size, last_accessed=timezone.now() - datetime.timedelta(minutes=minutes_ago)
+        )
+
+    def on_disk(self):
+        return sorted(SceneImage.objects.filter(size__gt=0).values_list("key", flat=True))
+
+    def test_least_recently_used_images_are_evicted_down_to_the_quota(self):
+        for key, minutes_ago in [("a", 40), ("b", 30), ("c", 20), ("d", 10)]:
+            self.add_image(key, minutes_ago)
+        self.assertEqual(enforce_scene_quota(), (2, 800 * 1024))
+        self.assertEqual(self.on_disk(), ["c", "d"])
+        self.assertFalse(os.path.exists(scene_file_path("a")[0]))
+        self.assertTrue(os.path.exists(scene_file_path("c")[0]))
+
+    def test_kept_keys_are_never_evicted(self):
+        for key, minutes_ago in [("a", 40), ("b", 30), ("c", 20), ("d", 10)]:
+            self.add_image(key, minutes_ago)
+        enforce_scene_quota(keep={"a"})
+        self.assertEqual(self.on_disk(), ["a", "d"])
+
+    def test_under_the_quota_nothing_is_evicted(self):
+        self.add_image("a", 10)
+        self.add_image("b", 20)
+        self.assertEqual(enforce_scene_quota(), (0, 0))
+        self.assertEqual(self.on_disk(), ["a", "b"])
+
+    def test_recording_an_image_evicts_the_oldest_over_the_quota(self):
+        self.add_image("old", 30)
+        self.add_image("older", 40)
+        with open(scene_file_path("new")[0], "wb") as f:
+            f.write(b"0" * 400 * 1024)
+        record_scene_image("new", "gpt-image-1")
+        self.assertEqual(self.on_disk(), ["new", "old"])
+        self.assertEqual(SceneImage.objects.get(key="new").generations, 1)
+
+    def write_legacy(self, name):
+        path = os.path.join(scenes_folder(), name)
+        with open(path, "wb") as f:
+            f.write(b"legacy image")
+        return path
+
+    def test_legacy_images_are_reported_apart_from_untracked_files(self):
+        legacy = [self.write_legacy(name) for name in ("scene_1_2_3.png", "scene_1_2_3.png.preview", "scene_1_2_3_w256.webp")]
+        crash = self.write_legacy("deadbeef.png")
+        stats = scene_cache_stats()
+        self.assertEqual(sorted(stats["legacy"]), sorted(legacy))
+        self.assertEqual(stats["untracked"], [crash])
+
+    def test_legacy_images_of_existing_events_are_adopted(self):
+        book = Book.objects.create(title="Book")
+        chapter = Chapter.objects.create(book=book, number=2, title="Two", content="<p>One.</p>")
+        Event.objects.create(chapter=chapter, number=3, summary="Event", start_index=1)
+        self.write_legacy(f"scene_{book.id}_2_3.png")
+        self.write_legacy(f"scene_{book.id}_2_3_w256.webp")
+        gone = self.write_legacy(f"scene_{book.id}_2_4.png")
+
+        self.assertEqual(adopt_legacy_scene_images("gpt-image-1"), (1, 1))
+        key = Event.objects.get(chapter=chapter, number=3).scene_key
+        self.assertTrue(os.path.exists(scene_file_path(key)[0]))
+        self.assertTrue(os.path.exists(os.path.join(scenes_folder(), f"{key}_w256.webp")))
+        self.assertEqual(SceneImage.objects.get(key=key).size, 2 * len(b"legacy image"))
+        self.assertEqual(scene_cache_stats()["legacy"], [gone])
+
+
+class EventsStageTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(title="Book")
+        self.chapters = []
+        for number in (1, 2):
+            chapter = parsed_chapter("<p>One.</p><p>Two.</p>")
+            chapter.book, chapter.number = self.book, number
+            chapter.save()
+            self.chapters.append(chapter)
+
+    def answer(self, chapter, error=""):
+        events = None if error else EventList(events=[event(1), event(2)])
+        return {"chapter_id": chapter.id, "event_list": events, "error": error}
+
+    def run_events_stage(self, answers):
+        with mock.patch.object(ingestion, "extract_events", return_value=answers) as extract:
+            try:
+                ingestion.run_stage(self.book, "events", ingestion.stage_events)
+            except ingestion.StageIncomplete:
+                pass
+        return extract, IngestionStage.objects.get(book=self.book, name="events")
+
+    def test_failed_chapter_fails_the_stage_and_is_retried_alone(self):
+        first, second = self.chapters
+        extract, stage = self.run_events_stage([self.answer(first), self.answer(second, error="RateLimitError()")])
+        self.assertEqual(extract.call_args.kwargs["chapter_ids"], None)
+        self.assertEqual(stage.status, "failed")
+        self.assertEqual(stage.outputs["failed_chapters"], [second.id])
+        self.assertEqual(Event.objects.filter(chapter=first).count(), 2)
+        self.assertEqual(Event.objects.filter(chapter=second).count(), 0)
+
+        # resuming only extracts the failed chapter and keeps the events of the others
+        extract, stage = self.run_events_stage([self.answer(second)])
+        self.assertEqual(extract.call_args.kwargs["chapter_ids"], [second.id])
+        self.assertEqual(stage.status, "done")
+        self.assertEqual(stage.outputs["failed_chapters"], [])
+        self.assertEqual(Event.objects.filter(chapter__book=self.book).count(), 4)
+
+    def test_requested_rerun_extracts_every_chapter(self):
+        first, second = self.chapters
+        self.run_events_stage([self.answer(first), self.answer(second, error="RateLimitError()")])
+        ingestion.enqueue_ingestion(self.book, stages=["events"])
+        extract, stage = self.run_events_stage([self.answer(first), self.answer(second)])
+        self.assertEqual(extract.call_args.kwargs["chapter_ids"], None)
+        self.assertEqual(Event.objects.filter(chapter__book=self.book).count(), 4)
+
+
+class BookListTests(TestCase):
+    def test_books_report_the_status_of_their_latest_ingestion_job(self):
+        ready, running, failed, legacy = (Book.objects.create(title=title) for title in ("ready", "running", "failed", "legacy"))
+        IngestionJob.objects.create(book=ready, status="failed", created_at=timezone.now() - datetime.timedelta(hours=1))
+        IngestionJob.objects.create(book=ready, status="done")
+        IngestionJob.objects.create(book=running, status="running")
+        IngestionJob.objects.create(book=failed, status="failed")
+        statuses = {book["title"]: book["ingest_status"] for book in self.client.get("/api/books/").json()}
+        # books ingested before background jobs have no job
+        self.assertEqual(statuses, {"ready": "done", "running": "running", "failed": "failed", "legacy": "done"})
+
+
+class FanOutTests(TestCase):
+    def test_results_are_in_input_order(self):
+        def slow_square(n):
+            # later items finish first
+            time.sleep(0.01 * (5 - n))
+            return n * n
+
+        self.assertEqual(fan_out(slow_square, range(5), max_workers=5), [(n * n, None) for n in range(5)])
+
+    def test_errors_are_returned_per_item(self):
+        def invert(n):
+            return 1 / n
+
+        results = fan_out(invert, [1, 0, 2], max_workers=3)
+        self.assertEqual([r for r, _ in results], [1.0, None, 0.5])
+        self.assertIsInstance(results[1][1], ZeroDivisionError)
+        self.assertEqual([e for _, e in results[::2]], [None, None])
+
+    def test_one_worker_runs_in_the_calling_thread(self):
+        results = fan_out(lambda _: threading.current_thread(), [1, 2], max_workers=1)
+        self.assertEqual([r for r, _ in results], [threading.current_thread()] * 2)
+
+    def test_at_most_max_workers_calls_are_in_flight(self):
+        lock, in_flight, peak = threading.Lock(), [0], [0]
+
+        def call(_):
+            with lock:
+                in_flight[0] += 1
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+
+        fan_out(call, range(8), max_workers=3)
+        self.assertLessEqual(peak[0], 3)
+
+
+class UsageTests(TestCase):
+    def openai_response(self, input_tokens, output_tokens):
+        return mock.Mock(usage=mock.Mock(input_tokens=input_tokens, output_tokens=output_tokens))
+
+    def chat_model(self, input_tokens, output_tokens):
+        message = AIMessage(
+            content="answer",
+            usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+            response_metadata={"model_name": "fake"},
+        )
+        return FakeMessagesListChatModel(responses=[message])
+
+    def test_usage_outside_of_a_scope_is_ignored(self):
+        record_usage(self.openai_response(10, 5))
+        with track_usage() as usage:
+            pass
+        self.assertEqual((usage.input_tokens, usage.output_tokens), (0, 0))
+
+    def test_client_and_chat_model_usage_is_counted(self):
+        with track_usage() as usage:
+            record_usage(self.openai_response(10, 5))
+            record_usage(mock.Mock(usage=mock.Mock(input_tokens=None, output_tokens=None, prompt_tokens=3, completion_tokens=1)))
+            self.chat_model(7, 2).invoke("question")
+        self.assertEqual((usage.input_tokens, usage.output_tokens), (20, 8))
+
+    def test_usage_of_fan_out_workers_is_counted_in_the_caller_scope(self):
+        def call(n):
+            record_usage(self.openai_response(n, 1))
+            self.chat_model(n, 1).invoke("question")
+            return threading.current_thread()
+
+        with track_usage() as usage:
+            results = fan_out(call, range(1, 7), max_workers=3)
+        self.assertTrue(any(thread is not threading.current_thread() for thread, _ in results))
+        self.assertEqual((usage.input_tokens, usage.output_tokens), (2 * 21, 12))
+
+
+class FakeEncoding:
+    """One token per word."""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@mock.patch.object(tokens, "_encoding", lambda model: FakeEncoding())
+class TokenHelperTests(TestCase):
+    def test_count_tokens(self):
+        self.assertEqual(tokens.count_tokens(words(12)), 12)
+        self.assertEqual(tokens.count_tokens(""), 0)
+
+    def test_tail_tokens_keeps_the_end_of_the_text(self):
+        self.assertEqual(tokens.tail_tokens("one two three four", 2), "three four")
+        self.assertEqual(tokens.tail_tokens("one two", 5), "one two")
+        self.assertEqual(tokens.tail_tokens("one two", 0), "")
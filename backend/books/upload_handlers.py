@@ -0,0 +1,32 @@
+import hashlib
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Upload handler that computes the sha256 digest of uploaded files while they stream in.
+
+    It must be inserted first in request.upload_handlers (before request.FILES is accessed).
+    Every chunk is hashed and then passed on unchanged to the next handler, which still
+    builds the actual uploaded file (memory or temporary file), so the file is only read once.
+
+    After parsing, digests maps each form field name to the hex digest of its file.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = {}
+        self._hasher = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self._hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name] = self._hasher.hexdigest()
+        # returning None lets the next handler return the file object
+        return None
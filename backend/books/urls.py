@@ -4,15 +4,19 @@ from .views import *
 
 urlpatterns = [
     path('books/upload/', upload_epub, name='upload_epub'),
+    path('books/<int:book_id>/ingest_status/', get_ingest_status, name='get_ingest_status'),
     path('books/', get_books, name='get_books'),
     path('books/<int:book_id>/chapters/', get_all_chapters, name='get_all_chapters'),
     path('books/<int:book_id>/chapters/<int:chapter_id>/', get_chapter),
     path('books/summary/<int:book_id>/<int:chapter_id>/', get_summary),
+    path('books/<int:book_id>/recap/<int:chapter_id>/', get_book_recap),
     path('books/<int:book_id>/last_chapter', get_last_chapter),
     path('books/<int:book_id>/set_last/<int:chapter_num>/', set_last_chapter),
     path('books/query/<int:book_id>/<str:query>/', query_book),
     path('books/<int:book_id>/characters/', get_characters ),
+    path('books/<int:book_id>/appearances/<str:name>/', get_character_appearances),
     path('books/<int:book_id>/chapters/<int:chapter_id>/scene/<int:event_number>/',get_scene),
+    path('books/<int:book_id>/scene_jobs/<int:job_id>/', get_scene_job),
     path("books/<int:book_id>/graph/", get_book_relationship_graph),
 
 ]
@@ -3,7 +3,9 @@ from django.conf import settings
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .models import Book,Chapter,Event
+from django.db import transaction
+from .models import Book,Chapter,ChapterSummary,Event,RecapNode
+from django.db.models import Q
 
 from bs4 import BeautifulSoup
 from django.utils.html import strip_tags
@@ -12,23 +14,27 @@ from .serializers import CharacterSerializer
 
 #import  llm moduless
 from books.llm_modules.summarizer import *
+from books.llm_modules.recap import recap_node_keys
 
 # import model for character object
 from .models import Character as CharacterModel
+from .chapter_text import paragraph_range_offsets, remove_event_placeholders
 
 
 
-def save_characters_to_db(book, character_list):
+def save_characters_to_db(book, character_list, generate_images=True):
     """
     Saves extracted characters to DB and optionally generates a portrait image.
 
     Inputs:
       - book: Book object
       - character_list: list of generated character objects
+      - generate_images: if False, portraits are left to the ingestion portraits stage
 
     For each character:
       - get_or_create new character into DB 
       - store  field attributes  with  fallbacks (role, age, personality, etc.)
+      - refresh the aliases of a character that already exists (they feed the mention index)
       - generate an image if the row was just created or the row exists but has no image yet
     """
     #imported inside to avoid circular import error
@@ -45,100 +51,173 @@ def save_characters_to_db(book, character_list):
                 "personality": ci.personality or "",
                 "appearance": ci.appearance or "",
                 "bio": ci.bio or "",
+                "aliases": ci.aliases or [],
                 "chapters_appeared": ci.chapters_appeared or [],
             },
         )
-        if created or not character.image:
+        if not created and character.aliases != (ci.aliases or []):
+            character.aliases = ci.aliases or []
+            character.save(update_fields=["aliases"])
+        if generate_images and (created or not character.image):
             generate_character_image(character)
 
 def save_events_to_db(book, event_list):
     """
-    Saves extracted events to DB AND edits chapter HTML to insert placeholders.
+    Saves extracted events to DB.
 
     Inputs:
       - book: Book object
       - event_list: list of events for every chapter 
       
+    Chapters whose event extraction failed (event_list None) are skipped.
     For each chapter:
-      - fetch the Chapter row by its DB id
       - enumerate events (index starts at 1 per chapter)
-      - edit the chapter HTML to add a placeholder div at the event anchor paragraph
-      - create an Event row (chapter, number, start_index, summary, label)
+      - build an Event row (chapter, number, start_index, summary, label) with the offsets of
+        its text in the chapter text: from the paragraph after the previous event to its last paragraph
+    Chapter HTML is not modified, event anchors are rendered when the chapter is served.
+    All events are written with one bulk_create.
     """
 
+    chapter_ids = [c["chapter_id"] for c in event_list if c["event_list"] is not None]
+    chapters = Chapter.objects.filter(book=book).in_bulk(chapter_ids)
+
+    new_events = []
     for chapter_events in event_list:
-        index=0
-        ch = Chapter.objects.get(book=book, id=chapter_events["chapter_id"])
-
-        for ev in chapter_events["event_list"].events:
-            
-            index+=1
-            edit_chapter(ch,ev,index)
-            Event.objects.create(
-            chapter = ch,
-            number=index,
-            start_index=ev.last_paragraph,
-            summary=ev.event_summary,  
-            label=ev.event_label
-        )
+        if chapter_events["event_list"] is None:
+            continue
+        ch = chapters[chapter_events["chapter_id"]]
+
+        first_paragraph = 1
+        for index, ev in enumerate(chapter_events["event_list"].events, start=1):
+            text_start, text_end = paragraph_range_offsets(ch, first_paragraph, ev.last_paragraph)
+            new_events.append(Event(
+                chapter=ch,
+                number=index,
+                start_index=ev.last_paragraph,
+                text_start=text_start,
+                text_end=text_end,
+                summary=ev.event_summary,
+                label=ev.event_label,
+            ))
+            first_paragraph = ev.last_paragraph + 1
+
+    with transaction.atomic():
+        Event.objects.bulk_create(new_events, batch_size=500)
+
+
+def clear_events(book, chapter_ids=None):
+    """
+    Removes all events of a book (or of the chapters in chapter_ids), and the event placeholders that
+    chapters stored before event anchors were rendered at serve time.
+    """
+    chapters = Chapter.objects.filter(book=book)
+    if chapter_ids is not None:
+        chapters = chapters.filter(id__in=chapter_ids)
+    Event.objects.filter(chapter__in=chapters).delete()
+    for ch in chapters.filter(content__contains="PLACEHOLDER FOR IMAGE"):
+        if remove_event_placeholders(ch):
+            ch.save(update_fields=["content", "paragraph_index"])
 
 
+def save_chapter_summaries(book, chapter_summaries):
+    """
+    Saves the chapter summaries of a book (output of summarize_all_chapters) to DB.
 
-def edit_chapter(chapter,event,event_index):
+    Inputs:
+      - book: Book object
+      - chapter_summaries: [{"chapter": chapter number, "summary": text}], in chapter order
+    Previous summaries of the book are replaced. Each row also gets the cumulative story so far.
     """
-    Inserts an HTML placeholder into a chapter at the paragraph indicated by event.last_paragraph.
-    Currently all paragraphs in chapter have paragraph number. This number is used to identify pointers for event scenes.
-    Once anchors for event are added, extra paragraph index are removed.This  lets the frontend  locate event anchors and swap for scene image generation
+    rows = []
+    story = []
+    for item in chapter_summaries:
+        summary = item["summary"].strip()
+        story.append(summary)
+        rows.append(ChapterSummary(
+            book=book,
+            chapter_number=item["chapter"],
+            summary=summary,
+            story_so_far="\n\n".join(story),
+        ))
 
-    - append a div placeholder inside the target <p>:
-        <div id="ev{event_index}">PLACEHOLDER FOR IMAGE {event_index}</div>
+    with transaction.atomic():
+        ChapterSummary.objects.filter(book=book).delete()
+        ChapterSummary.objects.bulk_create(rows)
 
-    """
-    event_position=event.last_paragraph
-    soup = BeautifulSoup(chapter.content, 'html.parser')
-    p_tags = soup.find_all("p")
-    total = len(p_tags)
-    if total == 0:
-        print("No <p> tags in this chapter, skipping event.")
-        print("*********************")
-        return
-    if event_position < 1:
-        print("Invalid last_paragraph (<1), skipping.")
-        print("*********************")
-        return
-    
-    if event_position > total:        
-        event_position = total
-    
-    p_tag =p_tags[event_position - 1]
-    div = soup.new_tag("div", id=f"ev{event_index}")
-    div.string = f"PLACEHOLDER FOR IMAGE {event_index}"
-    p_tag.append(div)
-    chapter.content=str(soup)
-    chapter.save()
-    
 
 def get_chapter_summary(book_id, chapter_id):
     """
-    Returns a "summary up to this chapter" text. Just truncates the full text summary (which was already generasted during upload time) up to current chapter
+    Returns a "summary up to this chapter" text: the story so far of the last summarized chapter
+    at or before chapter_id (precomputed at upload time, one indexed lookup).
     """
-
-    book = Book.objects.get(id=book_id)
-    full_summary=book.summary
-    paragraphs = [p.strip() for p in full_summary.split("\n\n") if p.strip()]
-
     try:
         chapter_index = int(chapter_id)
     except ValueError:
         return ""
 
+    story_so_far = (
+        ChapterSummary.objects
+        .filter(book_id=book_id, chapter_number__lte=chapter_index)
+        .order_by('-chapter_number')
+        .values_list('story_so_far', flat=True)
+        .first()
+    )
+    return story_so_far or ""
+
+
+def save_recap_tree(book, nodes):
+    """
+    Saves the recap tree of a book (output of build_recap_tree) to DB, replacing the previous one.
+    """
+    rows = [RecapNode(book=book, **node) for node in nodes]
+    with transaction.atomic():
+        RecapNode.objects.filter(book=book).delete()
+        RecapNode.objects.bulk_create(rows)
 
-    if chapter_index <= 1:
-        previous_paragraphs = []  
-    else:
-        previous_paragraphs = paragraphs[: chapter_index - 1]
 
-    return "\n\n".join(previous_paragraphs)
+def get_recap_nodes(book_id, chapter_id):
+    """
+    Returns the recap tree nodes covering the story up to chapter_id, in story order.
+    At most RECAP_BRANCHING - 1 nodes per tree level: the size of the recap grows with log(chapters).
+    """
+    try:
+        chapter_index = int(chapter_id)
+    except ValueError:
+        return []
+
+    summaries = ChapterSummary.objects.filter(book_id=book_id)
+    total = summaries.count()
+    covered = summaries.filter(chapter_number__lte=chapter_index).count()
+    keys = recap_node_keys(covered, total, settings.RECAP_BRANCHING)
+    if not keys:
+        return []
+
+    query = Q()
+    for level, index in keys:
+        query |= Q(level=level, index=index)
+    nodes = {(n.level, n.index): n for n in RecapNode.objects.filter(query, book_id=book_id)}
+    # books ingested before the recap tree existed (or with a tree built with another branching)
+    if len(nodes) != len(keys):
+        return []
+    return [nodes[key] for key in keys]
+
+
+def get_recap(book_id, chapter_id):
+    """
+    Returns a compact "story so far" text at chapter_id, assembled from the recap tree.
+    Falls back to the full summary up to this chapter when the book has no recap tree.
+    """
+    nodes = get_recap_nodes(book_id, chapter_id)
+    if not nodes:
+        return get_chapter_summary(book_id, chapter_id)
+
+    parts = []
+    for node in nodes:
+        if node.start_chapter == node.end_chapter:
+            parts.append(f"Chapter {node.start_chapter}:\n{node.summary}")
+        else:
+            parts.append(f"Chapters {node.start_chapter}-{node.end_chapter}:\n{node.summary}")
+    return "\n\n".join(parts)
 
     
 
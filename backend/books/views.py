@@ -1,9 +1,11 @@
 import os
+import hashlib
 from django.conf import settings
+from django.db.models import OuterRef, Prefetch, Subquery
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .models import Book,Chapter,Character
+from .models import Book,Chapter,Character,Event,GraphSnapshot,IngestionJob,SceneJob,SUMMARY_MODE_CHOICES
 from ebooklib import epub
 from bs4 import BeautifulSoup
 import ebooklib
@@ -24,6 +26,17 @@ from books.llm_modules.metadata_extractor import *
 
 # importing utility functions
 from .utils import *
+from .ingestion import enqueue_ingestion, ingestion_status
+from .upload_handlers import HashingUploadHandler
+from .mentions import character_appearances, find_character
+from .scene_prefetch import prefetch_scenes
+from .scene_jobs import scene_image_url, scene_job_status, start_scene_job
+from .image_derivatives import file_srcset, image_srcset
+from .scene_cache import touch_scene_image
+from .cooccurrence import pair_key
+from .chapter_text import render_event_anchors
+from .graph import graph_etag, relationship_graph, stored_layout, with_layout
+from django.utils.http import parse_etags
 
 
 
@@ -33,114 +46,82 @@ def upload_epub(request):
     POST /api/books/upload (example)
 
     Main frontend endpoint:
-    1) Saves the uploaded EPUB as a Book row.
-    2) Reads EPUB metadata (title/author) and stores it.
-    3) Extracts a cover image (if found) into MEDIA/uploads/covers/.
-    4) Extracts each document item as a Chapter (HTML content).
-    5) Runs LLM modules :
-       - summarize_all_chapters
-       - get_book_metadata (tags, synopsis, MoodList, etc.)
-       - character extraction + relationship extraction
-       - event extraction + save to DB
-       - load_book() to build / refresh vector embeddings for RAG
-    6) Store generated information as book attributes
-    Returns the created book id.
+    1) Hashes the uploaded EPUB while it streams in (sha256).
+    2) If a book with the same content hash is already in the library, returns that book
+       instead of creating a new one, so none of the LLM stages run again (200).
+    3) Otherwise saves the uploaded EPUB as a Book row and queues an ingestion job
+       for the book and returns right away (202).
+
+    The ingestion job is run by a worker process (python manage.py ingest_worker) which:
+       - reads EPUB metadata, cover image and chapters
+       - runs LLM modules (summary, metadata, characters, relationships, events)
+       - runs load_book() to build / refresh vector embeddings for RAG
+    Progress can be polled on GET /api/books/<book_id>/ingest_status/.
+    Optional form field summary_mode: "iterative" (default) or "map_reduce" (see llm_modules/summarizer.py).
+    Returns the new or existing book id and its job id.
 
     """
 
+    # must be registered before request.FILES is first accessed
+    hasher = HashingUploadHandler(request)
+    request.upload_handlers.insert(0, hasher)
+
     file = request.FILES.get('file')
     if not file:
         return Response({'error': 'No file uploaded'}, status=status.HTTP_400_BAD_REQUEST)
-    
-     # Create Book row in DB
-    book = Book.objects.create(title=file.name.replace('.epub', ''), epub_file=file)
-    epub_book = epub.read_epub(book.epub_file.path)
-    title = epub_book.get_metadata('DC', 'title')
-    author = epub_book.get_metadata('DC', 'creator')
-    book.title = title[0][0] if title else book.title
-    book.author = author[0][0] if author else ''
-    book.save()
-
-    # Extract book cover image if possible
-    for item in epub_book.get_items_of_type(ebooklib.ITEM_IMAGE):
-        if 'cover' in item.get_name().lower():
-            # save to MEDIA ROOT folder
-            cover_folder = os.path.join(settings.MEDIA_ROOT, 'uploads', 'covers')
-            os.makedirs(cover_folder, exist_ok=True)
-
-            cover_path = os.path.join(cover_folder, f'cover_{book.id}.jpg')
-            with open(cover_path, 'wb') as f:
-                f.write(item.get_content())
-
-            book.cover_image = f'uploads/covers/cover_{book.id}.jpg'
-            book.save()
-            break
-
-    # Extract chapters from all HTML/XHTML document items
-    chapter_num = 1
-    for item in epub_book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-        soup = BeautifulSoup(item.get_body_content(), features="lxml")
-        if soup is None:
-            soup = BeautifulSoup(item.get_body_content(), "html.parser")
-
-
-        for tag in soup(["script", "style"]):
-            tag.decompose()
-
-        body = soup.body
-        content_html = "".join(str(child) for child in body.contents) if body else str(soup)
-
-        
-        title_tag = soup.find(["h1", "h2"])
-        chapter_title = title_tag.get_text(strip=True) if title_tag else f"Chapter {chapter_num}"
-
-        #create chapter objects in DB
-        Chapter.objects.create(
-            book=book,
-            number=chapter_num,
-            title=chapter_title,
-            content=content_html,  
+    summary_mode = request.data.get('summary_mode') or 'iterative'
+    if summary_mode not in dict(SUMMARY_MODE_CHOICES):
+        return Response({'error': f'Unknown summary_mode {summary_mode}'}, status=status.HTTP_400_BAD_REQUEST)
+    content_hash = hasher.digests.get('file', '')
+
+    # Same EPUB already uploaded: link to the existing book and its artifacts
+    existing = Book.objects.filter(content_hash=content_hash).order_by('created_at').first() if content_hash else None
+    if existing is not None:
+        job = existing.ingestion_jobs.order_by('-created_at').first()
+        # a previous failed ingestion is retried instead of being served as is
+        if job is None or job.status == "failed":
+            job = enqueue_ingestion(existing)
+        return Response(
+            {
+                "message": "Book already in library",
+                "book_id": existing.id,
+                "job_id": job.id,
+                "duplicate": True,
+                "status_url": request.build_absolute_uri(f"/api/books/{existing.id}/ingest_status/"),
+            },
+            status=status.HTTP_200_OK
         )
-        chapter_num += 1
-        
-    #LLM call to text summarizer module    
-    book.summary=summarize_all_chapters(book.id)
-    book.save()
-    #LLM call to metadata extractor module  
-    book.inferred_metadata=get_book_metadata(book.id).model_dump()
-    book.save()
-
-    #LLM call to character extractor module  
-    result = set_characters(book.id)  
-    
-    # save character objects to DB   
-    if isinstance(result, CharacterList):
-            save_characters_to_db(book, result)
-            character_names = [c.name for c in result.Characters]
-    else:
-            character_names = []
-    
-    #LLM call to character extractor module (extract relationships) 
-    book.relationships = set_character_relationships(book.id).model_dump()
-    book.save()
-
-    #character_grid(3,[c.image.path for c in Character.objects.filter(book=book) if c.image])
-
-    #LLM call to character extractor module (extract relationships) 
-    all_events= extract_events(book.id)
-    save_events_to_db(book, all_events)
-
-    #Build embeddings for RAG querying (Chroma)
-    load_book(book.id) 
 
+     # Create Book row in DB
+    book = Book.objects.create(title=file.name.replace('.epub', ''), epub_file=file, content_hash=content_hash, summary_mode=summary_mode)
+    job = enqueue_ingestion(book)
 
     return Response(
             {
-                "message": "Book uploaded successfully",
-                "book_id": book.id,          
+                "message": "Book uploaded successfully, processing started",
+                "book_id": book.id,
+                "job_id": job.id,
+                "duplicate": False,
+                "status_url": request.build_absolute_uri(f"/api/books/{book.id}/ingest_status/"),
             },
-            status=status.HTTP_201_CREATED
+            status=status.HTTP_202_ACCEPTED
         )
+
+
+@api_view(['GET'])
+def get_ingest_status(request, book_id):
+    """
+    GET /api/books/<book_id>/ingest_status/
+
+    Reports progress of the latest ingestion job of a book:
+      - job status (queued/running/done/failed) and current stage
+      - per stage status, timestamps, duration and error message
+    """
+    job = IngestionJob.objects.filter(book_id=book_id).order_by('-created_at').first()
+    if job is None:
+        return Response({'error': 'No ingestion job found for this book'}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(ingestion_status(job), status=status.HTTP_200_OK)
             
 
 @api_view(['GET'])
@@ -151,11 +132,15 @@ def get_books(request):
     Returns a list of book attritutes for homescreen display 
     Includes:
       - basic Book fields
-      - absolute cover image URL for the frontend
+      - absolute cover image URL for the frontend, and cover_srcset: srcset map of its WebP/AVIF derivatives
       - inferred tags + synopsis (with fallbacks if metadata missing)
+      - ingest_status: status of the latest ingestion job of the book (queued / running / done / failed).
+        Only "done" books can be opened, the others are shown as processing or failed.
+        Books ingested before background jobs have no job and are "done".
     """
 
-    books = Book.objects.all()
+    latest_job = IngestionJob.objects.filter(book=OuterRef('pk')).order_by('-created_at')
+    books = Book.objects.annotate(ingest_status=Subquery(latest_job.values('status')[:1]))
     data = []
     for book in books:
         inferred = book.inferred_metadata or {}
@@ -165,16 +150,42 @@ def get_books(request):
             'author': book.author,
             'created_at': book.created_at,
             'cover_image': request.build_absolute_uri(book.cover_image.url) if book.cover_image else None,
+            'cover_srcset': file_srcset(book.cover_image, request),
             'tags':inferred.get("main_genre") or ["Adventure","Historical"],
             'synopsis':inferred.get("synopsis") or "Summary TBD",
+            'ingest_status': book.ingest_status or "done",
         })
     return Response(data)
 
+def event_anchors(events):
+    """Anchors of the events of a chapter: event number, label, last paragraph and text offsets."""
+    return [
+        {
+            'event': e.number,
+            'label': e.label,
+            'paragraph': e.start_index,
+            'text_start': e.text_start,
+            'text_end': e.text_end,
+        }
+        for e in events
+    ]
+
+
 #endpoint testing
 @api_view(['GET'])
 def get_all_chapters(request, book_id):
-    chapters = Chapter.objects.filter(book_id=book_id).values('number', 'title', 'content')
-    return Response(list(chapters))
+    chapters = Chapter.objects.filter(book_id=book_id).prefetch_related(
+        Prefetch('events', queryset=Event.objects.order_by('number'))
+    )
+    return Response([
+        {
+            'number': chapter.number,
+            'title': chapter.title,
+            'content': render_event_anchors(chapter, chapter.events.all()),
+            'anchors': event_anchors(chapter.events.all()),
+        }
+        for chapter in chapters
+    ])
 
 
 @api_view(['GET'])
@@ -184,6 +195,9 @@ def get_chapter(request, book_id, chapter_id):
 
     Returns a single chapter plus book header info and a “music mood” field
     taken from inferred_metadata['MoodList'][chapter_id]['mood'].
+    content has an empty <div id="ev{n}"> anchor at the end of every event, anchors lists the events
+    with their last paragraph and the offsets of their text in the chapter text.
+    Scene images of the next events are prefetched in the background (see scene_prefetch.py).
     """
 
     try:
@@ -200,13 +214,20 @@ def get_chapter(request, book_id, chapter_id):
         print("Error while getting music:", repr(e)) 
         music = "dark"
 
+    # event anchors are rendered into the chapter HTML here, they are not stored in it
+    events = list(Event.objects.filter(chapter=chapter).order_by('number'))
+
+    # scene images of the events the reader is about to reach are generated in the background
+    prefetch_scenes(book.id, chapter.number)
+
     return Response({
         'id': book.id,
         'title': book.title,          
         'author': book.author,       
         'chapter_number': chapter.number,
         'chapter_title': chapter.title,
-        'content': chapter.content, 
+        'content': render_event_anchors(chapter, events), 
+        'anchors': event_anchors(events),
         'music':music, 
     })
 
@@ -217,7 +238,7 @@ def set_last_chapter(request, book_id, chapter_num):
     """
     POST /api/books/<book_id>/last_chapter/<chapter_num>/
 
-    sets pointer to last chapter read.
+    sets pointer to last chapter read, and starts prefetching the scene images ahead of it.
     """
     try:
         book = Book.objects.get(id=book_id)
@@ -226,6 +247,7 @@ def set_last_chapter(request, book_id, chapter_num):
 
     book.last_chapter_visited = chapter_num
     book.save()
+    prefetch_scenes(book.id, chapter_num)
     return Response({'message': f'Last chapter set to {chapter_num} for {book.title}'}, status=status.HTTP_200_OK)
 
 
@@ -235,7 +257,7 @@ def get_last_chapter(request, book_id):
     """
     GET /api/books/<book_id>/last_chapter/
 
-    Returns the last chapter read
+    Returns the last chapter read, with its event anchors as in get_chapter
     """
 
     try:
@@ -244,13 +266,15 @@ def get_last_chapter(request, book_id):
     except (Book.DoesNotExist, Chapter.DoesNotExist):
         return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
 
+    events = list(Event.objects.filter(chapter=chapter).order_by('number'))
     return Response({
         'id': book.id,
         'title': book.title,
         'author': book.author,
         'chapter_number': chapter.number,
         'chapter_title': chapter.title,
-        'content': chapter.content,
+        'content': render_event_anchors(chapter, events),
+        'anchors': event_anchors(events),
     })
 
 
@@ -269,44 +293,119 @@ def get_summary(request,book_id, chapter_id):
         status=status.HTTP_200_OK,
     )
    
+@api_view(['GET'])
+def get_book_recap(request, book_id, chapter_id):
+    """
+    GET /api/books/<int:book_id>/recap/<int:chapter_id>/
+
+    Returns a compact recap of the story up to this chapter, assembled from the recap tree
+    (a few arc summaries and the latest chapter summaries instead of every chapter summary):
+      - recap: text
+      - nodes: [{level, start_chapter, end_chapter}] recap tree nodes used, in story order
+    """
+    if not Book.objects.filter(id=book_id).exists():
+        return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    nodes = get_recap_nodes(book_id, chapter_id)
+    return Response(
+        {
+            "chapter": chapter_id,
+            "recap": get_recap(book_id, chapter_id),
+            "nodes": [
+                {"level": n.level, "start_chapter": n.start_chapter, "end_chapter": n.end_chapter}
+                for n in nodes
+            ],
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
+@api_view(['GET'])
+def get_character_appearances(request, book_id, name):
+    """
+    GET /api/books/<int:book_id>/appearances/<str:name>/
+
+    Where does a character appear: chapters and paragraphs mentioning the character (by name or alias),
+    read from the mention index built at ingestion. No LLM call.
+    """
+    character = find_character(book_id, name)
+    if character is None:
+        return Response({'error': 'Character not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    appearances = character_appearances(character)
+    return Response(
+        {
+            "character": character.name,
+            "aliases": character.aliases,
+            "total_mentions": sum(a["count"] for a in appearances),
+            "chapters": appearances,
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
 @api_view(["GET"])
 def get_book_relationship_graph(request, book_id):
     """
-    GET /api/books/<int:book_id>/graph/
+    GET /api/books/<int:book_id>/graph/[?upto=<chapter>]
 
-    Converts stored relationship data into a graph structure:
-      - nodes: [{id, label}]
-      - edges: [{id, source, target, label}]
+    Returns the character relationship graph:
+      - nodes: [{id, label, x, y}]
+      - edges: [{id, source, target, label, weight, first_chapter}]
     For frontend graph visualization library format.
+    x, y are precomputed node coordinates (force-directed layout of the whole book graph computed by the
+    graph ingestion stage, see graph.py), nodes have none until that stage ran.
+    weight is the number of paragraphs where both characters are mentioned and first_chapter the first
+    chapter where it happens (from the book co-occurrence, 0 / null when the pair never co-occurs).
+
+    With upto, only what a reader of that chapter knows about (graph snapshot of the chapter, built at
+    ingestion). Without it, the graph of the whole book.
+    Responses carry an ETag: a request with a matching If-None-Match gets an empty 304.
     """
+    upto = request.query_params.get("upto")
+    if upto is not None:
+        try:
+            upto = int(upto)
+        except ValueError:
+            return Response({"error": "upto must be a chapter number"}, status=status.HTTP_400_BAD_REQUEST)
+
     try:
-        book = Book.objects.get(id=book_id)
+        book = Book.objects.only("relationships", "cooccurrence", "graph_layout").get(id=book_id)
     except Book.DoesNotExist:
         return Response({"error": "Book not found"}, status=status.HTTP_404_NOT_FOUND)
-    rlist = (book.relationships or {}).get("relationships", [])
-
-    names = set()
-    for r in rlist:
-        s = r.get("source")
-        t = r.get("target")
-        if s: names.add(s)
-        if t: names.add(t)
-
-    nodes = [{"id": n, "label": n} for n in sorted(names)]
-
-    edges = []
-    for i, r in enumerate(rlist):
-        s, t = r.get("source"), r.get("target")
-        if not s or not t:
-            continue
-        edges.append({
-            "id": f"{s}-{t}-{i}",
-            "source": s,
-            "target": t,
-            "label": r.get("label", ""),
-        })
 
-    return Response({"nodes": nodes, "edges": edges}, status=status.HTTP_200_OK)
+    snapshots = GraphSnapshot.objects.filter(book=book).only("graph", "etag")
+    if upto is not None:
+        snapshots = snapshots.filter(chapter_number__lte=upto)
+    snapshot = snapshots.order_by("-chapter_number").first()
+
+    if snapshot is not None:
+        graph, etag = snapshot.graph, snapshot.etag
+    else:
+        if upto is not None and GraphSnapshot.objects.filter(book=book).exists():
+            # before the first chapter
+            graph = relationship_graph([], {})
+        else:
+            # books ingested before graph snapshots existed
+            cooccurrence = {pair_key(p["source"], p["target"]): p for p in (book.cooccurrence or {}).get("pairs", [])}
+            graph = relationship_graph((book.relationships or {}).get("relationships", []), cooccurrence)
+        etag = graph_etag(graph)
+
+    # node coordinates stored by the graph stage, this endpoint only reads them
+    positions, layout_version = stored_layout(book)
+    graph = with_layout(graph, positions)
+    etag = hashlib.sha1(f"{etag}:{layout_version}".encode("utf-8")).hexdigest()
+
+    quoted_etag = f'"{etag}"'
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if quoted_etag in if_none_match or "*" in if_none_match:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(graph, status=status.HTTP_200_OK)
+    response["ETag"] = quoted_etag
+    # clients may keep the graph but must check it is still current
+    response["Cache-Control"] = "no-cache"
+    return response
 
     
 
@@ -315,10 +414,13 @@ def get_scene(request,book_id,chapter_id,event_number):
     """
     GET /api/books/<int:book_id>/chapters/<int:chapter_id>/scene/<int:event_number>/
 
-    Generates (or retrieves cached) scene image for a given event.
-    Response contains:
-      - image_url (absolute)
-      - caption (event label)
+    Returns the scene image of a given event, never waits for image generation:
+      - full image already generated: 200 with image_url (absolute), caption (event label), tier "full"
+        and srcset (WebP/AVIF derivatives)
+      - only the preview generated (progressive scene images): 200 with the preview, tier "preview", and
+        the scene job rendering the full image with its status_url
+      - otherwise: 202 with the scene job generating it (see scene_jobs.py) and status_url,
+        the scene job endpoint to poll until the image is ready
     """
 
     try:
@@ -335,11 +437,53 @@ def get_scene(request,book_id,chapter_id,event_number):
     except Event.DoesNotExist:
         return Response({'error': 'Event not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    sceneURL=generate_or_get_scene_image(book_id,chapter_id,event_number)
-    data={
-            'image_url': request.build_absolute_uri(sceneURL),
-            'caption': event.label,               
-        }
+    scenePath, sceneURL = scene_image_path(book_id, chapter_id, event_number)
+    tier = scene_image_tier(book_id, chapter_id, event_number)
+    if tier is not None:
+        touch_scene_image(event.scene_key)
+    if tier == "full":
+        data={
+                'status': 'done',
+                'tier': tier,
+                'image_url': request.build_absolute_uri(scene_image_url(sceneURL, tier)),
+                'srcset': image_srcset(scenePath, scene_image_url(sceneURL, tier), request),
+                'caption': event.label,               
+            }
+        return Response(data)
+
+    job = start_scene_job(book, chapter_id, event_number)
+    data = scene_job_status(job)
+    data['caption'] = event.label
+    data['status_url'] = request.build_absolute_uri(f"/api/books/{book_id}/scene_jobs/{job.id}/")
+    if tier == "preview":
+        data['tier'] = tier
+        data['image_url'] = request.build_absolute_uri(scene_image_url(sceneURL, tier))
+        return Response(data)
+    return Response(data, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+def get_scene_job(request, book_id, job_id):
+    """
+    GET /api/books/<int:book_id>/scene_jobs/<int:job_id>/
+
+    Status of a scene image job: queued/running/done/failed.
+    image_url is the absolute URL of the image as soon as there is one, tier tells whether it is the
+    preview or the full render, srcset lists the derivatives of the full render. Once failed, error holds the reason.
+    """
+    try:
+        job = SceneJob.objects.get(id=job_id, book_id=book_id)
+    except SceneJob.DoesNotExist:
+        return Response({'error': 'Scene job not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    data = scene_job_status(job)
+    if data['image_url']:
+        data['image_url'] = request.build_absolute_uri(data['image_url'])
+    if job.tier == "full":
+        scenePath, sceneURL = scene_image_path(job.book_id, job.chapter_number, job.event_number)
+        data['srcset'] = image_srcset(scenePath, scene_image_url(sceneURL, job.tier), request)
+    event = Event.objects.filter(chapter__book_id=book_id, chapter__number=job.chapter_number, number=job.event_number).first()
+    data['caption'] = event.label if event else ''
     return Response(data)
 
 @api_view(['GET'])
@@ -360,9 +504,13 @@ def get_characters(request, book_id=None):
 
     """
     GET /api/books/<book_id>/characters/
-    Returns all extracted characters for a book using CharacterSerializer.
+    Returns all extracted characters for a book using CharacterSerializer,
+    plus image_srcset: srcset map of the WebP/AVIF derivatives of the portrait (absolute URLs).
     """
 
     characters = Character.objects.filter(book_id=book_id)
     serializer = CharacterSerializer(characters, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
\ No newline at end of file
+    data = serializer.data
+    for item, character in zip(data, characters):
+        item['image_srcset'] = file_srcset(character.image, request)
+    return Response(data, status=status.HTTP_200_OK)
\ No newline at end of file
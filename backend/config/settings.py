@@ -92,6 +92,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # ingestion stages write from several threads, wait for the SQLite write lock instead of failing
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -142,3 +144,77 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+
+# LLM pipeline settings
+
+# Max number of ingestion stages (summary, events, embeddings, ...) running at the same time for a book
+INGESTION_STAGE_WORKERS = int(os.getenv("INGESTION_STAGE_WORKERS", "4"))
+
+# Token budget of the running summary sent with each chapter by summarize_all_chapters (0 = no limit,
+# send every previous summary). Older summaries are compressed into digests to stay under it.
+SUMMARY_CONTEXT_TOKEN_BUDGET = int(os.getenv("SUMMARY_CONTEXT_TOKEN_BUDGET", "8000"))
+# Number of most recent chapter summaries always kept verbatim in that context
+SUMMARY_RECENT_CHAPTERS = int(os.getenv("SUMMARY_RECENT_CHAPTERS", "5"))
+
+# Map-reduce summary mode (Book.summary_mode = "map_reduce"): chapters summarized at the same time, each with
+# the last SUMMARY_LOOKBACK_TOKENS tokens of the previous chapter as context, then stitched
+# SUMMARY_STITCH_BATCH summaries per call
+SUMMARY_MAX_WORKERS = int(os.getenv("SUMMARY_MAX_WORKERS", "8"))
+SUMMARY_LOOKBACK_TOKENS = int(os.getenv("SUMMARY_LOOKBACK_TOKENS", "400"))
+SUMMARY_STITCH_BATCH = int(os.getenv("SUMMARY_STITCH_BATCH", "10"))
+
+# Recap tree (see books.llm_modules.recap): number of nodes condensed into one node of the level above,
+# and max length in words of a condensed node. Books keep the tree built at ingestion: rerun their
+# recap stage after changing RECAP_BRANCHING (reprocess_book <id> --stages recap)
+RECAP_BRANCHING = int(os.getenv("RECAP_BRANCHING", "4"))
+RECAP_NODE_WORDS = int(os.getenv("RECAP_NODE_WORDS", "150"))
+# Max number of recap nodes condensed at the same time
+RECAP_MAX_WORKERS = int(os.getenv("RECAP_MAX_WORKERS", "4"))
+
+# Max number of chapter requests extract_events keeps in flight at the same time (1 = sequential)
+EVENT_EXTRACTION_MAX_WORKERS = int(os.getenv("EVENT_EXTRACTION_MAX_WORKERS", "8"))
+# Size in tokens up to which extract_events packs consecutive small chapters into one request
+EVENT_BATCH_TOKENS = int(os.getenv("EVENT_BATCH_TOKENS", "6000"))
+# Max size in tokens of the chapter text of one extract_events request, larger chapters are split into windows
+# of paragraphs. 0 = what fits in the context window of the event model (see books.llm_modules.event_extractor)
+EVENT_WINDOW_TOKENS = int(os.getenv("EVENT_WINDOW_TOKENS", "0"))
+
+# Max number of chapters whose characters are extracted at the same time
+CHARACTER_EXTRACTION_MAX_WORKERS = int(os.getenv("CHARACTER_EXTRACTION_MAX_WORKERS", "8"))
+# Number of top ranked merged characters sent to the final character pick
+CHARACTER_CANDIDATES_FOR_PICK = int(os.getenv("CHARACTER_CANDIDATES_FOR_PICK", "15"))
+
+# Number of most co-occurring character pairs the relationships stage asks the LLM to label
+RELATIONSHIP_TOP_PAIRS = int(os.getenv("RELATIONSHIP_TOP_PAIRS", "15"))
+
+# Max number of character portraits generated at the same time
+PORTRAIT_MAX_WORKERS = int(os.getenv("PORTRAIT_MAX_WORKERS", "4"))
+
+# Max number of chapters whose scene image prompts are written at the same time (scene_prompts stage)
+SCENE_PROMPT_MAX_WORKERS = int(os.getenv("SCENE_PROMPT_MAX_WORKERS", "8"))
+
+# Max number of scene images requested by readers generated at the same time (see books.scene_jobs)
+SCENE_JOB_MAX_WORKERS = int(os.getenv("SCENE_JOB_MAX_WORKERS", "4"))
+# Progressive scene images: a low quality preview is rendered and served first, then replaced by the full render
+SCENE_PROGRESSIVE = os.getenv("SCENE_PROGRESSIVE", "1") == "1"
+
+# Scene image prefetch (see books.scene_prefetch): number of events ahead of the reader whose scene images are
+# generated in the background (0 = no prefetch), max number generated at the same time, and max number of
+# prefetches started per day (0 = no limit)
+SCENE_PREFETCH_EVENTS = int(os.getenv("SCENE_PREFETCH_EVENTS", "3"))
+SCENE_PREFETCH_MAX_WORKERS = int(os.getenv("SCENE_PREFETCH_MAX_WORKERS", "2"))
+SCENE_PREFETCH_DAILY_BUDGET = int(os.getenv("SCENE_PREFETCH_DAILY_BUDGET", "100"))
+# Disk quota of the scene image cache in MB (0 = no limit), least recently used images are evicted
+# to stay under it (see books.scene_cache)
+SCENE_CACHE_MAX_MB = int(os.getenv("SCENE_CACHE_MAX_MB", "2048"))
+
+# Widths and formats of the smaller copies written next to covers, portraits and scene images
+# (see books.image_derivatives). Formats the Pillow build cannot encode are skipped
+IMAGE_DERIVATIVE_WIDTHS = [int(w) for w in os.getenv("IMAGE_DERIVATIVE_WIDTHS", "256,512,768").split(",")]
+IMAGE_DERIVATIVE_FORMATS = os.getenv("IMAGE_DERIVATIVE_FORMATS", "avif,webp").split(",")
+
+# Age in seconds after which the lease of a scene image being generated is considered left behind by a
+# crashed process, and another caller takes over the generation (see books.llm_modules.singleflight).
+# Scene jobs left unfinished for longer are considered abandoned and replaced
+SCENE_LEASE_SECONDS = int(os.getenv("SCENE_LEASE_SECONDS", "300"))
+
@@ -259,7 +259,7 @@ export default function BookPage() {
             <div className="relative z-0 flex items-center justify-center">
               {/*relationship graph component*/}
 
-              <RelationshipGraph bookId={selectedBook.id} />
+              <RelationshipGraph bookId={selectedBook.id} chapterId={Number(chapter)} />
             </div>
           </div>
         </div>
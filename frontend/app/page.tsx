@@ -34,9 +34,10 @@ export default function Home() {
     fetchAllBooks();
   }, []);
 
-  // most recent books
-  const lastBook = AllBooks?.[AllBooks.length - 1] ?? null;
-  const LastTwo = AllBooks?.slice(-2) ?? [];
+  // most recent books that finished processing (ingest_status "done")
+  const readyBooks = AllBooks?.filter((book) => book.ingest_status === "done") ?? [];
+  const lastBook = readyBooks[readyBooks.length - 1] ?? null;
+  const LastTwo = readyBooks.slice(-2);
 
   // Uploads epub file whenever UploadButton is triggered
   const fileInputRef = useRef<HTMLInputElement>(null);
@@ -63,7 +64,11 @@ export default function Home() {
 
       const data = await response.json();
       console.log("Upload successful:", data);
-      alert("Book uploaded successfully!");
+      if (data.duplicate) {
+        alert("This book is already in your library.");
+      } else {
+        alert("Book uploaded! It will appear in your library once processing finishes.");
+      }
     } catch (error) {
       console.error("Error uploading book:", error);
       alert("Error uploading file.");
@@ -120,16 +125,27 @@ export default function Home() {
                           initial={{ opacity: 0, x: 200 * (i + 1) }}
                           animate={{ opacity: 1, x: 0 }}
                         >
-                          <a
-                            href={`/book/${book.id}/1`}
-                            style={{ textDecoration: "none" }}
-                          >
+                          {book.ingest_status === "done" ? (
+                            <a
+                              href={`/book/${book.id}/1`}
+                              style={{ textDecoration: "none" }}
+                            >
+                              <BookCard
+                                title={book.title}
+                                coverImage={book.cover_image}
+                                coverSrcset={book.cover_srcset}
+                                description="summary TBD"
+                              />
+                            </a>
+                          ) : (
                             <BookCard
                               title={book.title}
                               coverImage={book.cover_image}
+                              coverSrcset={book.cover_srcset}
                               description="summary TBD"
+                              status={book.ingest_status}
                             />
-                          </a>
+                          )}
                         </motion.li>
                       ))
                     : [],
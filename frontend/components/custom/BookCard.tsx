@@ -1,21 +1,36 @@
+import ResponsiveImage from "./ResponsiveImage";
+
 export default function BookCard({
   title,
   description,
   coverImage,
+  coverSrcset,
   onClick,
+  status = "done",
 }: any) {
+  // books still being ingested (or whose ingestion failed) are shown but cannot be opened
+  const ready = status === "done";
   return (
     <div
-      className="bg-transparent text-white w-[280px] h-[450px] rounded-[5px]   cursor-pointer transition-transform duration-300 ease-in-out mb-6 mr-4 hover:scale-[1.02]"
-      onClick={onClick}
+      className={`bg-transparent text-white w-[280px] h-[450px] rounded-[5px] transition-transform duration-300 ease-in-out mb-6 mr-4 ${
+        ready ? "cursor-pointer hover:scale-[1.02]" : "cursor-default opacity-60"
+      }`}
+      onClick={ready ? onClick : undefined}
     >
-      <img
+      <ResponsiveImage
         src={coverImage}
+        srcset={coverSrcset}
+        sizes="280px"
         alt={title}
         className="w-full h-5/6 aspect-square rounded-[8px]"
       />
       <div className=" ">
         <h3 className="text-[1.2rem] font-bold m-2 line-clamp-2">{title}</h3>
+        {!ready && (
+          <p className="text-sm mx-2">
+            {status === "failed" ? "Processing failed" : "Processing..."}
+          </p>
+        )}
       </div>
     </div>
   );
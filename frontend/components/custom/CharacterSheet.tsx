@@ -8,6 +8,7 @@ import {
   CarouselNext,
   CarouselPrevious,
 } from "@/components/ui/carousel";
+import ResponsiveImage from "./ResponsiveImage";
 
 type Props = {
   open: boolean;
@@ -47,8 +48,10 @@ export default function CharacterSheet({ open, onClose, characters }: Props) {
                     <Card className="w-[480px] h-auto shadow-md flex items-center">
                       <CardContent className="flex flex-row items-center p-4 space-x-4">
                         {char.image ? (
-                          <img
+                          <ResponsiveImage
                             src={`http://127.0.0.1:8000${char.image}`}
+                            srcset={char.image_srcset}
+                            sizes="160px"
                             alt={char.name}
                             className="w-40 h-52 object-cover rounded-lg shadow-sm"
                           />
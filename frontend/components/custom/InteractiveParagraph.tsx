@@ -2,9 +2,15 @@
 import { useState } from "react";
 import { Copy, Play, RotateCcw } from "lucide-react";
 import { toast } from "react-toastify";
+import ResponsiveImage from "./ResponsiveImage";
+
+const SCENE_POLL_INTERVAL_MS = 2000;
+// give up after 5 minutes
+const SCENE_POLL_MAX_ATTEMPTS = 150;
 
 interface SceneData {
   imageUrl: string;
+  srcset?: Record<string, string>;
   caption: string;
 }
 
@@ -29,6 +35,41 @@ export default function InteractiveParagraph({  children,event_number,  bookId,
     toast.success("Feature coming soon");
   };
 
+  const showScene = (data: { image_url: string; srcset?: Record<string, string>; caption: string }) => {
+    setScene({
+      imageUrl: data.image_url,
+      srcset: data.srcset,
+      caption: data.caption,
+    });
+  };
+
+  // poll a scene job until its image is generated (or generation failed).
+  // A preview is shown as soon as the job has one, the full render replaces it when done
+  const waitForSceneJob = async (statusUrl: string) => {
+    for (let attempt = 0; attempt < SCENE_POLL_MAX_ATTEMPTS; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, SCENE_POLL_INTERVAL_MS));
+      const response = await fetch(statusUrl, { method: "GET" });
+      if (!response.ok) {
+        throw new Error(`HTTP error: ${response.status}`);
+      }
+      const job = await response.json();
+      if (job.status === "done") {
+        return job;
+      }
+      if (job.image_url) {
+        showScene(job);
+      }
+      // the full render failed but the preview is there: keep the preview
+      if (job.status === "failed" && job.image_url) {
+        return job;
+      }
+      if (job.status === "failed") {
+        throw new Error(`Scene generation failed: ${job.error}`);
+      }
+    }
+    throw new Error("Scene generation timed out");
+  };
+
   const handleImageScene = async () => {
     try {
       setIsLoadingScene(true);
@@ -44,11 +85,16 @@ export default function InteractiveParagraph({  children,event_number,  bookId,
         throw new Error(`HTTP error: ${response.status}`);
       }
 
-      const data = await response.json();
-      setScene({
-        imageUrl: data.image_url,
-        caption: data.caption,
-      });
+      // 202: the image is being generated in the background.
+      // tier "preview": a low quality image is ready, the full render is on its way
+      let data = await response.json();
+      if (data.tier === "preview") {
+        showScene(data);
+      }
+      if (response.status === 202 || data.tier === "preview") {
+        data = await waitForSceneJob(data.status_url);
+      }
+      showScene(data);
 
       toast.success("Scene image loaded!");
     } catch (error) {
@@ -101,8 +147,10 @@ export default function InteractiveParagraph({  children,event_number,  bookId,
       {scene && (
         <div className="mt-3 flex flex-col gap-4 items-center">
           {scene.imageUrl && (
-            <img
+            <ResponsiveImage
               src={scene.imageUrl}
+              srcset={scene.srcset}
+              sizes="(max-width: 800px) 100vw, 800px"
               alt={scene.caption || "Generated image"}
               className="w-200 h-auto rounded-md border"
             />
@@ -1,16 +1,21 @@
 "use client";
 
 import React, { useEffect, useState } from "react";
-import { GraphCanvas, type GraphNode, type GraphEdge } from "reagraph";
+import { GraphCanvas, type GraphNode, type GraphEdge, type InternalGraphPosition } from "reagraph";
 
-type Props = { bookId: number };
+// node coordinates precomputed by the backend (force-directed layout)
+type LayoutNode = GraphNode & { x?: number; y?: number };
 
-export default function RelationshipGraph({ bookId }: Props) {
-  const [nodes, setNodes] = useState<GraphNode[]>([]);
+type Props = { bookId: number; chapterId?: number };
+
+export default function RelationshipGraph({ bookId, chapterId }: Props) {
+  const [nodes, setNodes] = useState<LayoutNode[]>([]);
   const [edges, setEdges] = useState<GraphEdge[]>([]);
 
   useEffect(() => {
-    fetch(`http://127.0.0.1:8000/api/books/${bookId}/graph/`)
+    // graph as of the current chapter; "no-cache" revalidates with the ETag so an unchanged graph is a 304
+    const upto = chapterId ? `?upto=${chapterId}` : "";
+    fetch(`http://127.0.0.1:8000/api/books/${bookId}/graph/${upto}`, { cache: "no-cache" })
       .then((r) => r.json())
       .then((j) => {
         setNodes(j.nodes || []);
@@ -20,7 +25,10 @@ export default function RelationshipGraph({ bookId }: Props) {
         setNodes([]);
         setEdges([]);
       });
-  }, [bookId]);
+  }, [bookId, chapterId]);
+
+  const positions = new Map(nodes.map((n) => [n.id, n]));
+  const hasLayout = nodes.length > 0 && nodes.every((n) => n.x !== undefined && n.y !== undefined);
 
   return (
     <div className="w-[800px] h-[500px] bg-slate-50 rounded-lg shadow-inner overflow-hidden">
@@ -31,6 +39,17 @@ export default function RelationshipGraph({ bookId }: Props) {
         edgeLabelPosition="inline"
         edgeArrowPosition="end"
         draggable
+        layoutType={hasLayout ? "custom" : "forceDirected2d"}
+        layoutOverrides={
+          hasLayout
+            ? {
+                getNodePosition: (id: string) => {
+                  const n = positions.get(id);
+                  return { x: n?.x ?? 0, y: n?.y ?? 0, z: 1 } as InternalGraphPosition;
+                },
+              }
+            : undefined
+        }
       />
     </div>
   );
@@ -0,0 +1,22 @@
+// <img> with the WebP/AVIF derivatives returned by the API as a srcset map ({avif: "...", webp: "..."}):
+// the browser picks the smallest derivative that fits `sizes`, src stays the fallback.
+const FORMATS = ["avif", "webp"];
+
+interface ResponsiveImageProps {
+  src: string;
+  srcset?: Record<string, string>;
+  sizes: string;
+  alt: string;
+  className?: string;
+}
+
+export default function ResponsiveImage({ src, srcset, sizes, alt, className }: ResponsiveImageProps) {
+  return (
+    <picture>
+      {FORMATS.filter((format) => srcset?.[format]).map((format) => (
+        <source key={format} type={`image/${format}`} srcSet={srcset![format]} sizes={sizes} />
+      ))}
+      <img src={src} alt={alt} className={className} />
+    </picture>
+  );
+}